@@ -1,15 +1,26 @@
-"""Save details of chunks to a text file and CSV file.
+"""Save details of chunks to a text file, a CSV file and a Parquet file.
+
+The chunks are read in batches of bounded size, from the chunk store of the database
+(or from the Chroma collection for the databases without chunk store), and all the
+statistics are computed in a single streaming pass, so that the memory used does not
+depend on the size of the collection.
 
 Usage:
 ======
-    python src/analysis/get_chunk_stats.py --data_dir [data_dir] --chroma_path [chroma_path]
+    python src/analysis/get_chunk_stats.py --chroma_path [chroma_path] [--batch_size batch_size]
+                                           [--profile [report-path]] [--cprofile-dir cprofile-dir]
 
 Arguments:
 ==========
-    --data_dir : str
-        The path to the directory containing the Markdown documents.
     --chroma_path : str
         The path to the directory containing the Chroma database.
+    --batch_size : int (optional)
+        The number of chunks read from the database at once. Default is 1000.
+    --profile : str (optional)
+        Record the wall time, CPU time and peak memory of each stage and save the report to this path
+        (get_chunk_stats_profile.json if no path is given). See stage_profiler.py.
+    --cprofile-dir : str (optional)
+        With --profile, also dump the cProfile statistics of each stage to this directory.
 
 Example:
 ========
@@ -17,7 +28,8 @@ Example:
 
 This command will load the Chroma database from the 'chroma_db' directory, reconstruct the chunks from the vector database, 
 save the details of each chunk to a text file named 'chroma_db_chunks_details.txt' 
-and save the id, the file name, the number of tokens and characters for each chunks to a CSV file named 'chroma_db_chunks_stats.csv'.
+and save the id, the file name, the number of tokens and characters for each chunks to a CSV file named 'chroma_db_chunks_stats.csv'
+and to a Parquet file named 'chroma_db_chunks_stats.parquet'.
 """
 
 # METADATA
@@ -31,10 +43,13 @@ __version__ = "1.0.0"
 # LIBRARY IMPORTS
 import os
 import sys
+import shutil
 import argparse
-from statistics import mean
-from typing import List, Tuple
+import tempfile
+from typing import Iterable, Iterator, List, Tuple, Union
 
+import pyarrow as pa
+import pyarrow.parquet as pq
 from loguru import logger
 from langchain_core.documents import Document
 from langchain_community.vectorstores import Chroma
@@ -45,26 +60,78 @@ project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 if project_root not in sys.path:
     sys.path.append(project_root)
 from query_chatbot import load_database
+from chunk_store import ChunkStore, ChunkView
+from index_versions import resolve_index_path
+from stage_profiler import StageProfiler, add_profile_arguments
+
+
+# CONSTANTS
+BATCH_SIZE = 1000
+PROFILE_PATH = "get_chunk_stats_profile.json"
+STATS_SCHEMA = pa.schema(
+    [
+        ("chunk_id", pa.int64()),
+        ("file_name", pa.string()),
+        ("nb_chars", pa.int64()),
+        ("nb_tokens", pa.int64()),
+    ]
+)
+
+
+# CLASSES
+class RunningStats:
+    """Count, sum, mean, min and max of a stream of values, updated in one pass."""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def update(self, value: Union[int, float]) -> None:
+        """Add a value to the statistics."""
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    @property
+    def mean(self) -> float:
+        """Mean of the values, 0 if there is no value."""
+        return self.total / self.count if self.count else 0
 
 
 # FUNCTIONS
-def get_args() -> str:
+def get_args() -> Tuple[str, int, str, str]:
     """Get the command line arguments.
     Returns
     -------
     chroma_path : str
         The path to the directory containing the Chroma database.
+    batch_size : int
+        The number of chunks read from the database at once.
+    profile_path : str or None
+        The path of the profile report of the stages (None for no profiling).
+    cprofile_dir : str or None
+        The directory of the cProfile statistics of the stages.
     """
     logger.info("Getting the command line arguments...")
     # Create the parser
     parser = argparse.ArgumentParser(
-        description="Save details of chunks to a text file and CSV file."
+        description="Save details of chunks to a text file, a CSV file and a Parquet file."
     )
     parser.add_argument(
         "--chroma_path",
         type=str,
         help="The path to the directory containing the Chroma database.",
     )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=BATCH_SIZE,
+        help="The number of chunks read from the database at once.",
+    )
+    add_profile_arguments(parser, PROFILE_PATH)
     # Parse the command line arguments
     args = parser.parse_args()
 
@@ -82,156 +149,191 @@ def get_args() -> str:
         )
         sys.exit(1)  # Exit the program
 
+    if args.batch_size <= 0:
+        logger.error("The batch size should be a positive integer.")
+        sys.exit(1)
+
     logger.success("Got the command line arguments successfully.\n")
 
-    return args.chroma_path
+    return args.chroma_path, args.batch_size, args.profile_path, args.cprofile_dir
+
 
+def iter_chunk_batches(
+    vector_db: Chroma, batch_size: int = BATCH_SIZE
+) -> Iterator[List[Document]]:
+    """Read the chunks from the vector database, one batch at a time.
+
+    The chunks are paginated in their insertion order, which is the order of their id,
+    and each batch is sorted by id.
 
-def reconstruct_chunks(vector_db: Chroma) -> List[Document]:
-    """Reconstruct the chunks from the vector database.
     Parameters
     ----------
     vector_db : Chroma
-        The vector database to reconstruct the chunks.
-    Returns
-    -------
+        The vector database to read the chunks from.
+    batch_size : int
+        The number of chunks read at once.
+
+    Yields
+    ------
     chunks : list of Document
-        List of text chunks reconstructed from the vector database.
-        format : [{"page_content": str, "metadata": dict}, ...]
+        A batch of text chunks reconstructed from the vector database.
     """
-    logger.info("Reconstructing the chunks from the vector database...")
-
-    chunks = []
-    vector_collections = vector_db.get()
-    total_chunks = len(vector_collections["ids"])
-    for i in range(total_chunks):
-        chunk = {
-            "page_content": vector_collections["documents"][i],
-            "metadata": vector_collections["metadatas"][i],
-        }
-        # ** used to unpack a dictionary into keyword arguments.
-        chunk = Document(**chunk)
-        chunks.append(chunk)
-
-    logger.success(
-        f"Reconstructed {total_chunks} chunks from the vector database successfully.\n"
-    )
-
-    return chunks
+    offset = 0
+    while True:
+        vector_collections = vector_db.get(
+            limit=batch_size, offset=offset, include=["documents", "metadatas"]
+        )
+        if not vector_collections["ids"]:
+            break
+        chunks = [
+            Document(page_content=content, metadata=metadata)
+            for content, metadata in zip(
+                vector_collections["documents"], vector_collections["metadatas"]
+            )
+        ]
+        yield sorted(chunks, key=lambda x: x.metadata["id"])
+        offset += len(chunks)
 
 
-def save_to_txt(chunks: List[Document], chroma_path: str) -> None:
-    """Save text chunks to a text file with metadata.
+def write_chunk_details(f, chunk: Union[Document, ChunkView]) -> None:
+    """Write the details of a chunk to a text file.
     Parameters
     ----------
-    chunks : list of Document
-        List of text chunks to save to a text file.
-    chroma_path : str
-        The path to the directory containing the Chroma database.
+    f : file object
+        The text file opened for writing.
+    chunk : Document or ChunkView
+        The text chunk to write.
     """
-    logger.info(f"Saving into text file...")
-
-    txt_output_path = chroma_path + "_chunks_details.txt"  # add .txt extension
-
-    # Get statistics of the tokens for all the chunks
-    all_tokens = sum(chunk.metadata.get("nb_tokens", 0) for chunk in chunks)
-    mean_tokens = mean(chunk.metadata.get("nb_tokens", 0) for chunk in chunks)
-    min_tokens = min(chunk.metadata.get("nb_tokens", 0) for chunk in chunks)
-    max_tokens = max(chunk.metadata.get("nb_tokens", 0) for chunk in chunks)
-
-    # Save the details of the chunks to a text file
-    with open(txt_output_path, "w") as f:
-        f.write("Chunks Details :\n\n")
-        # statistics of the tokens for all the chunks
-        f.write("Statistics of the tokens for all the chunks:\n")
-        f.write(f"- Count : {all_tokens}\n")
-        f.write(f"- Mean : {round(mean_tokens, 3)}\n")
-        f.write(f"- Min : {min_tokens}\n")
-        f.write(f"- Max : {max_tokens}\n\n")
-
-        f.write("Statistics of the characters for all the chunks:\n")
-        f.write(f"- Count : {sum(len(chunk.page_content) for chunk in chunks)}\n")
-        f.write(f"- Mean : {round(mean(len(chunk.page_content) for chunk in chunks), 3)}\n")
-        f.write(f"- Min : {min(len(chunk.page_content) for chunk in chunks)}\n")
-        f.write(f"- Max : {max(len(chunk.page_content) for chunk in chunks)}\n\n")
-
-        # sort the chunks by the id
-        chunks = sorted(chunks, key=lambda x: x.metadata["id"])
-
-        for chunk in chunks:
-            f.write(f"Chunk id: {chunk.metadata['id']}\n")
-            f.write(f"Number of Characters: {len(chunk.page_content)}\n")
-            f.write(f"Number of Tokens: {chunk.metadata['nb_tokens']}\n")
-            f.write(f"Url: {chunk.metadata['url']}\n")
-            f.write(f"File Name: {chunk.metadata['file_name']}\n")
-            f.write(f"Chapter Name: {chunk.metadata['chapter_name']}\n")
-            if "section_name" in chunk.metadata:
-                f.write(f"Section Name: {chunk.metadata.get('section_name', '')}\n")
-            if "subsection_name" in chunk.metadata:
-                f.write(
-                    f"Subsection Name: {chunk.metadata.get('subsection_name', '')}\n"
-                )
-            if "subsubsection_name" in chunk.metadata:
-                f.write(
-                    f"Subsubsection Name: {chunk.metadata.get('subsubsection_name', '')}\n"
-                )
-            f.write(f"Content:\n")
-            f.write(f"{chunk.page_content}\n\n")
-
-    logger.success(
-        f"Saved the details of each chunks successfully to '{txt_output_path}'.\n"
-    )
+    f.write(f"Chunk id: {chunk.metadata['id']}\n")
+    f.write(f"Number of Characters: {len(chunk.page_content)}\n")
+    f.write(f"Number of Tokens: {chunk.metadata['nb_tokens']}\n")
+    f.write(f"Url: {chunk.metadata['url']}\n")
+    f.write(f"File Name: {chunk.metadata['file_name']}\n")
+    f.write(f"Chapter Name: {chunk.metadata['chapter_name']}\n")
+    if "section_name" in chunk.metadata:
+        f.write(f"Section Name: {chunk.metadata.get('section_name', '')}\n")
+    if "subsection_name" in chunk.metadata:
+        f.write(
+            f"Subsection Name: {chunk.metadata.get('subsection_name', '')}\n"
+        )
+    if "subsubsection_name" in chunk.metadata:
+        f.write(
+            f"Subsubsection Name: {chunk.metadata.get('subsubsection_name', '')}\n"
+        )
+    f.write(f"Content:\n")
+    f.write(f"{chunk.page_content}\n\n")
 
 
-def save_to_csv(
-    chunks: List[Document],
-    chroma_path: str,
+def write_stats_header(f, token_stats: RunningStats, char_stats: RunningStats) -> None:
+    """Write the statistics of the tokens and characters of all the chunks.
+    Parameters
+    ----------
+    f : file object
+        The text file opened for writing.
+    token_stats : RunningStats
+        The statistics of the number of tokens of the chunks.
+    char_stats : RunningStats
+        The statistics of the number of characters of the chunks.
+    """
+    f.write("Chunks Details :\n\n")
+    # statistics of the tokens for all the chunks
+    f.write("Statistics of the tokens for all the chunks:\n")
+    f.write(f"- Count : {token_stats.total}\n")
+    f.write(f"- Mean : {round(token_stats.mean, 3)}\n")
+    f.write(f"- Min : {token_stats.min}\n")
+    f.write(f"- Max : {token_stats.max}\n\n")
+
+    f.write("Statistics of the characters for all the chunks:\n")
+    f.write(f"- Count : {char_stats.total}\n")
+    f.write(f"- Mean : {round(char_stats.mean, 3)}\n")
+    f.write(f"- Min : {char_stats.min}\n")
+    f.write(f"- Max : {char_stats.max}\n\n")
+
+
+def save_chunk_stats(
+    chunk_batches: Iterable[List[Union[Document, ChunkView]]], chroma_path: str
 ) -> None:
-    """Save details of the chunks to a CSV file.
+    """Save the details and statistics of the chunks in a single pass over the database.
+
+    The details of the chunks are written to a temporary file while the statistics are
+    accumulated, then the statistics and the details are assembled in the text file.
+    The CSV and Parquet rows are written batch by batch.
 
     Parameters
     ----------
-    chunks : list of Document
-        List of text chunks to save to a CSV file.
+    chunk_batches : iterable of list of Document or ChunkView
+        The batches of chunks, ordered by id.
     chroma_path : str
         The path to the directory containing the Chroma database.
     """
-    logger.info(f"Saving into CSV file...")
-    csv_output_path = chroma_path + "_chunks_stats.csv"  # add .csv extension
-
-    # order the chunks by the id
-    chunks = sorted(chunks, key=lambda x: x.metadata["id"])
+    logger.info("Saving the details of the chunks in text, CSV and Parquet files...")
 
-    with open(csv_output_path, "w") as f:
-        f.write("chunk_id,file_name,nb_chars,nb_tokens\n")
-        for chunk in chunks:
-            f.write(
-                f"{chunk.metadata['id']},{chunk.metadata['file_name']},{len(chunk.page_content)},{chunk.metadata['nb_tokens']}\n"
-            )
+    txt_output_path = chroma_path + "_chunks_details.txt"  # add .txt extension
+    csv_output_path = chroma_path + "_chunks_stats.csv"  # add .csv extension
+    parquet_output_path = chroma_path + "_chunks_stats.parquet"  # add .parquet extension
+
+    token_stats = RunningStats()
+    char_stats = RunningStats()
+    with tempfile.TemporaryFile("w+") as details, open(
+        csv_output_path, "w"
+    ) as csv_file, pq.ParquetWriter(parquet_output_path, STATS_SCHEMA) as parquet_writer:
+        csv_file.write("chunk_id,file_name,nb_chars,nb_tokens\n")
+        for chunks in chunk_batches:
+            rows = {name: [] for name in STATS_SCHEMA.names}
+            for chunk in chunks:
+                nb_chars = len(chunk.page_content)
+                nb_tokens = chunk.metadata.get("nb_tokens", 0)
+                token_stats.update(nb_tokens)
+                char_stats.update(nb_chars)
+                write_chunk_details(details, chunk)
+                csv_file.write(
+                    f"{chunk.metadata['id']},{chunk.metadata['file_name']},{nb_chars},{nb_tokens}\n"
+                )
+                rows["chunk_id"].append(chunk.metadata["id"])
+                rows["file_name"].append(chunk.metadata["file_name"])
+                rows["nb_chars"].append(nb_chars)
+                rows["nb_tokens"].append(nb_tokens)
+            parquet_writer.write_table(pa.table(rows, schema=STATS_SCHEMA))
+
+        # Write the statistics before the details of the chunks
+        details.seek(0)
+        with open(txt_output_path, "w") as f:
+            write_stats_header(f, token_stats, char_stats)
+            shutil.copyfileobj(details, f)
 
     logger.success(
-        f"Saved the number of tokens and chunks for each files successfully to '{csv_output_path}'.\n"
+        f"Saved the details of {token_stats.count} chunks successfully to '{txt_output_path}'.\n"
+    )
+    logger.success(
+        f"Saved the number of tokens and chunks for each files successfully to '{csv_output_path}' and '{parquet_output_path}'.\n"
     )
 
 
 def main() -> None:
-    """Main function to save details of chunks to a text file and CSV file."""
+    """Main function to save details of chunks to a text file, a CSV file and a Parquet file."""
     # Get the command line arguments
-    chroma_path = get_args()
-
-    # load the Chroma database
-    vector_db = load_database(chroma_path)[0]
+    chroma_path, batch_size, profile_path, cprofile_dir = get_args()
+    profiler = StageProfiler(enabled=profile_path is not None, cprofile_dir=cprofile_dir)
 
-    # get the chunks from the vector database
-    chunks = reconstruct_chunks(vector_db)
+    # read the chunks from the chunk store, or from the Chroma database
+    with profiler.stage("load"):
+        chunk_store = ChunkStore.load(resolve_index_path(chroma_path))
+        if chunk_store is not None:
+            logger.info(f"Reading the {len(chunk_store)} chunks from the chunk store.")
+            chunk_batches = chunk_store.iter_batches(batch_size)
+        else:
+            vector_db = load_database(chroma_path)[0]
+            chunk_batches = iter_chunk_batches(vector_db, batch_size)
 
-    # save the details of each chunks to a text file
-    save_to_txt(chunks, chroma_path)
+    # save the details and the statistics of the chunks in one pass
+    # (the chunks are read from the database while the statistics are computed)
+    with profiler.stage("stats"):
+        save_chunk_stats(chunk_batches, chroma_path)
 
-    # save the number of tokens and chunks for each files to a CSV file
-    save_to_csv(chunks, chroma_path)
+    if profile_path is not None:
+        profiler.write_report(profile_path, "get_chunk_stats")
 
 
 # MAIN PROGRAM
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
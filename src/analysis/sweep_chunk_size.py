@@ -0,0 +1,389 @@
+"""Compare chunk sizes on retrieval quality, query latency and index size.
+
+This script loads and preprocesses the Markdown files once, then splits the content
+for every chunk size in parallel worker processes. Chunks are embedded through a
+cache keyed on the chunk text, so identical chunks are embedded only once across
+chunk sizes and across runs. Each chunk size is scored on:
+
+- the hit rate: fraction of the labelled questions of `banque_questions_python.yaml`
+  for which at least one of the top k retrieved chunks belongs to the question chapter,
+- the mean and 95th percentile of the search latency,
+- the size of the index on disk.
+
+Usage:
+======
+    python src/analysis/sweep_chunk_size.py --data-path [data-path] [--sizes sizes] [--overlap overlap]
+                                            [--questions questions] [--k k] [--output output]
+
+Arguments:
+==========
+    --data-path : str
+        The directory containing the processed Markdown files of the python course.
+    --sizes : list of int (optional)
+        The chunk sizes to compare. Default is 200 400 600 800 1000 1500 2000 3000.
+    --overlap : int (optional)
+        The overlap between text chunks. Default is 100.
+    --questions : str (optional)
+        The YAML file of labelled questions. Default is data/banque_questions_python.yaml.
+    --k : int (optional)
+        The number of retrieved chunks per question. Default is 3.
+    --cache-path : str (optional)
+        The directory of the embedding cache. Default is embedding_cache.
+    --output : str (optional)
+        The CSV file where the comparison table is saved. Default is chunk_size_sweep.csv.
+    --provider : str (optional)
+        The embedding provider: "openai" or "local". Default is "openai".
+
+Example:
+========
+    python src/analysis/sweep_chunk_size.py --data-path data/markdown_processed --sizes 500 1000 2000
+
+This command will split the course into chunks of 500, 1000 and 2000 characters,
+embed and index the chunks of each size, and display one table comparing the chunk sizes.
+"""
+
+# METADATA
+__authors__ = ("Pierre Poulain", "Essmay Touami")
+__contact__ = "pierre.poulain@u-paris.fr"
+__copyright__ = "BSD-3 clause"
+__date__ = "2024"
+__version__ = "1.0.0"
+
+
+# LIBRARY IMPORTS
+import os
+import re
+import sys
+import time
+import argparse
+import tempfile
+from statistics import mean, quantiles
+from concurrent.futures import ProcessPoolExecutor
+
+import yaml
+import pandas as pd
+from loguru import logger
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_community.vectorstores import Chroma
+from langchain.storage import LocalFileStore
+from langchain.embeddings import CacheBackedEmbeddings
+
+# MODULE IMPORTS
+# Add the project root directory to the sys.path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if project_root not in sys.path:
+    sys.path.append(project_root)
+from create_database import (
+    EMBEDDING_MODEL,
+    load_documents,
+    get_file_names,
+    concatenate_content,
+    split_text,
+    remove_small_chunks,
+    add_index_to_metadata,
+    add_token_number_to_metadata,
+    add_file_names_to_metadata,
+    add_url_to_metadata,
+)
+from dedup import remove_near_duplicates
+from providers import PROVIDERS, DEFAULT_PROVIDER, LOCAL_EMBEDDING_DIM, get_embedding_function
+
+
+# CONSTANTS
+CHUNK_SIZES = [200, 400, 600, 800, 1000, 1500, 2000, 3000]
+CHUNK_OVERLAP = 100
+QUESTIONS_PATH = "data/banque_questions_python.yaml"
+EMBEDDING_CACHE_PATH = "embedding_cache"
+OUTPUT_PATH = "chunk_size_sweep.csv"
+
+
+# FUNCTIONS
+def get_args() -> tuple[str, list[int], int, str, int, str, str, str]:
+    """Parse command-line arguments.
+
+    Returns
+    -------
+    data_path, sizes, overlap, questions_path, k, cache_path, output_path, provider : Tuple[str, list[int], int, str, int, str, str, str]
+        - data_path : str
+            The directory containing the processed Markdown files.
+        - sizes : list of int
+            The chunk sizes to compare.
+        - overlap : int
+            The overlap between text chunks.
+        - questions_path : str
+            The YAML file of labelled questions.
+        - k : int
+            The number of retrieved chunks per question.
+        - cache_path : str
+            The directory of the embedding cache.
+        - output_path : str
+            The CSV file where the comparison table is saved.
+        - provider : str
+            The embedding provider.
+    """
+    parser = argparse.ArgumentParser(
+        description="Compare chunk sizes on retrieval quality, query latency and index size."
+    )
+    parser.add_argument(
+        "--data-path",
+        dest="data_path",
+        required=True,
+        help="The directory containing the processed Markdown files of the python course.",
+    )
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=CHUNK_SIZES, help="The chunk sizes to compare."
+    )
+    parser.add_argument(
+        "--overlap", type=int, default=CHUNK_OVERLAP, help="The overlap between text chunks."
+    )
+    parser.add_argument(
+        "--questions",
+        dest="questions_path",
+        default=QUESTIONS_PATH,
+        help="The YAML file of labelled questions.",
+    )
+    parser.add_argument(
+        "--k", type=int, default=3, help="The number of retrieved chunks per question."
+    )
+    parser.add_argument(
+        "--cache-path",
+        dest="cache_path",
+        default=EMBEDDING_CACHE_PATH,
+        help="The directory of the embedding cache.",
+    )
+    parser.add_argument(
+        "--output",
+        dest="output_path",
+        default=OUTPUT_PATH,
+        help="The CSV file where the comparison table is saved.",
+    )
+    parser.add_argument(
+        "--provider", choices=PROVIDERS, default=DEFAULT_PROVIDER, help="The embedding provider."
+    )
+    args = parser.parse_args()
+
+    # Checks
+    if not os.path.exists(args.data_path):
+        logger.error(f"The data directory '{args.data_path}' does not exist.")
+        sys.exit(1)
+    if not os.path.exists(args.questions_path):
+        logger.error(f"The questions file '{args.questions_path}' does not exist.")
+        sys.exit(1)
+    if any(size <= args.overlap for size in args.sizes):
+        logger.error(f"The chunk sizes should be greater than the overlap ({args.overlap}).")
+        sys.exit(1)
+
+    return (
+        args.data_path,
+        args.sizes,
+        args.overlap,
+        args.questions_path,
+        args.k,
+        args.cache_path,
+        args.output_path,
+        args.provider,
+    )
+
+
+def load_labelled_questions(questions_path: str) -> list[tuple[str, int]]:
+    """Load the questions and the number of the chapter they are related to.
+
+    Parameters
+    ----------
+    questions_path : str
+        The YAML file of questions, grouped by chapter ('Chapitre 1 : Introduction').
+
+    Returns
+    -------
+    questions : list of tuple
+        List of (question, chapter number).
+    """
+    logger.info(f"Loading labelled questions from '{questions_path}'...")
+
+    with open(questions_path, "r", encoding="utf-8") as f:
+        data = yaml.safe_load(f)
+
+    questions = []
+    for chapter, chapter_questions in data["questions"].items():
+        chapter_number = re.match(r"Chapitre\s+(\d+)", chapter)
+        if not chapter_number:
+            continue
+        for question in chapter_questions:
+            for text in question.values():
+                questions.append((text, int(chapter_number.group(1))))
+
+    logger.success(f"Loaded {len(questions)} labelled questions.\n")
+
+    return questions
+
+
+def prepare_chunks(
+    content: str, file_names: list[str], chunk_size: int, chunk_overlap: int
+) -> list[Document]:
+    """Split the content into chunks and add their metadata, as in create_database.py.
+
+    Parameters
+    ----------
+    content : str
+        The concatenated content of the Markdown files.
+    file_names : list of str
+        List of file names of the Markdown documents.
+    chunk_size : int
+        The size of the text chunks to be created.
+    chunk_overlap : int
+        The overlap between text chunks.
+
+    Returns
+    -------
+    chunks : list of Document
+        List of text chunks with their metadata.
+    """
+    logger.remove()  # keep the output of the worker processes readable
+    chunks = split_text(content, chunk_size, chunk_overlap)
+    chunks = remove_small_chunks(chunks, min_nb_char=100)
+    chunks, _duplicates = remove_near_duplicates(chunks)
+    chunks = add_index_to_metadata(chunks)
+    chunks = add_token_number_to_metadata(chunks)
+    chunks = add_file_names_to_metadata(chunks, file_names)
+    chunks = add_url_to_metadata(chunks)
+
+    return chunks
+
+
+def get_directory_size(path: str) -> int:
+    """Get the size of the files of a directory, in bytes."""
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _dirs, files in os.walk(path)
+        for name in files
+    )
+
+
+def score_chunk_size(
+    chunks: list[Document],
+    embedding_function: Embeddings,
+    questions: list[tuple[str, int]],
+    questions_vectors: list[list[float]],
+    k: int,
+) -> dict:
+    """Index the chunks and score the retrieval of the labelled questions.
+
+    Parameters
+    ----------
+    chunks : list of Document
+        List of text chunks with their metadata.
+    embedding_function : Embeddings
+        The (cached) embedding function.
+    questions : list of tuple
+        List of (question, chapter number).
+    questions_vectors : list of list of float
+        The embeddings of the questions.
+    k : int
+        The number of retrieved chunks per question.
+
+    Returns
+    -------
+    dict
+        The hit rate, the search latencies and the size of the index.
+    """
+    with tempfile.TemporaryDirectory() as index_path:
+        start = time.perf_counter()
+        vector_db = Chroma.from_documents(
+            chunks,
+            embedding_function,
+            persist_directory=index_path,
+            collection_metadata={"hnsw:space": "cosine"},
+        )
+        build_time = time.perf_counter() - start
+
+        hits = 0
+        latencies = []
+        for (_question, chapter_number), vector in zip(questions, questions_vectors):
+            start = time.perf_counter()
+            results = vector_db.similarity_search_by_vector(vector, k=k)
+            latencies.append(time.perf_counter() - start)
+            chapter_prefix = f"{chapter_number:02d}_"
+            if any(
+                chunk.metadata.get("file_name", "").startswith(chapter_prefix)
+                for chunk in results
+            ):
+                hits += 1
+        index_size = get_directory_size(index_path)
+
+    return {
+        "nb_chunks": len(chunks),
+        "mean_tokens": round(mean(chunk.metadata["nb_tokens"] for chunk in chunks), 1),
+        f"hit_rate@{k}": round(hits / len(questions), 3),
+        "mean_latency_ms": round(mean(latencies) * 1e3, 2),
+        "p95_latency_ms": round(quantiles(latencies, n=20)[18] * 1e3, 2),
+        "index_size_mb": round(index_size / 1e6, 2),
+        "build_time_s": round(build_time, 1),
+    }
+
+
+def sweep_chunk_sizes() -> None:
+    """Split, index and score the course for every chunk size."""
+    (
+        data_path,
+        sizes,
+        overlap,
+        questions_path,
+        k,
+        cache_path,
+        output_path,
+        provider,
+    ) = get_args()
+
+    # Load and preprocess the course once
+    documents = load_documents(data_path)
+    file_names = get_file_names(documents)
+    content = concatenate_content(documents)
+
+    # Split the content for every chunk size in parallel
+    logger.info(f"Splitting the content for chunk sizes {sizes}...")
+    with ProcessPoolExecutor() as executor:
+        all_chunks = list(
+            executor.map(
+                prepare_chunks,
+                [content] * len(sizes),
+                [file_names] * len(sizes),
+                sizes,
+                [overlap] * len(sizes),
+            )
+        )
+    logger.success("Split the content for all chunk sizes.\n")
+
+    # Embed the chunks through a cache keyed on the chunk text and on the embedding model
+    # (and the dimension of the local embeddings, so that another dimension is not served)
+    namespace = f"{provider}_{EMBEDDING_MODEL}"
+    if provider == "local":
+        namespace += f"_{LOCAL_EMBEDDING_DIM}"
+    embedding_function = CacheBackedEmbeddings.from_bytes_store(
+        get_embedding_function(provider, EMBEDDING_MODEL),
+        LocalFileStore(cache_path),
+        namespace=namespace,
+    )
+    questions = load_labelled_questions(questions_path)
+    questions_vectors = embedding_function.embed_documents(
+        [question for question, _chapter in questions]
+    )
+
+    # Score every chunk size
+    rows = []
+    for size, chunks in zip(sizes, all_chunks):
+        logger.info(f"Scoring chunk size {size} ({len(chunks)} chunks)...")
+        scores = score_chunk_size(chunks, embedding_function, questions, questions_vectors, k)
+        rows.append({"chunk_size": size, "chunk_overlap": overlap, **scores})
+        logger.success(f"Scored chunk size {size}.\n")
+
+    # Display and save the comparison table
+    table = pd.DataFrame(rows)
+    print(table.to_string(index=False))
+    table.to_csv(output_path, index=False)
+    logger.success(f"Saved the comparison table to '{output_path}'.")
+
+
+# MAIN PROGRAM
+if __name__ == "__main__":
+    sweep_chunk_sizes()
@@ -0,0 +1,373 @@
+"""Micro-benchmarks of the ingestion and query hot paths.
+
+This script times the functions of the ingestion pipeline and of the query pipeline
+on fixed synthetic inputs whose size is controlled by a scale factor.
+The results are saved as JSON and compared to a stored baseline:
+the script fails if a function is slower than the baseline beyond a given tolerance.
+
+Usage:
+======
+    python src/benchmarks/benchmark_hot_paths.py [--scale scale] [--repeat repeat]
+                                                 [--output output] [--baseline baseline]
+                                                 [--tolerance tolerance] [--save-baseline]
+
+Arguments:
+==========
+    --scale : int (optional)
+        Scale factor of the synthetic inputs. Default is 1.
+    --repeat : int (optional)
+        Number of timing repetitions for each function. Default is 5.
+    --output : str (optional)
+        Path of the JSON file where the results are saved. Default is bench_hot_paths.json.
+    --baseline : str (optional)
+        Path of the JSON baseline. Default is src/benchmarks/baseline_hot_paths.json.
+    --tolerance : float (optional)
+        Allowed slowdown relative to the baseline. Default is 0.2 (20 %).
+    --save-baseline : flag (optional)
+        Save the results as the new baseline instead of comparing them.
+
+Example:
+========
+    python src/benchmarks/benchmark_hot_paths.py --scale 4
+
+This command will time each function on inputs 4 times larger than the default ones,
+save the results to `bench_hot_paths.json` and compare them to the baseline.
+"""
+
+# METADATA
+__authors__ = ("Pierre Poulain", "Essmay Touami")
+__contact__ = "pierre.poulain@u-paris.fr"
+__copyright__ = "BSD-3 clause"
+__date__ = "2024"
+__version__ = "1.0.0"
+
+
+# LIBRARY IMPORTS
+import os
+import sys
+import json
+import timeit
+import argparse
+import platform
+from statistics import median
+from typing import Callable
+
+from loguru import logger
+from langchain_core.documents import Document
+
+# MODULE IMPORTS
+# Add the project root directory to the sys.path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if project_root not in sys.path:
+    sys.path.append(project_root)
+from parse_clean_markdown import clean_python_comments, renumber_headers
+from create_database import (
+    concatenate_content,
+    split_text,
+    add_token_number_to_metadata,
+    add_file_names_to_metadata,
+    preprocess_for_url,
+)
+from dedup import remove_near_duplicates
+from query_chatbot import (
+    format_relevant_chunks,
+    format_chat_history,
+    add_metadata_to_answer,
+)
+
+
+# CONSTANTS
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline_hot_paths.json")
+OUTPUT_PATH = "bench_hot_paths.json"
+TOLERANCE = 0.2
+SECTIONS_PER_CHAPTER = 8
+PARAGRAPH = (
+    "Les listes sont des objets modifiables. On peut y ajouter des éléments "
+    "avec la méthode .append() et accéder à un élément grâce à son indice. "
+    "Une liste peut contenir des éléments de types différents.\n"
+)
+CODE_BLOCK = (
+    "```python\n"
+    "#   Création d'une liste\n"
+    "animaux = ['girafe', 'tigre', 'singe']\n"
+    "for animal in animaux:\n"
+    "    #  Affichage de chaque élément\n"
+    "    print(animal)\n"
+    "```\n"
+)
+
+
+# FUNCTIONS
+def make_chapter(chapter_number: int) -> str:
+    """Create the Markdown content of a synthetic chapter.
+
+    Parameters
+    ----------
+    chapter_number : int
+        The number of the chapter.
+
+    Returns
+    -------
+    str
+        The Markdown content, with sections, subsections, paragraphs and Python code blocks.
+    """
+    lines = [f"# {chapter_number} Chapitre synthétique numéro {chapter_number}\n"]
+    for section in range(1, SECTIONS_PER_CHAPTER + 1):
+        lines.append(f"## {chapter_number}.{section} Les listes et les boucles\n")
+        lines.append(PARAGRAPH * 3)
+        lines.append(CODE_BLOCK)
+        lines.append(f"### {chapter_number}.{section}.1 Méthodes associées aux listes\n")
+        lines.append(PARAGRAPH * 2)
+        lines.append(CODE_BLOCK)
+
+    return "\n".join(lines)
+
+
+def make_inputs(scale: int) -> dict:
+    """Create the synthetic inputs of the benchmarks.
+
+    Parameters
+    ----------
+    scale : int
+        Scale factor of the inputs: the number of chapters of the synthetic course.
+
+    Returns
+    -------
+    dict
+        The synthetic inputs, by name.
+    """
+    nb_chapters = 2 * scale
+    documents = [
+        Document(
+            page_content=make_chapter(number),
+            metadata={"source": f"data/markdown_processed/{number:02d}_chapitre.md"},
+        )
+        for number in range(1, nb_chapters + 1)
+    ]
+    file_names = [f"{number:02d}_chapitre" for number in range(1, nb_chapters + 1)]
+    content = "\n".join(document.page_content for document in documents)
+    chunks = split_text(content, 1000, 200)
+    for index, chunk in enumerate(chunks):
+        chunk.metadata["id"] = index
+    chunks = add_token_number_to_metadata(chunks)
+    chunks = add_file_names_to_metadata(chunks, file_names)
+    headers = [
+        line.lstrip("#").strip() for line in content.split("\n") if line.startswith("#")
+    ]
+    metadatas = [
+        {**chunk.metadata, "url": f"https://python.sdv.univ-paris-diderot.fr/{chunk.metadata['file_name']}/#section"}
+        for chunk in chunks
+    ]
+    chat_history = [
+        (
+            f"Question numéro {i} sur les listes ?",
+            f"Réponse numéro {i}.\n\nPour plus d'informations, consultez les sources suivantes :\n- Chapitre **1**",
+        )
+        for i in range(10 * scale)
+    ]
+
+    return {
+        "documents": documents,
+        "file_names": file_names,
+        "content": content,
+        "chunks": chunks,
+        "headers": headers,
+        "metadatas": metadatas,
+        "chat_history": chat_history,
+    }
+
+
+def get_benchmarks(inputs: dict) -> dict[str, Callable]:
+    """Define the functions to benchmark on the synthetic inputs.
+
+    Parameters
+    ----------
+    inputs : dict
+        The synthetic inputs.
+
+    Returns
+    -------
+    dict
+        The benchmarked callables, by function name.
+    """
+    return {
+        "clean_python_comments": lambda: clean_python_comments(inputs["content"]),
+        "renumber_headers": lambda: renumber_headers(inputs["content"], 1),
+        "concatenate_content": lambda: concatenate_content(inputs["documents"]),
+        "split_text": lambda: split_text(inputs["content"], 1000, 200),
+        "remove_near_duplicates": lambda: remove_near_duplicates(inputs["chunks"]),
+        "add_token_number_to_metadata": lambda: add_token_number_to_metadata(inputs["chunks"]),
+        "add_file_names_to_metadata": lambda: add_file_names_to_metadata(
+            inputs["chunks"], inputs["file_names"]
+        ),
+        "preprocess_for_url": lambda: [
+            preprocess_for_url(header) for header in inputs["headers"]
+        ],
+        "format_relevant_chunks": lambda: format_relevant_chunks(inputs["chunks"]),
+        "format_chat_history": lambda: format_chat_history(
+            inputs["chat_history"], len_history=len(inputs["chat_history"])
+        ),
+        "add_metadata_to_answer": lambda: add_metadata_to_answer(
+            "Une réponse.", inputs["metadatas"]
+        ),
+    }
+
+
+def run_benchmarks(benchmarks: dict[str, Callable], repeat: int) -> dict:
+    """Time each benchmarked function.
+
+    Parameters
+    ----------
+    benchmarks : dict
+        The benchmarked callables, by function name.
+    repeat : int
+        Number of timing repetitions.
+
+    Returns
+    -------
+    results : dict
+        The minimum and median time of one call, in seconds, by function name.
+    """
+    results = {}
+    for name, function in benchmarks.items():
+        times = timeit.repeat(function, number=1, repeat=repeat)
+        results[name] = {"min_s": min(times), "median_s": median(times)}
+        print(f"{name:<30} min {min(times) * 1e3:10.3f} ms   median {median(times) * 1e3:10.3f} ms")
+
+    return results
+
+
+def compare_to_baseline(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Compare the results to the baseline.
+
+    The minimum times are compared since they are the least sensitive to system noise.
+
+    Parameters
+    ----------
+    results : dict
+        The benchmark results.
+    baseline : dict
+        The baseline results.
+    tolerance : float
+        Allowed slowdown relative to the baseline.
+
+    Returns
+    -------
+    regressions : list of str
+        The names of the functions slower than the baseline beyond the tolerance.
+    """
+    regressions = []
+    for name, result in results["results"].items():
+        if name not in baseline["results"]:
+            logger.warning(f"No baseline for '{name}'.")
+            continue
+        reference = baseline["results"][name]["min_s"]
+        ratio = result["min_s"] / reference
+        message = f"{name}: {ratio:.2f}x the baseline"
+        if ratio > 1 + tolerance:
+            logger.error(message)
+            regressions.append(name)
+        else:
+            logger.info(message)
+
+    return regressions
+
+
+def get_args() -> tuple[int, int, str, str, float, bool]:
+    """Parse command-line arguments.
+
+    Returns
+    -------
+    scale, repeat, output_path, baseline_path, tolerance, save_baseline : Tuple[int, int, str, str, float, bool]
+        - scale : int
+            Scale factor of the synthetic inputs.
+        - repeat : int
+            Number of timing repetitions.
+        - output_path : str
+            Path of the JSON results.
+        - baseline_path : str
+            Path of the JSON baseline.
+        - tolerance : float
+            Allowed slowdown relative to the baseline.
+        - save_baseline : bool
+            Flag to save the results as the new baseline.
+    """
+    parser = argparse.ArgumentParser(
+        description="Micro-benchmarks of the ingestion and query hot paths."
+    )
+    parser.add_argument("--scale", type=int, default=1, help="Scale factor of the synthetic inputs.")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timing repetitions.")
+    parser.add_argument("--output", default=OUTPUT_PATH, help="Path of the JSON results.")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="Path of the JSON baseline.")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=TOLERANCE,
+        help="Allowed slowdown relative to the baseline.",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        default=False,
+        help="Save the results as the new baseline.",
+    )
+    args = parser.parse_args()
+
+    # Checks
+    if args.scale <= 0 or args.repeat <= 0:
+        logger.error("The scale and the number of repetitions should be positive integers.")
+        sys.exit(1)
+
+    return (
+        args.scale,
+        args.repeat,
+        args.output,
+        args.baseline,
+        args.tolerance,
+        args.save_baseline,
+    )
+
+
+def main() -> None:
+    """Run the benchmarks and compare them to the baseline."""
+    scale, repeat, output_path, baseline_path, tolerance, save_baseline = get_args()
+
+    # Remove the logging of the benchmarked functions
+    logger.remove()
+    inputs = make_inputs(scale)
+    results = {
+        "scale": scale,
+        "repeat": repeat,
+        "python": platform.python_version(),
+        "results": run_benchmarks(get_benchmarks(inputs), repeat),
+    }
+    logger.add(sys.stderr)
+
+    # Save the results
+    if save_baseline:
+        output_path = baseline_path
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    logger.success(f"Saved the results to '{output_path}'.")
+    if save_baseline:
+        return
+
+    # Compare the results to the baseline
+    if not os.path.exists(baseline_path):
+        logger.warning(f"No baseline found at '{baseline_path}'. Use --save-baseline to create it.")
+        return
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline["scale"] != scale:
+        logger.error(f"The baseline was recorded with --scale {baseline['scale']}.")
+        sys.exit(1)
+    regressions = compare_to_baseline(results, baseline, tolerance)
+    if regressions:
+        logger.error(f"{len(regressions)} regression(s) beyond {tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+    logger.success("No regression compared to the baseline.")
+
+
+# MAIN PROGRAM
+if __name__ == "__main__":
+    main()
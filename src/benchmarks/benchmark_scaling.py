@@ -0,0 +1,373 @@
+"""Scaling benchmark of the ingestion on synthetic courses of increasing size.
+
+For each scale, a synthetic course is generated (see `generate_corpus.py`), processed by
+`parse_clean_markdown.py` and ingested by the `create_database.py` pipeline with the local
+embedding provider (no network access). Each scale is ingested twice with the stage profiler,
+in a new process each time so that the maximum resident memory is the one of the scale.
+The times of the stages are measured in a first run without memory tracing, since tracemalloc
+slows down the stages unevenly (2 to 10 times). Their peak memory (tracemalloc) is measured
+in a second run.
+
+The growth of each stage is measured by the exponent of its time (and peak memory) as a function
+of the corpus size, fitted in log-log scale: 1 for a linear stage, 2 for a quadratic one.
+The stages whose time exponent is above SUPERLINEAR_EXPONENT are reported as superlinear.
+The throughput (MB of Markdown per second) and the peak memory of each stage are plotted
+against the corpus size.
+
+Usage:
+======
+    python src/benchmarks/benchmark_scaling.py [--scales scales] [--chunk-size chunk-size]
+                                               [--chunk-overlap chunk-overlap] [--output output]
+                                               [--plot plot] [--seed seed]
+
+Arguments:
+==========
+    --scales : list of int (optional)
+        The sizes of the synthetic courses, relative to the real course. Default is 1 2 5 10.
+    --chunk-size : int (optional)
+        The size of the text chunks. Default is 1000.
+    --chunk-overlap : int (optional)
+        The overlap between text chunks. Default is 200.
+    --output : str (optional)
+        Path of the JSON file where the results are saved. Default is bench_scaling.json.
+    --plot : str (optional)
+        Path of the figure of the throughput and the peak memory. Default is bench_scaling.png.
+    --seed : int (optional)
+        The seed of the synthetic courses. Default is 0.
+
+Example:
+========
+    python src/benchmarks/benchmark_scaling.py --scales 1 10 100
+
+This command will ingest synthetic courses 1, 10 and 100 times larger than the real course,
+display the growth exponent of each stage and save the results and the figure.
+"""
+
+# METADATA
+__authors__ = ("Pierre Poulain", "Essmay Touami")
+__contact__ = "pierre.poulain@u-paris.fr"
+__copyright__ = "BSD-3 clause"
+__date__ = "2024"
+__version__ = "1.0.0"
+
+
+# LIBRARY IMPORTS
+import os
+import sys
+import json
+import shutil
+import argparse
+import platform
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import matplotlib
+
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+from loguru import logger
+
+# MODULE IMPORTS
+# Add the project root directory to the sys.path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if project_root not in sys.path:
+    sys.path.append(project_root)
+from generate_corpus import MAX_SCALE, generate_corpus
+from parse_clean_markdown import process_md_files
+from create_database import CHUNK_SIZE, CHUNK_OVERLAP, build_chunks, save_to_chroma
+from stage_profiler import StageProfiler
+from token_ledger import display_summary
+
+
+# CONSTANTS
+SCALES = [1, 2, 5, 10]
+OUTPUT_PATH = "bench_scaling.json"
+PLOT_PATH = "bench_scaling.png"
+SUPERLINEAR_EXPONENT = 1.2
+
+
+# FUNCTIONS
+def run_scale(
+    scale: int, chunk_size: int, chunk_overlap: int, seed: int, trace_memory: bool = False
+) -> dict:
+    """Generate and ingest a synthetic course, profiling the stages.
+
+    Parameters
+    ----------
+    scale : int
+        The size of the synthetic course, relative to the real course.
+    chunk_size : int
+        The size of the text chunks.
+    chunk_overlap : int
+        The overlap between text chunks.
+    seed : int
+        The seed of the synthetic course.
+    trace_memory : bool, optional
+        Measure the peak memory of the stages with tracemalloc, by default False
+        (the times are measured without the overhead of tracemalloc).
+
+    Returns
+    -------
+    dict
+        The size of the course, the number of chunks, the maximum resident memory
+        and the profile of the stages.
+    """
+    # Remove the logging of the benchmarked functions
+    logger.remove()
+    work_dir = tempfile.mkdtemp(prefix=f"bench_scaling_x{scale}_")
+    try:
+        raw_dir = os.path.join(work_dir, "markdown_raw")
+        processed_dir = os.path.join(work_dir, "markdown_processed")
+        corpus = generate_corpus(raw_dir, scale, seed)
+
+        profiler = StageProfiler(trace_memory=trace_memory)
+        with profiler.stage("parse"):
+            process_md_files(raw_dir, processed_dir, profiler)
+        chunks, _duplicates, _file_names = build_chunks(
+            processed_dir, chunk_size, chunk_overlap, profiler=profiler
+        )
+        with profiler.stage("save"):
+            save_to_chroma(
+                chunks,
+                os.path.join(work_dir, "chroma_db"),
+                ledger_path=os.path.join(work_dir, "token_ledger.csv"),
+                provider="local",
+            )
+        report = profiler.get_report(f"ingestion x{scale}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "scale": scale,
+        "size_mb": round(corpus["size_mb"], 3),
+        "nb_chunks": len(chunks),
+        "max_rss_mb": report["max_rss_mb"],
+        "stages": report["stages"],
+    }
+
+
+def profile_scale(scale: int, chunk_size: int, chunk_overlap: int, seed: int) -> dict:
+    """Ingest a synthetic course once for the times of the stages and once for their memory.
+
+    Each run is done in a new process: its memory is not shared with the previous runs.
+
+    Parameters
+    ----------
+    scale : int
+        The size of the synthetic course, relative to the real course.
+    chunk_size : int
+        The size of the text chunks.
+    chunk_overlap : int
+        The overlap between text chunks.
+    seed : int
+        The seed of the synthetic course.
+
+    Returns
+    -------
+    dict
+        The result of the run without memory tracing (times and maximum resident memory),
+        with the peak and net memory of the stages measured by the run with memory tracing.
+    """
+    results = {}
+    for trace_memory in (False, True):
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            results[trace_memory] = executor.submit(
+                run_scale, scale, chunk_size, chunk_overlap, seed, trace_memory
+            ).result()
+    result = results[False]
+    memory_stages = {stage["stage"]: stage for stage in results[True]["stages"]}
+    for stage in result["stages"]:
+        stage["peak_mb"] = memory_stages[stage["stage"]]["peak_mb"]
+        stage["net_mb"] = memory_stages[stage["stage"]]["net_mb"]
+
+    return result
+
+
+def fit_exponent(sizes: list[float], values: list[float]) -> float:
+    """Fit the exponent of a power law of the corpus size, in log-log scale."""
+    values = np.maximum(np.asarray(values, dtype=float), 1e-6)
+
+    return float(np.polyfit(np.log(sizes), np.log(values), 1)[0])
+
+
+def compute_growth(results: list[dict]) -> list[dict]:
+    """Compute the growth exponents of the time and the peak memory of each stage.
+
+    Parameters
+    ----------
+    results : list of dict
+        The results of the scales, by increasing size.
+
+    Returns
+    -------
+    growth : list of dict
+        For each stage, its time and peak memory at the largest scale, their growth
+        exponents and its throughput at the smallest and the largest scales.
+    """
+    sizes = [result["size_mb"] for result in results]
+    growth = []
+    for stage in results[0]["stages"]:
+        name = stage["stage"]
+        stages = [
+            next(row for row in result["stages"] if row["stage"] == name) for result in results
+        ]
+        walls = [row["wall_s"] for row in stages]
+        peaks = [row["peak_mb"] for row in stages]
+        time_exponent = fit_exponent(sizes, walls)
+        growth.append(
+            {
+                "stage": name,
+                "wall_s": walls[-1],
+                "peak_mb": peaks[-1],
+                "time_exponent": round(time_exponent, 2),
+                "memory_exponent": round(fit_exponent(sizes, peaks), 2),
+                "first_mb_per_s": round(sizes[0] / max(walls[0], 1e-6), 2),
+                "last_mb_per_s": round(sizes[-1] / max(walls[-1], 1e-6), 2),
+                "superlinear": time_exponent > SUPERLINEAR_EXPONENT,
+            }
+        )
+
+    return growth
+
+
+def plot_results(results: list[dict], plot_path: str) -> None:
+    """Plot the throughput and the peak memory of the stages against the corpus size.
+
+    Parameters
+    ----------
+    results : list of dict
+        The results of the scales, by increasing size.
+    plot_path : str
+        Path of the figure.
+    """
+    sizes = [result["size_mb"] for result in results]
+    # The nested stages are summed in their parent stage
+    names = [stage["stage"] for stage in results[0]["stages"] if "/" not in stage["stage"]]
+    fig, (ax_throughput, ax_memory) = plt.subplots(1, 2, figsize=(13, 5))
+    for name in names:
+        stages = [
+            next(row for row in result["stages"] if row["stage"] == name) for result in results
+        ]
+        throughputs = [size / max(row["wall_s"], 1e-6) for size, row in zip(sizes, stages)]
+        ax_throughput.plot(sizes, throughputs, "o-", label=name)
+        ax_memory.plot(sizes, [max(row["peak_mb"], 1e-3) for row in stages], "o-", label=name)
+    ax_memory.plot(sizes, [result["max_rss_mb"] for result in results], "k--", label="max RSS")
+    ax_throughput.set(
+        xscale="log", yscale="log", xlabel="Corpus size (MB)", ylabel="Throughput (MB/s)",
+        title="Throughput of the stages",
+    )
+    ax_memory.set(
+        xscale="log", yscale="log", xlabel="Corpus size (MB)", ylabel="Peak memory (MB)",
+        title="Peak memory of the stages",
+    )
+    ax_throughput.legend(fontsize="small")
+    ax_memory.legend(fontsize="small")
+    fig.tight_layout()
+    fig.savefig(plot_path, dpi=120)
+    plt.close(fig)
+
+
+def get_args() -> tuple[list[int], int, int, str, str, int]:
+    """Parse command-line arguments.
+
+    Returns
+    -------
+    scales, chunk_size, chunk_overlap, output_path, plot_path, seed : Tuple[list[int], int, int, str, str, int]
+        - scales : list of int
+            The sizes of the synthetic courses, by increasing size.
+        - chunk_size : int
+            The size of the text chunks.
+        - chunk_overlap : int
+            The overlap between text chunks.
+        - output_path : str
+            Path of the JSON results.
+        - plot_path : str
+            Path of the figure.
+        - seed : int
+            The seed of the synthetic courses.
+    """
+    parser = argparse.ArgumentParser(
+        description="Scaling benchmark of the ingestion on synthetic courses."
+    )
+    parser.add_argument(
+        "--scales", type=int, nargs="+", default=SCALES, help="The sizes of the synthetic courses."
+    )
+    parser.add_argument(
+        "--chunk-size",
+        dest="chunk_size",
+        type=int,
+        default=CHUNK_SIZE,
+        help="The size of the text chunks.",
+    )
+    parser.add_argument(
+        "--chunk-overlap",
+        dest="chunk_overlap",
+        type=int,
+        default=CHUNK_OVERLAP,
+        help="The overlap between text chunks.",
+    )
+    parser.add_argument("--output", default=OUTPUT_PATH, help="Path of the JSON results.")
+    parser.add_argument("--plot", default=PLOT_PATH, help="Path of the figure.")
+    parser.add_argument("--seed", type=int, default=0, help="The seed of the synthetic courses.")
+    args = parser.parse_args()
+
+    # Checks
+    scales = sorted(set(args.scales))
+    if len(scales) < 2:
+        logger.error("At least two different scales are needed to measure the growth of the stages.")
+        sys.exit(1)
+    if scales[0] < 1 or scales[-1] > MAX_SCALE:
+        logger.error(f"The scales should be between 1 and {MAX_SCALE}.")
+        sys.exit(1)
+    if args.chunk_overlap >= args.chunk_size:
+        logger.error("The chunk overlap should be less than the chunk size.")
+        sys.exit(1)
+
+    return scales, args.chunk_size, args.chunk_overlap, args.output, args.plot, args.seed
+
+
+def main() -> None:
+    """Run the ingestion at each scale, then report and plot the growth of the stages."""
+    scales, chunk_size, chunk_overlap, output_path, plot_path, seed = get_args()
+
+    results = []
+    for scale in scales:
+        logger.info(f"Ingesting the synthetic course x{scale}...")
+        result = profile_scale(scale, chunk_size, chunk_overlap, seed)
+        total = sum(stage["wall_s"] for stage in result["stages"] if "/" not in stage["stage"])
+        logger.info(
+            f"x{scale}: {result['size_mb']:.1f} MB, {result['nb_chunks']} chunks, "
+            f"{total:.1f} s, max RSS {result['max_rss_mb']:.0f} MB"
+        )
+        results.append(result)
+
+    growth = compute_growth(results)
+    display_summary(growth)
+    for row in growth:
+        if row["superlinear"]:
+            logger.warning(
+                f"The stage '{row['stage']}' is superlinear: time ~ size^{row['time_exponent']}."
+            )
+
+    # Save the results
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "chunk_size": chunk_size,
+                "chunk_overlap": chunk_overlap,
+                "seed": seed,
+                "python": platform.python_version(),
+                "results": results,
+                "growth": growth,
+            },
+            f,
+            indent=2,
+        )
+    plot_results(results, plot_path)
+    logger.success(f"Saved the results to '{output_path}' and the figure to '{plot_path}'.")
+
+
+# MAIN PROGRAM
+if __name__ == "__main__":
+    main()
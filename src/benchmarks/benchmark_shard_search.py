@@ -0,0 +1,281 @@
+"""Benchmark of the search of the chapter shards by worker processes.
+
+The unfiltered search of a database built with chapter shards (`create_database.py --shard-workers`)
+can be run by worker processes (`query_chatbot.py --search-workers`). This script compares,
+on the same queries, the latency of:
+
+- chroma_hnsw : `ChunkVectorStore.search_all`, the HNSW index of Chroma in the main process,
+- numpy_exact : the exact scan of the full embeddings in the main process (one matrix product),
+- shards_[N] : `ShardedVectorStore.search_all`, the exact scan of the shards by N worker processes.
+
+The queries are the embeddings of random chunks of the database with Gaussian noise,
+so that no embedding API is called. The recall of each search is measured against
+the exact scan.
+
+Usage:
+======
+    python src/benchmarks/benchmark_shard_search.py --chroma-path [chroma-path] [--workers workers]
+                                                    [--nb-queries nb-queries] [--k k] [--output output]
+
+Arguments:
+==========
+    --chroma-path : str
+        The path to the directory containing the Chroma database, built with --shard-workers.
+    --workers : list of int (optional)
+        The numbers of search worker processes. Default is 1 2 4.
+    --nb-queries : int (optional)
+        The number of queries. Default is 200.
+    --k : int (optional)
+        The number of chunks returned by each search. Default is 3.
+    --output : str (optional)
+        Path of the JSON file where the results are saved. Default is bench_shard_search.json.
+
+Example:
+========
+    python src/benchmarks/benchmark_shard_search.py --chroma-path chroma_db --workers 2 4
+
+This command will time the searches of the `chroma_db` database in the main process
+and with 2 and 4 search worker processes, and save the results.
+"""
+
+# METADATA
+__authors__ = ("Pierre Poulain", "Essmay Touami")
+__contact__ = "pierre.poulain@u-paris.fr"
+__copyright__ = "BSD-3 clause"
+__date__ = "2024"
+__version__ = "1.0.0"
+
+
+# LIBRARY IMPORTS
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+from typing import Callable
+
+import numpy as np
+from loguru import logger
+
+# MODULE IMPORTS
+# Add the project root directory to the sys.path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if project_root not in sys.path:
+    sys.path.append(project_root)
+from query_chatbot import load_database
+from shards import read_shards_manifest
+from index_versions import resolve_index_path
+from vector_store import normalize_vectors
+from token_ledger import display_summary
+
+
+# CONSTANTS
+WORKERS = [1, 2, 4]
+NB_QUERIES = 200
+K = 3
+NOISE = 0.5
+OUTPUT_PATH = "bench_shard_search.json"
+SEED = 0
+
+
+# FUNCTIONS
+def make_queries(full_vectors: np.ndarray, nb_queries: int, seed: int = SEED) -> np.ndarray:
+    """Make query embeddings from random chunk embeddings with Gaussian noise.
+
+    Parameters
+    ----------
+    full_vectors : np.ndarray
+        The full normalized embeddings of the chunks.
+    nb_queries : int
+        The number of queries.
+    seed : int, optional
+        The seed of the random generator, by default SEED.
+
+    Returns
+    -------
+    np.ndarray
+        The normalized query embeddings, one per row.
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, len(full_vectors), size=nb_queries)
+    dimension = full_vectors.shape[1]
+    noise = rng.normal(scale=NOISE / np.sqrt(dimension), size=(nb_queries, dimension))
+
+    return normalize_vectors(full_vectors[rows] + noise)
+
+
+def search_exact(full_vectors: np.ndarray, query_vector: np.ndarray, k: int) -> np.ndarray:
+    """Get the ids of the k chunks most similar to the query, with one matrix product."""
+    scores = full_vectors @ query_vector
+    best = np.argpartition(-scores, k - 1)[:k]
+
+    return best[np.argsort(-scores[best])]
+
+
+def time_search(
+    search: Callable[[np.ndarray], list[int]], queries: np.ndarray, exact_ids: list[set]
+) -> dict:
+    """Time a search on the queries and measure its recall against the exact scan.
+
+    Parameters
+    ----------
+    search : callable
+        The function returning the ids of the chunks found for a query embedding.
+    queries : np.ndarray
+        The query embeddings.
+    exact_ids : list of set
+        The ids of the chunks found by the exact scan, for each query.
+
+    Returns
+    -------
+    dict
+        The median and 95th percentile latencies (in ms) and the recall of the search.
+    """
+    # Warm-up: worker processes, memory-mapped files and caches
+    for query_vector in queries[:5]:
+        search(query_vector)
+    latencies = []
+    nb_found = 0
+    for query_vector, ids in zip(queries, exact_ids):
+        start = time.perf_counter()
+        found = search(query_vector)
+        latencies.append((time.perf_counter() - start) * 1000)
+        nb_found += len(ids.intersection(found))
+
+    return {
+        "median_ms": round(float(np.median(latencies)), 3),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+        "recall": round(nb_found / max(sum(len(ids) for ids in exact_ids), 1), 3),
+    }
+
+
+def get_args() -> tuple[str, list[int], int, int, str]:
+    """Parse command-line arguments.
+
+    Returns
+    -------
+    chroma_path, workers, nb_queries, k, output_path : Tuple[str, list[int], int, int, str]
+        - chroma_path : str
+            The path to the Chroma database.
+        - workers : list of int
+            The numbers of search worker processes.
+        - nb_queries : int
+            The number of queries.
+        - k : int
+            The number of chunks returned by each search.
+        - output_path : str
+            Path of the JSON results.
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark the search of the chapter shards by worker processes."
+    )
+    parser.add_argument(
+        "--chroma-path",
+        dest="chroma_path",
+        required=True,
+        help="The path to the Chroma database, built with --shard-workers.",
+    )
+    parser.add_argument(
+        "--workers", type=int, nargs="+", default=WORKERS, help="The numbers of search workers."
+    )
+    parser.add_argument(
+        "--nb-queries",
+        dest="nb_queries",
+        type=int,
+        default=NB_QUERIES,
+        help="The number of queries.",
+    )
+    parser.add_argument("--k", type=int, default=K, help="The number of chunks of each search.")
+    parser.add_argument("--output", default=OUTPUT_PATH, help="Path of the JSON results.")
+    args = parser.parse_args()
+
+    # Checks
+    if not os.path.exists(args.chroma_path):
+        logger.error(f"The database '{args.chroma_path}' does not exist.")
+        sys.exit(1)
+    if not read_shards_manifest(resolve_index_path(args.chroma_path)):
+        logger.error("The database has no shards: rebuild it with --shard-workers.")
+        sys.exit(1)
+    if min(args.workers) < 1 or args.nb_queries < 1 or args.k < 1:
+        logger.error("The numbers of workers and queries and k should be positive.")
+        sys.exit(1)
+
+    return args.chroma_path, sorted(set(args.workers)), args.nb_queries, args.k, args.output
+
+
+def main() -> None:
+    """Time the searches of the database in the main process and with search workers."""
+    chroma_path, workers, nb_queries, k, output_path = get_args()
+
+    vector_db, nb_chunks = load_database(chroma_path)
+    # Remove the logging of the benchmarked searches
+    logger.remove()
+    full_vectors = np.asarray(vector_db.full_vectors)
+    queries = make_queries(full_vectors, nb_queries)
+    exact_ids = [
+        set(search_exact(full_vectors, query_vector, k).tolist()) for query_vector in queries
+    ]
+
+    results = [
+        {
+            "search": "chroma_hnsw",
+            **time_search(
+                lambda query_vector: [
+                    document.metadata["id"]
+                    for document, _score in vector_db.search_all(query_vector, k)
+                ],
+                queries,
+                exact_ids,
+            ),
+        },
+        {
+            "search": "numpy_exact",
+            **time_search(
+                lambda query_vector: search_exact(full_vectors, query_vector, k).tolist(),
+                queries,
+                exact_ids,
+            ),
+        },
+    ]
+    for nb_workers in workers:
+        sharded_db = load_database(chroma_path, nb_workers)[0]
+        try:
+            results.append(
+                {
+                    "search": f"shards_{nb_workers}",
+                    **time_search(
+                        lambda query_vector: [
+                            document.metadata["id"]
+                            for document, _score in sharded_db.search_all(query_vector, k)
+                        ],
+                        queries,
+                        exact_ids,
+                    ),
+                }
+            )
+        finally:
+            sharded_db.close()
+    vector_db.close()
+
+    print(f"{nb_chunks} chunks of {full_vectors.shape[1]} dimensions, {nb_queries} queries, k={k}")
+    display_summary(results)
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "nb_chunks": nb_chunks,
+                "dimension": int(full_vectors.shape[1]),
+                "nb_queries": nb_queries,
+                "k": k,
+                "python": platform.python_version(),
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"Saved the results to '{output_path}'.")
+
+
+# MAIN PROGRAM
+if __name__ == "__main__":
+    main()
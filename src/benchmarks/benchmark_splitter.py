@@ -0,0 +1,267 @@
+"""Compare the langchain splitters and the native single-pass splitter.
+
+The Markdown content is split by the two splitters of `create_database.split_text`:
+
+- "langchain": `MarkdownHeaderTextSplitter`, then `RecursiveCharacterTextSplitter`,
+- "native": the single-pass splitter on offsets of `header_splitter.py`.
+
+The chunks of the two splitters (texts and metadata) must be identical: the script fails
+at the first different chunk. The minimum time of each splitter over several runs and its
+peak memory (tracemalloc) are displayed and saved as JSON.
+
+Usage:
+======
+    python src/benchmarks/benchmark_splitter.py [--data-path data-path | --scale scale]
+                                                [--chunk-size chunk-size] [--chunk-overlap chunk-overlap]
+                                                [--repeat repeat] [--output output]
+
+Arguments:
+==========
+    --data-path : str (optional)
+        The directory containing the processed Markdown files of the course.
+    --scale : int (optional)
+        Split a synthetic course of this scale instead (see generate_corpus.py). Default is 1.
+    --chunk-size : int (optional)
+        The size of the text chunks. Default is 1000.
+    --chunk-overlap : int (optional)
+        The overlap between text chunks. Default is 200.
+    --repeat : int (optional)
+        Number of timing repetitions of each splitter. Default is 5.
+    --output : str (optional)
+        Path of the JSON file where the results are saved. Default is bench_splitter.json.
+
+Example:
+========
+    python src/benchmarks/benchmark_splitter.py --data-path data/markdown_processed
+
+This command will split the course with both splitters, check that they give the same chunks
+and display the time and the peak memory of each splitter.
+"""
+
+# METADATA
+__authors__ = ("Pierre Poulain", "Essmay Touami")
+__contact__ = "pierre.poulain@u-paris.fr"
+__copyright__ = "BSD-3 clause"
+__date__ = "2024"
+__version__ = "1.0.0"
+
+
+# LIBRARY IMPORTS
+import os
+import sys
+import json
+import shutil
+import timeit
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from typing import Optional
+
+from loguru import logger
+from langchain_core.documents import Document
+
+# MODULE IMPORTS
+# Add the project root directory to the sys.path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if project_root not in sys.path:
+    sys.path.append(project_root)
+from generate_corpus import generate_corpus
+from parse_clean_markdown import process_md_files
+from create_database import (
+    CHUNK_SIZE,
+    CHUNK_OVERLAP,
+    SPLITTERS,
+    load_documents,
+    concatenate_content,
+    split_text,
+)
+
+
+# CONSTANTS
+OUTPUT_PATH = "bench_splitter.json"
+
+
+# FUNCTIONS
+def load_content(data_path: Optional[str], scale: int) -> str:
+    """Load the concatenated content of the course, or of a synthetic course.
+
+    Parameters
+    ----------
+    data_path : str or None
+        The directory containing the processed Markdown files, None for a synthetic course.
+    scale : int
+        The scale of the synthetic course.
+
+    Returns
+    -------
+    str
+        The concatenated Markdown content, as in the `create_database.py` pipeline.
+    """
+    if data_path is not None:
+        return concatenate_content(load_documents(data_path))
+    work_dir = tempfile.mkdtemp(prefix="bench_splitter_")
+    try:
+        raw_dir = os.path.join(work_dir, "markdown_raw")
+        processed_dir = os.path.join(work_dir, "markdown_processed")
+        generate_corpus(raw_dir, scale)
+        process_md_files(raw_dir, processed_dir)
+        return concatenate_content(load_documents(processed_dir))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def find_difference(reference: list[Document], chunks: list[Document]) -> Optional[str]:
+    """Describe the first difference between two lists of chunks, None if they are identical."""
+    for i, (expected, actual) in enumerate(zip(reference, chunks)):
+        if expected.page_content != actual.page_content or expected.metadata != actual.metadata:
+            return (
+                f"chunk {i}: expected {expected.page_content[:80]!r} {expected.metadata}, "
+                f"got {actual.page_content[:80]!r} {actual.metadata}"
+            )
+    if len(reference) != len(chunks):
+        return f"expected {len(reference)} chunks, got {len(chunks)}"
+
+    return None
+
+
+def measure_peak_memory(content: str, chunk_size: int, chunk_overlap: int, splitter: str) -> float:
+    """Measure the peak memory allocated while splitting the content, in MB."""
+    tracemalloc.start()
+    try:
+        split_text(content, chunk_size, chunk_overlap, splitter)
+        _current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return peak / 1024 / 1024
+
+
+def get_args() -> tuple[Optional[str], int, int, int, int, str]:
+    """Parse command-line arguments.
+
+    Returns
+    -------
+    data_path, scale, chunk_size, chunk_overlap, repeat, output_path : Tuple[str, int, int, int, int, str]
+        - data_path : str or None
+            The directory containing the processed Markdown files (None for a synthetic course).
+        - scale : int
+            The scale of the synthetic course.
+        - chunk_size : int
+            The size of the text chunks.
+        - chunk_overlap : int
+            The overlap between text chunks.
+        - repeat : int
+            Number of timing repetitions.
+        - output_path : str
+            Path of the JSON results.
+    """
+    parser = argparse.ArgumentParser(
+        description="Compare the langchain splitters and the native single-pass splitter."
+    )
+    parser.add_argument(
+        "--data-path",
+        dest="data_path",
+        default=None,
+        help="The directory containing the processed Markdown files of the course.",
+    )
+    parser.add_argument(
+        "--scale", type=int, default=1, help="The scale of the synthetic course split instead."
+    )
+    parser.add_argument(
+        "--chunk-size",
+        dest="chunk_size",
+        type=int,
+        default=CHUNK_SIZE,
+        help="The size of the text chunks.",
+    )
+    parser.add_argument(
+        "--chunk-overlap",
+        dest="chunk_overlap",
+        type=int,
+        default=CHUNK_OVERLAP,
+        help="The overlap between text chunks.",
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timing repetitions.")
+    parser.add_argument("--output", default=OUTPUT_PATH, help="Path of the JSON results.")
+    args = parser.parse_args()
+
+    # Checks
+    if args.data_path is not None and not os.path.exists(args.data_path):
+        logger.error(f"The data directory '{args.data_path}' does not exist.")
+        sys.exit(1)
+    if args.scale <= 0 or args.repeat <= 0:
+        logger.error("The scale and the number of repetitions should be positive integers.")
+        sys.exit(1)
+    if args.chunk_overlap >= args.chunk_size:
+        logger.error("The chunk overlap should be less than the chunk size.")
+        sys.exit(1)
+
+    return (
+        args.data_path,
+        args.scale,
+        args.chunk_size,
+        args.chunk_overlap,
+        args.repeat,
+        args.output,
+    )
+
+
+def main() -> None:
+    """Split the content with both splitters, check the chunks and compare the splitters."""
+    data_path, scale, chunk_size, chunk_overlap, repeat, output_path = get_args()
+
+    content = load_content(data_path, scale)
+    # Remove the logging of the benchmarked functions
+    logger.remove()
+    chunks = {
+        splitter: split_text(content, chunk_size, chunk_overlap, splitter) for splitter in SPLITTERS
+    }
+    results = {}
+    for splitter in SPLITTERS:
+        times = timeit.repeat(
+            lambda: split_text(content, chunk_size, chunk_overlap, splitter), number=1, repeat=repeat
+        )
+        results[splitter] = {
+            "min_s": min(times),
+            "peak_mb": measure_peak_memory(content, chunk_size, chunk_overlap, splitter),
+            "nb_chunks": len(chunks[splitter]),
+        }
+        print(
+            f"{splitter:<10} min {min(times) * 1e3:10.1f} ms   "
+            f"peak {results[splitter]['peak_mb']:8.1f} MB   {len(chunks[splitter])} chunks"
+        )
+    logger.add(sys.stderr)
+
+    # Save the results
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "data_path": data_path,
+                "scale": None if data_path else scale,
+                "nb_chars": len(content),
+                "chunk_size": chunk_size,
+                "chunk_overlap": chunk_overlap,
+                "python": platform.python_version(),
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    logger.success(f"Saved the results to '{output_path}'.")
+
+    # The native splitter must give the chunks of the langchain splitters
+    difference = find_difference(chunks["langchain"], chunks["native"])
+    if difference is not None:
+        logger.error(f"The splitters give different chunks: {difference}")
+        sys.exit(1)
+    logger.success(
+        f"Same {len(chunks['native'])} chunks, "
+        f"{results['langchain']['min_s'] / results['native']['min_s']:.1f}x faster and "
+        f"{results['langchain']['peak_mb'] / results['native']['peak_mb']:.1f}x lower peak memory."
+    )
+
+
+# MAIN PROGRAM
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""Benchmark the truncated-dimension search with full-dimension rescoring.
+
+This script loads the full embeddings saved next to a vector database and embeds
+the questions of `banque_questions_python.yaml`. For each truncated dimension,
+it searches the top candidates with the truncated embeddings, rescores them with
+the full embeddings, and compares the results to the exact full-dimension search.
+It reports the recall@k, the memory used by the first-pass vectors and the search latency.
+
+Usage:
+======
+    python src/benchmarks/benchmark_truncated_embeddings.py --chroma-path [chroma-path]
+                                                            [--dims dims] [--k k]
+                                                            [--rescore-factor rescore-factor]
+
+Arguments:
+==========
+    --chroma-path : str
+        The path to the directory containing the Chroma database.
+    --dims : list of int (optional)
+        The truncated dimensions to compare. Default is 128 256 512 1024.
+    --k : int (optional)
+        The number of retrieved chunks. Default is 3.
+    --rescore-factor : int (optional)
+        Number of first-pass candidates per retrieved chunk. Default is 4.
+    --questions : str (optional)
+        The YAML file of questions. Default is data/banque_questions_python.yaml.
+
+Example:
+========
+    python src/benchmarks/benchmark_truncated_embeddings.py --chroma-path chroma_db --dims 256 512
+
+This command will compare the search with embeddings truncated to 256 and 512 dimensions
+to the search with the full embeddings of the `chroma_db` database.
+"""
+
+# METADATA
+__authors__ = ("Pierre Poulain", "Essmay Touami")
+__contact__ = "pierre.poulain@u-paris.fr"
+__copyright__ = "BSD-3 clause"
+__date__ = "2024"
+__version__ = "1.0.0"
+
+
+# LIBRARY IMPORTS
+import os
+import sys
+import time
+import argparse
+
+import yaml
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+# MODULE IMPORTS
+# Add the project root directory to the sys.path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if project_root not in sys.path:
+    sys.path.append(project_root)
+from index_config import read_index_config
+from providers import LOCAL_EMBEDDING_DIM, get_embedding_function
+from vector_store import RESCORE_FACTOR, load_embeddings, normalize_vectors, truncate_vectors
+
+
+# CONSTANTS
+DIMENSIONS = [128, 256, 512, 1024]
+QUESTIONS_PATH = "data/banque_questions_python.yaml"
+
+
+# FUNCTIONS
+def get_args() -> tuple[str, list[int], int, int, str]:
+    """Parse command-line arguments.
+
+    Returns
+    -------
+    chroma_path, dims, k, rescore_factor, questions_path : Tuple[str, list[int], int, int, str]
+        - chroma_path : str
+            The path to the directory containing the Chroma database.
+        - dims : list of int
+            The truncated dimensions to compare.
+        - k : int
+            The number of retrieved chunks.
+        - rescore_factor : int
+            Number of first-pass candidates per retrieved chunk.
+        - questions_path : str
+            The YAML file of questions.
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark the truncated-dimension search with full-dimension rescoring."
+    )
+    parser.add_argument(
+        "--chroma-path",
+        dest="chroma_path",
+        required=True,
+        help="The path to the directory containing the Chroma database.",
+    )
+    parser.add_argument(
+        "--dims", type=int, nargs="+", default=DIMENSIONS, help="The truncated dimensions to compare."
+    )
+    parser.add_argument("--k", type=int, default=3, help="The number of retrieved chunks.")
+    parser.add_argument(
+        "--rescore-factor",
+        dest="rescore_factor",
+        type=int,
+        default=RESCORE_FACTOR,
+        help="Number of first-pass candidates per retrieved chunk.",
+    )
+    parser.add_argument(
+        "--questions",
+        dest="questions_path",
+        default=QUESTIONS_PATH,
+        help="The YAML file of questions.",
+    )
+    args = parser.parse_args()
+
+    # Checks
+    if not os.path.exists(args.chroma_path):
+        logger.error(f"The directory '{args.chroma_path}' does not exist.")
+        sys.exit(1)
+
+    return args.chroma_path, args.dims, args.k, args.rescore_factor, args.questions_path
+
+
+def load_questions(questions_path: str) -> list[str]:
+    """Load the questions of the YAML file.
+
+    Parameters
+    ----------
+    questions_path : str
+        The YAML file of questions, grouped by chapter.
+
+    Returns
+    -------
+    list of str
+        The questions.
+    """
+    with open(questions_path, "r", encoding="utf-8") as f:
+        data = yaml.safe_load(f)
+
+    return [
+        text
+        for chapter_questions in data["questions"].values()
+        for question in chapter_questions
+        for text in question.values()
+    ]
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Get the indices of the k highest scores, by decreasing score (partition, then sort)."""
+    k = min(k, len(scores))
+    top = np.argpartition(-scores, k - 1)[:k]
+
+    return top[np.argsort(-scores[top])]
+
+
+def search_full(vectors: np.ndarray, queries: np.ndarray, k: int) -> tuple[np.ndarray, float]:
+    """Exact search with the full embeddings.
+
+    Returns
+    -------
+    tuple
+        The ids of the top k chunks of each query and the mean latency per query, in seconds.
+    """
+    start = time.perf_counter()
+    top = [top_k(vectors @ query, k) for query in queries]
+
+    return np.array(top), (time.perf_counter() - start) / len(queries)
+
+
+def search_truncated(
+    vectors: np.ndarray,
+    truncated: np.ndarray,
+    queries: np.ndarray,
+    truncate_dim: int,
+    k: int,
+    rescore_factor: int,
+) -> tuple[np.ndarray, float]:
+    """Search with the truncated embeddings and rescore the candidates with the full embeddings.
+
+    Returns
+    -------
+    tuple
+        The ids of the top k chunks of each query and the mean latency per query, in seconds.
+    """
+    nb_candidates = min(rescore_factor * k, len(truncated))
+    start = time.perf_counter()
+    top = []
+    for query in queries:
+        scores = truncated @ truncate_vectors(query, truncate_dim)
+        candidates = np.argpartition(-scores, nb_candidates - 1)[:nb_candidates]
+        rescored = vectors[candidates] @ query
+        top.append(candidates[top_k(rescored, k)])
+
+    return np.array(top), (time.perf_counter() - start) / len(queries)
+
+
+def main() -> None:
+    """Compare the truncated-dimension searches to the full-dimension search."""
+    chroma_path, dims, k, rescore_factor, questions_path = get_args()
+
+    # Load the full embeddings in memory and embed the questions
+    vectors = np.array(load_embeddings(chroma_path))
+    nb_chunks, full_dim = vectors.shape
+    index_config = read_index_config(chroma_path)
+    embedding_function = get_embedding_function(
+        index_config.get("provider", "openai"),
+        index_config.get("embedding_model", "text-embedding-3-large"),
+        index_config.get("embedding_dimension") or LOCAL_EMBEDDING_DIM,
+    )
+    questions = load_questions(questions_path)
+    queries = normalize_vectors(embedding_function.embed_documents(questions))
+    logger.info(f"{nb_chunks} chunks of {full_dim} dimensions, {len(questions)} questions.")
+
+    # Reference: exact search with the full embeddings
+    reference, full_latency = search_full(vectors, queries, k)
+    rows = [
+        {
+            "dim": full_dim,
+            f"recall@{k}": 1.0,
+            "first_pass_mb": round(vectors.nbytes / 1e6, 2),
+            "memory_saving": "1.0x",
+            "latency_ms": round(full_latency * 1e3, 3),
+        }
+    ]
+
+    for truncate_dim in dims:
+        if truncate_dim >= full_dim:
+            continue
+        truncated = truncate_vectors(vectors, truncate_dim)
+        top, latency = search_truncated(
+            vectors, truncated, queries, truncate_dim, k, rescore_factor
+        )
+        recall = np.mean(
+            [len(set(found) & set(expected)) / k for found, expected in zip(top, reference)]
+        )
+        rows.append(
+            {
+                "dim": truncate_dim,
+                f"recall@{k}": round(float(recall), 3),
+                "first_pass_mb": round(truncated.nbytes / 1e6, 2),
+                "memory_saving": f"{vectors.nbytes / truncated.nbytes:.1f}x",
+                "latency_ms": round(latency * 1e3, 3),
+            }
+        )
+
+    print(pd.DataFrame(rows).to_string(index=False))
+
+
+# MAIN PROGRAM
+if __name__ == "__main__":
+    main()
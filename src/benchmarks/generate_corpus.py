@@ -0,0 +1,260 @@
+"""Generate synthetic Python courses to benchmark the ingestion at scale.
+
+The synthetic course has the layout of the raw Markdown files of the course,
+as expected by `parse_clean_markdown.py`:
+
+- chapter files `[NN]_[title].md` and annex files `annexe_[letter]_[title].md`,
+- unnumbered headers of levels 1 to 4 (chapter, section, subsection, subsubsection),
+- French paragraphs with accents, inline code and bullet lists,
+- Python code blocks whose comments have spaces after the '#'.
+
+At scale 1, the course has the structure of the real course (25 chapters of 6 sections and 4 annexes).
+The number of sections grows linearly with the scale. The chapters are numbered with two digits
+and the annexes with one letter (the file names are matched on them), so beyond 99 chapters
+the chapters get longer instead of more numerous. The content is drawn from a seeded
+random generator: a scale and a seed always give the same course.
+
+Usage:
+======
+    python src/benchmarks/generate_corpus.py --out [out-dir] [--scale scale] [--seed seed]
+
+Arguments:
+==========
+    --out : str
+        The directory where the Markdown files of the synthetic course are written.
+    --scale : int (optional)
+        The size of the course, relative to the real course (1 to 1000). Default is 1.
+    --seed : int (optional)
+        The seed of the random generator. Default is 0.
+
+Example:
+========
+    python src/benchmarks/generate_corpus.py --out data/synthetic_x10 --scale 10
+    python src/parse_clean_markdown.py --in data/synthetic_x10 --out data/synthetic_x10_processed
+
+These commands will write a synthetic course 10 times larger than the real course
+to the `data/synthetic_x10` directory, and process it as the real course.
+"""
+
+# METADATA
+__authors__ = ("Pierre Poulain", "Essmay Touami")
+__contact__ = "pierre.poulain@u-paris.fr"
+__copyright__ = "BSD-3 clause"
+__date__ = "2024"
+__version__ = "1.0.0"
+
+
+# LIBRARY IMPORTS
+import os
+import sys
+import math
+import random
+import argparse
+from typing import TextIO
+
+from loguru import logger
+
+
+# CONSTANTS
+BASE_CHAPTERS = 25
+BASE_SECTIONS = 6
+MAX_CHAPTERS = 99
+MAX_SCALE = 1000
+ANNEX_LETTERS = "ABCD"
+WORDS = (
+    "liste", "élément", "boucle", "itération", "chaîne", "caractères", "données", "fonction",
+    "paramètre", "méthode", "dictionnaire", "clé", "valeur", "variable", "indice", "résultat",
+    "opérateur", "module", "fichier", "expression", "régulière", "entrée", "sortie", "objet",
+    "classe", "attribut", "instance", "tuple", "ensemble", "séquence", "programme", "interpréteur",
+    "erreur", "exception", "condition", "test", "comparaison", "affichage", "écriture", "lecture",
+    "répertoire", "bibliothèque", "numérique", "entier", "réel", "booléen", "tranche", "copie",
+    "référence", "mémoire", "portée", "générateur", "compréhension", "décorateur", "syntaxe",
+    "le", "la", "les", "un", "une", "des", "du", "de", "à", "où", "et", "ou", "avec", "pour",
+    "dans", "sur", "par", "est", "sont", "être", "peut", "très", "déjà", "aussi", "même",
+    "façon", "première", "dernière", "chaque", "différents", "créé", "modifié", "utilisé", "renvoyé",
+)
+TITLE_WORDS = (
+    "Listes", "Boucles", "Chaînes", "Dictionnaires", "Fonctions", "Fichiers", "Modules",
+    "Classes", "Objets", "Tuples", "Ensembles", "Tests", "Expressions", "Générateurs",
+    "Exceptions", "Variables", "Affichage", "Comparaisons", "Itérations", "Méthodes",
+)
+INLINE_CODE = ("`len()`", "`range()`", "`.append()`", "`print()`", "`dict.get()`", "`for`", "`if`")
+CODE_LINES = (
+    "animaux = ['girafe', 'tigre', 'singe', 'souris']",
+    "for animal in animaux:",
+    "    print(animal)",
+    "nombres = [x ** 2 for x in range(10) if x % 2 == 0]",
+    "taille = {'girafe': 5.0, 'éléphant': 3.2}",
+    "with open('données.txt', 'r') as fichier:",
+    "    lignes = fichier.readlines()",
+    "def calcule_moyenne(valeurs):",
+    "    return sum(valeurs) / len(valeurs)",
+    "chaîne = 'Élément numéro {}'.format(3)",
+    "if len(animaux) > 2:",
+    "    animaux.append('hérisson')",
+)
+
+
+# FUNCTIONS
+def make_title(rng: random.Random) -> str:
+    """Draw a title: a capitalized word followed by a few words."""
+    words = [rng.choice(TITLE_WORDS)]
+    words += rng.sample(WORDS, rng.randint(1, 4))
+
+    return " ".join(words)
+
+
+def make_sentence(rng: random.Random) -> str:
+    """Draw a sentence of 8 to 20 words, sometimes with inline code."""
+    words = [rng.choice(WORDS) for _ in range(rng.randint(8, 20))]
+    if rng.random() < 0.3:
+        words.insert(rng.randrange(len(words)), rng.choice(INLINE_CODE))
+    words[0] = words[0].capitalize()
+
+    return " ".join(words) + rng.choice(".....?!")
+
+
+def make_paragraph(rng: random.Random) -> str:
+    """Draw a paragraph of 2 to 6 sentences, or a bullet list."""
+    if rng.random() < 0.15:
+        return "\n".join(f"- {make_sentence(rng)}" for _ in range(rng.randint(2, 5)))
+
+    return " ".join(make_sentence(rng) for _ in range(rng.randint(2, 6)))
+
+
+def make_code_block(rng: random.Random) -> str:
+    """Draw a Python code block of 3 to 10 lines, with comments."""
+    lines = ["```python"]
+    for _ in range(rng.randint(3, 10)):
+        if rng.random() < 0.25:
+            lines.append(f"#{' ' * rng.randint(1, 3)}{make_sentence(rng)}")
+        else:
+            lines.append(rng.choice(CODE_LINES))
+    lines.append("```")
+
+    return "\n".join(lines)
+
+
+def write_section_content(f: TextIO, rng: random.Random) -> None:
+    """Write the paragraphs and code blocks of a header."""
+    for _ in range(rng.randint(2, 5)):
+        f.write(make_paragraph(rng) + "\n\n")
+        if rng.random() < 0.4:
+            f.write(make_code_block(rng) + "\n\n")
+
+
+def write_chapter(path: str, nb_sections: int, rng: random.Random) -> None:
+    """Write a chapter (or annex) file with its sections, subsections and subsubsections.
+
+    Parameters
+    ----------
+    path : str
+        The path of the Markdown file.
+    nb_sections : int
+        The number of sections of the chapter.
+    rng : random.Random
+        The random generator.
+    """
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"# {make_title(rng)}\n\n")
+        write_section_content(f, rng)
+        for _ in range(nb_sections):
+            f.write(f"## {make_title(rng)}\n\n")
+            write_section_content(f, rng)
+            for _ in range(rng.randint(0, 3)):
+                f.write(f"### {make_title(rng)}\n\n")
+                write_section_content(f, rng)
+                for _ in range(rng.choice((0, 0, 0, 1, 2))):
+                    f.write(f"#### {make_title(rng)}\n\n")
+                    write_section_content(f, rng)
+
+
+def get_file_slug(title: str) -> str:
+    """Get the file name part of a title: its first word, lowercased."""
+    return title.split()[0].lower()
+
+
+def generate_corpus(out_dir: str, scale: int = 1, seed: int = 0) -> dict:
+    """Write a synthetic course.
+
+    Parameters
+    ----------
+    out_dir : str
+        The directory where the Markdown files are written.
+    scale : int, optional
+        The size of the course, relative to the real course, by default 1.
+    seed : int, optional
+        The seed of the random generator, by default 0.
+
+    Returns
+    -------
+    dict
+        The numbers of chapters, annexes and sections, and the size of the course in MB.
+    """
+    rng = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    nb_chapters = min(BASE_CHAPTERS * scale, MAX_CHAPTERS)
+    nb_sections = math.ceil(BASE_CHAPTERS * BASE_SECTIONS * scale / nb_chapters)
+    nb_annex_sections = nb_sections // 2 + 1
+
+    paths = []
+    for number in range(1, nb_chapters + 1):
+        path = os.path.join(out_dir, f"{number:02d}_{get_file_slug(rng.choice(TITLE_WORDS))}.md")
+        write_chapter(path, nb_sections, rng)
+        paths.append(path)
+    for letter in ANNEX_LETTERS:
+        path = os.path.join(out_dir, f"annexe_{letter}_{get_file_slug(rng.choice(TITLE_WORDS))}.md")
+        write_chapter(path, nb_annex_sections, rng)
+        paths.append(path)
+    size_mb = sum(os.path.getsize(path) for path in paths) / 1024 / 1024
+    logger.success(
+        f"Generated {nb_chapters} chapters of {nb_sections} sections and {len(ANNEX_LETTERS)} annexes "
+        f"({size_mb:.1f} MB) in '{out_dir}'."
+    )
+
+    return {
+        "nb_chapters": nb_chapters,
+        "nb_annexes": len(ANNEX_LETTERS),
+        "nb_sections": nb_chapters * nb_sections + len(ANNEX_LETTERS) * nb_annex_sections,
+        "size_mb": size_mb,
+    }
+
+
+def get_args() -> tuple[str, int, int]:
+    """Parse command-line arguments.
+
+    Returns
+    -------
+    out_dir, scale, seed : Tuple[str, int, int]
+        - out_dir : str
+            The directory where the Markdown files are written.
+        - scale : int
+            The size of the course, relative to the real course.
+        - seed : int
+            The seed of the random generator.
+    """
+    parser = argparse.ArgumentParser(description="Generate a synthetic Python course.")
+    parser.add_argument(
+        "--out", dest="out_dir", required=True, help="The directory of the Markdown files."
+    )
+    parser.add_argument(
+        "--scale", type=int, default=1, help="The size of the course, relative to the real course."
+    )
+    parser.add_argument("--seed", type=int, default=0, help="The seed of the random generator.")
+    args = parser.parse_args()
+
+    # Checks
+    if not 1 <= args.scale <= MAX_SCALE:
+        logger.error(f"The scale should be between 1 and {MAX_SCALE}.")
+        sys.exit(1)
+    if os.path.exists(args.out_dir) and os.listdir(args.out_dir):
+        logger.error(f"The directory '{args.out_dir}' is not empty.")
+        sys.exit(1)
+
+    return args.out_dir, args.scale, args.seed
+
+
+# MAIN PROGRAM
+if __name__ == "__main__":
+    out_dir, scale, seed = get_args()
+    generate_corpus(out_dir, scale, seed)
@@ -0,0 +1,147 @@
+"""Chapter and section centroid embeddings of a vector database.
+
+The centroid of a chapter (or of a section) is the normalized mean of the full embeddings
+of its chunks. The centroids are computed when the database is created, from the embeddings
+of the chunks (without any call to the embedding API), and saved next to it:
+
+    centroids.npz: chapter_names, chapter_vectors, section_names, section_vectors
+
+They enable a two-stage search: the query is first compared to the centroids to select
+the most relevant chapters (or sections), then only the chunks of these chapters are searched.
+"""
+
+# METADATA
+__authors__ = ("Pierre Poulain", "Essmay Touami")
+__contact__ = "pierre.poulain@u-paris.fr"
+__copyright__ = "BSD-3 clause"
+__date__ = "2024"
+__version__ = "1.0.0"
+
+
+# LIBRARY IMPORTS
+import os
+
+import numpy as np
+from loguru import logger
+
+
+# CONSTANTS
+CENTROIDS_FILE = "centroids.npz"
+# Metadata field of the chunks grouped at each level
+CENTROID_LEVELS = {"chapter": "file_name", "section": "section_name"}
+
+
+# FUNCTIONS
+def build_centroids(
+    full_vectors: np.ndarray, groups: dict[str, list[int]]
+) -> tuple[np.ndarray, np.ndarray]:
+    """Compute the normalized mean embedding of each group of chunks.
+
+    Parameters
+    ----------
+    full_vectors : np.ndarray
+        The full normalized embeddings, one row per chunk id.
+    groups : dict
+        The ids of the chunks of each group, by group name.
+
+    Returns
+    -------
+    names, vectors : tuple of np.ndarray
+        The names of the groups and their centroids (one row per group).
+    """
+    names = sorted(groups)
+    vectors = np.zeros((len(names), full_vectors.shape[1]), dtype=np.float32)
+    for i, name in enumerate(names):
+        vectors[i] = full_vectors[np.sort(groups[name])].mean(axis=0)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    return np.array(names), vectors / np.where(norms == 0, 1, norms)
+
+
+def save_centroids(
+    full_vectors: np.ndarray, metadata_index: dict[str, dict[str, list[int]]], vector_db_path: str
+) -> None:
+    """Compute and save the chapter and section centroids next to the vector database.
+
+    Parameters
+    ----------
+    full_vectors : np.ndarray
+        The full normalized embeddings, one row per chunk id.
+    metadata_index : dict
+        The metadata index of the database.
+    vector_db_path : str
+        The directory of the vector database.
+    """
+    arrays = {}
+    for level, field in CENTROID_LEVELS.items():
+        names, vectors = build_centroids(full_vectors, metadata_index[field])
+        arrays[f"{level}_names"] = names
+        arrays[f"{level}_vectors"] = vectors
+    centroids_path = os.path.join(vector_db_path, CENTROIDS_FILE)
+    np.savez(centroids_path, **arrays)
+
+    logger.info(
+        f"Saved the centroids of {len(arrays['chapter_names'])} chapters "
+        f"and {len(arrays['section_names'])} sections to '{centroids_path}'."
+    )
+
+
+def load_centroids(vector_db_path: str) -> dict[str, np.ndarray]:
+    """Load the centroids saved next to the vector database.
+
+    Parameters
+    ----------
+    vector_db_path : str
+        The directory of the vector database.
+
+    Returns
+    -------
+    dict
+        The names and centroids of each level, empty if the database has no centroids.
+    """
+    centroids_path = os.path.join(vector_db_path, CENTROIDS_FILE)
+    if not os.path.exists(centroids_path):
+        return {}
+
+    return dict(np.load(centroids_path))
+
+
+def get_top_group_rows(
+    centroids: dict[str, np.ndarray],
+    metadata_index: dict[str, dict[str, list[int]]],
+    query_vector: np.ndarray,
+    nb_groups: int,
+    level: str = "chapter",
+) -> np.ndarray:
+    """Get the ids of the chunks of the groups whose centroids are the most similar to the query.
+
+    Parameters
+    ----------
+    centroids : dict
+        The names and centroids of each level.
+    metadata_index : dict
+        The metadata index of the database.
+    query_vector : np.ndarray
+        The full normalized query embedding.
+    nb_groups : int
+        The number of chapters (or sections) to keep.
+    level : str, optional
+        "chapter" or "section", by default "chapter".
+
+    Returns
+    -------
+    np.ndarray
+        The sorted ids of the chunks of the selected groups.
+    """
+    if not centroids:
+        raise ValueError("The database has no centroids: rebuild it with create_database.py.")
+
+    names = centroids[f"{level}_names"]
+    scores = centroids[f"{level}_vectors"] @ query_vector
+    top_groups = names[np.argsort(-scores)[:nb_groups]]
+    groups = metadata_index[CENTROID_LEVELS[level]]
+
+    return np.array(
+        sorted(chunk_id for name in top_groups for chunk_id in groups[str(name)]),
+        dtype=np.int64,
+    )
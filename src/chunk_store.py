@@ -0,0 +1,293 @@
+"""Compact columnar store of the text chunks.
+
+The chunks of a vector database are saved next to it in a columnar layout:
+
+- chunk_store.npz: the ids, numbers of tokens and characters and the offsets of the texts
+  as arrays, and for each header field (file name, chapter, section, URL, ...)
+  a table of its distinct strings and the index of the string of each chunk (-1 if missing),
+- chunk_texts.bin: the texts of all the chunks in one contiguous UTF-8 blob,
+  each text being optionally compressed with zlib.
+
+The blob is memory-mapped and the strings are stored once, instead of one `Document`
+with its own metadata dictionary per chunk. The chunks are accessed through lightweight
+`ChunkView` objects, which behave as read-only metadata dictionaries.
+"""
+
+# METADATA
+__authors__ = ("Pierre Poulain", "Essmay Touami")
+__contact__ = "pierre.poulain@u-paris.fr"
+__copyright__ = "BSD-3 clause"
+__date__ = "2024"
+__version__ = "1.0.0"
+
+
+# LIBRARY IMPORTS
+import os
+import zlib
+from collections.abc import Mapping
+from typing import Any, Iterator, Optional
+
+import numpy as np
+from loguru import logger
+from langchain_core.documents import Document
+
+
+# CONSTANTS
+CHUNK_STORE_FILE = "chunk_store.npz"
+CHUNK_TEXTS_FILE = "chunk_texts.bin"
+STRING_FIELDS = (
+    "file_name",
+    "chapter_name",
+    "section_name",
+    "subsection_name",
+    "subsubsection_name",
+    "url",
+)
+NUMERIC_FIELDS = ("id", "nb_tokens")
+
+
+# CLASSES
+class ChunkView(Mapping):
+    """Read-only view of a chunk of a `ChunkStore`.
+
+    The view behaves as the metadata dictionary of the chunk (`view["chapter_name"]`,
+    `view.get("section_name", "")`, `"url" in view`), without copying any value,
+    and gives the text of the chunk with `page_content`. As `view.metadata` is the view
+    itself, it can be used in place of a `Document` by the code reading the chunks.
+    """
+
+    __slots__ = ("_store", "_row")
+
+    def __init__(self, store: "ChunkStore", row: int) -> None:
+        self._store = store
+        self._row = row
+
+    @property
+    def page_content(self) -> str:
+        """The text of the chunk."""
+        return self._store.get_text(self._row)
+
+    @property
+    def metadata(self) -> "ChunkView":
+        """The metadata of the chunk: the view itself."""
+        return self
+
+    def __getitem__(self, key: str) -> Any:
+        value = self._store.get_value(key, self._row)
+        if value is None:
+            raise KeyError(key)
+
+        return value
+
+    def __iter__(self) -> Iterator[str]:
+        return (key for key in (*NUMERIC_FIELDS, *STRING_FIELDS) if key in self)
+
+    def __len__(self) -> int:
+        return sum(1 for _key in self)
+
+    def __contains__(self, key: object) -> bool:
+        return self._store.get_value(key, self._row) is not None
+
+    def __repr__(self) -> str:
+        return f"ChunkView({dict(self)})"
+
+    def to_document(self) -> Document:
+        """Materialize the chunk as a LangChain document."""
+        return Document(page_content=self.page_content, metadata=dict(self))
+
+
+class ChunkStore:
+    """Columnar store of the text chunks, ordered by chunk id."""
+
+    def __init__(
+        self,
+        arrays: dict[str, np.ndarray],
+        tables: dict[str, list[str]],
+        blob: np.ndarray,
+        compressed: bool = False,
+    ) -> None:
+        self.arrays = arrays
+        self.tables = tables
+        self.blob = blob
+        self.compressed = compressed
+
+    @classmethod
+    def from_documents(cls, chunks: list[Document], compressed: bool = False) -> "ChunkStore":
+        """Build the store from the chunks of the database.
+
+        Parameters
+        ----------
+        chunks : list of Document
+            List of text chunks, ordered by id, with their metadata.
+        compressed : bool, optional
+            Compress the text of each chunk with zlib, by default False.
+
+        Returns
+        -------
+        ChunkStore
+            The store of the chunks.
+        """
+        interned = {field: {} for field in STRING_FIELDS}
+        arrays = {
+            "id": np.array([chunk.metadata["id"] for chunk in chunks], dtype=np.int64),
+            "nb_tokens": np.array(
+                [chunk.metadata.get("nb_tokens", 0) for chunk in chunks], dtype=np.int32
+            ),
+            "nb_chars": np.array([len(chunk.page_content) for chunk in chunks], dtype=np.int32),
+        }
+        for field in STRING_FIELDS:
+            arrays[f"{field}_index"] = np.array(
+                [
+                    interned[field].setdefault(chunk.metadata[field], len(interned[field]))
+                    if chunk.metadata.get(field)
+                    else -1
+                    for chunk in chunks
+                ],
+                dtype=np.int32,
+            )
+        texts = [chunk.page_content.encode("utf-8") for chunk in chunks]
+        if compressed:
+            texts = [zlib.compress(text) for text in texts]
+        arrays["offsets"] = np.zeros(len(texts) + 1, dtype=np.int64)
+        arrays["offsets"][1:] = np.cumsum([len(text) for text in texts])
+        blob = np.frombuffer(b"".join(texts), dtype=np.uint8)
+        tables = {field: list(values) for field, values in interned.items()}
+
+        return cls(arrays, tables, blob, compressed)
+
+    def save(self, vector_db_path: str) -> None:
+        """Save the store next to the vector database.
+
+        Parameters
+        ----------
+        vector_db_path : str
+            The directory of the vector database.
+        """
+        tables = {
+            f"{field}_table": np.array(values, dtype=str) for field, values in self.tables.items()
+        }
+        np.savez(
+            os.path.join(vector_db_path, CHUNK_STORE_FILE),
+            compressed=np.array(self.compressed),
+            **self.arrays,
+            **tables,
+        )
+        self.blob.tofile(os.path.join(vector_db_path, CHUNK_TEXTS_FILE))
+
+        logger.info(
+            f"Saved the store of {len(self)} chunks ({self.blob.nbytes / 1e6:.2f} MB of texts) "
+            f"to '{vector_db_path}'."
+        )
+
+    @classmethod
+    def load(cls, vector_db_path: str) -> Optional["ChunkStore"]:
+        """Load the store saved next to the vector database, with the texts memory-mapped.
+
+        Parameters
+        ----------
+        vector_db_path : str
+            The directory of the vector database.
+
+        Returns
+        -------
+        ChunkStore or None
+            The store of the chunks, None if the database has no chunk store.
+        """
+        store_path = os.path.join(vector_db_path, CHUNK_STORE_FILE)
+        if not os.path.exists(store_path):
+            return None
+        data = dict(np.load(store_path))
+        compressed = bool(data.pop("compressed"))
+        tables = {field: data.pop(f"{field}_table").tolist() for field in STRING_FIELDS}
+        texts_path = os.path.join(vector_db_path, CHUNK_TEXTS_FILE)
+        if os.path.getsize(texts_path):
+            blob = np.memmap(texts_path, dtype=np.uint8, mode="r")
+        else:
+            blob = np.zeros(0, dtype=np.uint8)
+
+        return cls(data, tables, blob, compressed)
+
+    def __len__(self) -> int:
+        return len(self.arrays["id"])
+
+    def __getitem__(self, chunk_id: int) -> ChunkView:
+        """Get the view of a chunk by id (ids are the rows of the store)."""
+        if not 0 <= chunk_id < len(self):
+            raise IndexError(f"No chunk with id {chunk_id}.")
+
+        return ChunkView(self, int(chunk_id))
+
+    def __iter__(self) -> Iterator[ChunkView]:
+        return (ChunkView(self, row) for row in range(len(self)))
+
+    def get_text(self, row: int) -> str:
+        """Get the text of the chunk of a row."""
+        start, end = self.arrays["offsets"][row], self.arrays["offsets"][row + 1]
+        text = self.blob[start:end].tobytes()
+        if self.compressed:
+            text = zlib.decompress(text)
+
+        return text.decode("utf-8")
+
+    def get_value(self, field: object, row: int) -> Any:
+        """Get the value of a metadata field of the chunk of a row, None if it is missing."""
+        if field in NUMERIC_FIELDS:
+            return int(self.arrays[field][row])
+        if field in STRING_FIELDS:
+            index = self.arrays[f"{field}_index"][row]
+            return self.tables[field][index] if index >= 0 else None
+
+        return None
+
+    def iter_batches(self, batch_size: int) -> Iterator[list[ChunkView]]:
+        """Iterate over the views of the chunks, by batches of `batch_size` chunks."""
+        for start in range(0, len(self), batch_size):
+            yield [ChunkView(self, row) for row in range(start, min(start + batch_size, len(self)))]
+
+    def group_rows(self, field: str) -> dict[str, list[int]]:
+        """Get the rows of the chunks of each value of a string field.
+
+        Parameters
+        ----------
+        field : str
+            A string field of the metadata, for example "file_name".
+
+        Returns
+        -------
+        dict
+            The sorted rows of the chunks, by value.
+        """
+        indexes = self.arrays[f"{field}_index"]
+        order = np.argsort(indexes, kind="stable")
+        bounds = np.searchsorted(indexes[order], np.arange(len(self.tables[field]) + 1))
+
+        return {
+            value: order[bounds[i] : bounds[i + 1]].tolist()
+            for i, value in enumerate(self.tables[field])
+        }
+
+
+# FUNCTIONS
+def save_chunk_store(
+    chunks: list[Document], vector_db_path: str, compressed: bool = False
+) -> ChunkStore:
+    """Build and save the store of the chunks next to the vector database.
+
+    Parameters
+    ----------
+    chunks : list of Document
+        List of text chunks, ordered by id, with their metadata.
+    vector_db_path : str
+        The directory of the vector database.
+    compressed : bool, optional
+        Compress the text of each chunk with zlib, by default False.
+
+    Returns
+    -------
+    ChunkStore
+        The saved store.
+    """
+    chunk_store = ChunkStore.from_documents(chunks, compressed)
+    chunk_store.save(vector_db_path)
+
+    return chunk_store
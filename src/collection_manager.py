@@ -0,0 +1,356 @@
+"""Several course databases served by one process, within a memory budget.
+
+The `CollectionManager` maps a course key to the path of its vector database.
+The databases are loaded on demand, the first time a course is queried.
+The memory of a database is estimated by the size of the files that its searches map
+or load: the embeddings (memory-mapped), the HNSW index of Chroma (loaded on the first query)
+or the quantized codes, the chunk store arrays, the metadata index and the centroids.
+The texts (Chroma SQLite and chunk texts) are only read for the chunks returned and
+the shards are only mapped by search workers, so they are not counted.
+When the databases loaded exceed the memory budget, the least recently used ones
+are evicted (and loaded again if their course is queried later):
+
+    manager = CollectionManager({"python": "chroma_db", "unix": "chroma_db_unix"}, 2048)
+    with manager.acquire("python") as vector_db:
+        relevant_chunks = search_similarity_in_database(vector_db, query)
+
+The hits, misses, load times and evictions of each course are given by `get_metrics`.
+
+Usage:
+======
+    python src/collection_manager.py --courses [courses-path] [--memory-budget memory-budget] [--deadline deadline] [--model model]
+
+Arguments:
+==========
+    --courses : str
+        The JSON file mapping each course key to the path of its database,
+        for example {"python": "chroma_db", "unix": "chroma_db_unix"}.
+    --memory-budget : float (optional)
+        The memory budget of the loaded databases, in MB. Default is 1024.
+    --deadline : float (optional)
+        The time budget of each request, in seconds. Default is 10.
+    --model : str (optional)
+        The chat model answering each query. Default is to only search the relevant chunks.
+
+Example:
+========
+    python src/collection_manager.py --courses courses.json --memory-budget 2048
+
+This command will read lines "course<TAB>query" from the standard input, search the database
+of the course for each query and display the ids of the relevant chunks,
+then the metrics of each course. As in `index_reloader.py`, the requests run within
+their deadline and fall back to the degraded mode when an API fails.
+"""
+
+# METADATA
+__authors__ = ("Pierre Poulain", "Essmay Touami")
+__contact__ = "pierre.poulain@u-paris.fr"
+__copyright__ = "BSD-3 clause"
+__date__ = "2024"
+__version__ = "1.0.0"
+
+
+# LIBRARY IMPORTS
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from functools import partial
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional, Tuple
+
+from loguru import logger
+
+# MODULE IMPORTS
+from index_versions import resolve_index_path
+from index_config import read_index_config
+from vector_store import CODES_FILE, EMBEDDINGS_FILE, QUANTIZATION_FILE
+from chunk_store import CHUNK_STORE_FILE
+from metadata_index import METADATA_INDEX_FILE
+from centroids import CENTROIDS_FILE
+from shards import SHARDS_DIR
+from deadlines import Deadline
+from index_reloader import DEADLINE, IndexHandle, answer_request
+from query_chatbot import RETRIEVAL_BUDGET, load_database
+
+
+# CONSTANTS
+MEMORY_BUDGET_MB = 1024.0
+
+
+# CLASSES
+class CollectionManager:
+    """Load the course databases on demand and evict the least recently used ones.
+
+    Parameters
+    ----------
+    courses : dict
+        The path of the database of each course, by course key.
+    memory_budget_mb : float, optional
+        The memory budget of the loaded databases, in MB.
+    loader : callable, optional
+        The function loading a database from its path, returning (database, number of chunks),
+        by default `load_database`.
+    """
+
+    def __init__(
+        self,
+        courses: dict[str, str],
+        memory_budget_mb: float = MEMORY_BUDGET_MB,
+        loader: Callable[[str], Tuple[Any, int]] = load_database,
+    ) -> None:
+        self.courses = courses
+        self.memory_budget = memory_budget_mb * 1e6
+        self.loader = loader
+        # Loaded databases, from the least to the most recently used
+        self._handles = OrderedDict()
+        self._memory = {}
+        self._lock = threading.Lock()
+        self._load_locks = {course: threading.Lock() for course in courses}
+        self.metrics = {
+            course: {"hits": 0, "misses": 0, "loads": 0, "load_time": 0.0, "evictions": 0}
+            for course in courses
+        }
+
+    @property
+    def memory_used(self) -> int:
+        """The size of the files mapped or loaded by the loaded databases, in bytes."""
+        return sum(self._memory.values())
+
+    def _load(self, course: str) -> Tuple[IndexHandle, int]:
+        """Load the database of a course and measure the size of the files its searches use."""
+        path = resolve_index_path(self.courses[course])
+        start = time.perf_counter()
+        vector_db, nb_chunks = self.loader(path)
+        load_time = time.perf_counter() - start
+        memory = get_query_files_size(path)
+        with self._lock:
+            self.metrics[course]["loads"] += 1
+            self.metrics[course]["load_time"] += load_time
+        logger.info(
+            f"Loaded the database of the course '{course}' in {load_time:.2f} s "
+            f"({nb_chunks} chunks, {memory / 1e6:.1f} MB)."
+        )
+
+        return IndexHandle(path, vector_db, nb_chunks), memory
+
+    def _evict(self, keep: str) -> None:
+        """Evict the least recently used databases until the memory budget is met.
+
+        Must be called with the lock held. The database of `keep` is never evicted.
+        """
+        for course in list(self._handles):
+            if self.memory_used <= self.memory_budget:
+                break
+            if course == keep:
+                continue
+            handle = self._handles.pop(course)
+            memory = self._memory.pop(course)
+            handle.retired = True
+            self.metrics[course]["evictions"] += 1
+            logger.info(f"Evicted the database of the course '{course}' ({memory / 1e6:.1f} MB).")
+            if handle.refcount == 0:
+                handle.close()
+
+    def _get_handle(self, course: str) -> IndexHandle:
+        """Get the database of a course, loading it if needed, with a reference held."""
+        if course not in self.courses:
+            raise KeyError(f"Unknown course '{course}'. Choose among {sorted(self.courses)}.")
+        with self._lock:
+            if course in self._handles:
+                self.metrics[course]["hits"] += 1
+                self._handles.move_to_end(course)
+                handle = self._handles[course]
+                handle.refcount += 1
+                return handle
+            self.metrics[course]["misses"] += 1
+        # Only one thread loads a given course, the others wait for it
+        with self._load_locks[course]:
+            with self._lock:
+                if course in self._handles:
+                    handle = self._handles[course]
+                    handle.refcount += 1
+                    return handle
+            handle, memory = self._load(course)
+            with self._lock:
+                handle.refcount += 1
+                self._handles[course] = handle
+                self._memory[course] = memory
+                self._evict(keep=course)
+
+        return handle
+
+    @contextmanager
+    def acquire(self, course: str) -> Iterator[Any]:
+        """Use the database of a course for a request.
+
+        Parameters
+        ----------
+        course : str
+            The course key.
+
+        Yields
+        ------
+        The vector database of the course, which stays open until the end of the request
+        even if it is evicted meanwhile.
+        """
+        handle = self._get_handle(course)
+        try:
+            yield handle.vector_db
+        finally:
+            with self._lock:
+                handle.refcount -= 1
+                close_handle = handle.retired and handle.refcount == 0
+            if close_handle:
+                handle.close()
+
+    def get_metrics(self) -> dict[str, dict]:
+        """Get the hits, misses, loads, load time, evictions and mapped size of each course."""""
+        with self._lock:
+            return {
+                course: {
+                    **metrics,
+                    "loaded": course in self._handles,
+                    "mapped_mb": round(self._memory.get(course, 0) / 1e6, 1),
+                }
+                for course, metrics in self.metrics.items()
+            }
+
+
+# FUNCTIONS
+def get_query_files_size(vector_db_path: str) -> int:
+    """Get the size of the files of a database mapped or loaded by its searches.
+
+    The full embeddings, the chunk store arrays, the metadata index and the centroids
+    are always counted, with the quantized codes for a quantized database and the HNSW
+    index of Chroma otherwise. The Chroma SQLite file and the chunk texts, only read
+    for the chunks returned, and the shards, only mapped by search workers, are not counted.
+
+    Parameters
+    ----------
+    vector_db_path : str
+        The directory of the vector database (a version directory).
+
+    Returns
+    -------
+    int
+        The size of the files, in bytes.
+    """
+    file_names = [EMBEDDINGS_FILE, CHUNK_STORE_FILE, METADATA_INDEX_FILE, CENTROIDS_FILE]
+    if read_index_config(vector_db_path).get("quantization"):
+        file_names += [CODES_FILE, QUANTIZATION_FILE]
+    else:
+        # HNSW segments of the Chroma collection, one directory per segment
+        file_names += [
+            os.path.join(name, file_name)
+            for name in os.listdir(vector_db_path)
+            if name != SHARDS_DIR and os.path.isdir(os.path.join(vector_db_path, name))
+            for file_name in os.listdir(os.path.join(vector_db_path, name))
+        ]
+    paths = [os.path.join(vector_db_path, file_name) for file_name in file_names]
+
+    return sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+
+
+def read_courses(courses_path: str) -> dict[str, str]:
+    """Read the JSON file mapping each course key to the path of its database."""
+    with open(courses_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def get_args() -> Tuple[str, float, float, Optional[str]]:
+    """Parse command-line arguments.
+
+    Returns
+    -------
+    courses_path, memory_budget, deadline, model_name : Tuple[str, float, float, str]
+        - courses_path : str
+            The JSON file mapping each course key to the path of its database.
+        - memory_budget : float
+            The memory budget of the loaded databases, in MB.
+        - deadline : float
+            The time budget of each request, in seconds.
+        - model_name : str or None
+            The chat model answering each query.
+    """
+    parser = argparse.ArgumentParser(
+        description="Search the databases of several courses within a memory budget."
+    )
+    parser.add_argument(
+        "--courses",
+        dest="courses_path",
+        required=True,
+        help="The JSON file mapping each course key to the path of its database.",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        dest="memory_budget",
+        type=float,
+        default=MEMORY_BUDGET_MB,
+        help="The memory budget of the loaded databases, in MB.",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        default=DEADLINE,
+        help="The time budget of each request, in seconds.",
+    )
+    parser.add_argument(
+        "--model",
+        dest="model_name",
+        default=None,
+        help="The chat model answering each query (default: only search the relevant chunks).",
+    )
+    args = parser.parse_args()
+
+    # Checks
+    if not os.path.exists(args.courses_path):
+        logger.error(f"The courses file '{args.courses_path}' does not exist.")
+        sys.exit(1)
+    if args.memory_budget <= 0:
+        logger.error("The memory budget should be positive.")
+        sys.exit(1)
+    if args.deadline <= 0:
+        logger.error("The deadline should be positive.")
+        sys.exit(1)
+
+    return args.courses_path, args.memory_budget, args.deadline, args.model_name
+
+
+def main() -> None:
+    """Search the database of the course of each query of the standard input."""
+    courses_path, memory_budget, deadline, model_name = get_args()
+
+    # The embedding calls are not retried and give up with the search
+    loader = partial(load_database, api_timeout=RETRIEVAL_BUDGET)
+    manager = CollectionManager(read_courses(courses_path), memory_budget, loader)
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        course, _, query = line.rstrip("\n").partition("\t")
+        if course not in manager.courses:
+            logger.error(f"Unknown course '{course}'. Choose among {sorted(manager.courses)}.")
+            continue
+        with manager.acquire(course) as vector_db:
+            chunk_ids, lexical, answer = answer_request(
+                vector_db, query, Deadline(deadline), model_name
+            )
+        search_mode = "lexical" if lexical else "semantic"
+        print(f"{course}\t{query}\t{chunk_ids}\t{search_mode}", flush=True)
+        if answer is not None:
+            print(answer, flush=True)
+
+    for course, metrics in manager.get_metrics().items():
+        print(
+            f"{course:<16} hits {metrics['hits']:>5}  misses {metrics['misses']:>4}  "
+            f"loads {metrics['loads']:>3}  load time {metrics['load_time']:>7.2f} s  "
+            f"evictions {metrics['evictions']:>3}  mapped {metrics['mapped_mb']:>8.1f} MB"
+        )
+
+
+# MAIN PROGRAM
+if __name__ == "__main__":
+    main()
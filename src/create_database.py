@@ -2,6 +2,8 @@
 
 This script loads Markdown files from the specified directory, concatenates their content, 
 and splits the content into chunks based on headers and word limits. The resulting chunks are saved to a ChromaDB database.
+Each build is written to a new version directory (`[chroma-path]_versions/`) with a manifest,
+and published as `[chroma-path]` by an atomic switch once it is complete.
 
 Usage:
 ======
@@ -17,6 +19,40 @@ Arguments:
         The size of the text chunks to be created. Default is 1000.
     --chunk-overlap : int (optional)
         The overlap between text chunks. Default is 200.
+    --ledger : str (optional)
+        The path to the token ledger file. Default is token_ledger.csv.
+    --provider : str (optional)
+        The embedding provider: "openai" or "local". Default is "openai"
+        (or the BIOPYASSISTANT_PROVIDER environment variable).
+    --truncate-dim : int (optional)
+        Number of embedding dimensions stored in ChromaDB for the first-pass search
+        (for example 256 or 512). The full embeddings are kept in a separate NumPy file
+        to rescore the top candidates. Default is to store the full embeddings.
+    --quantization : str (optional)
+        Quantized storage mode: "int8" (4x smaller) or "binary" (32x smaller).
+        The candidates are searched in the codes held in memory and rescored exactly
+        with the full embeddings kept on disk. Default is no quantization.
+    --dedup-threshold : float (optional)
+        Minimum estimated Jaccard similarity of two near-duplicate chunks: only the first chunk
+        of each group of near-duplicates is kept, the others are saved as its aliases.
+        Use 0 to keep all the chunks. Default is 0.8.
+    --compress-texts : flag (optional)
+        Compress the text of each chunk with zlib in the chunk store. Default is no compression.
+    --keep-versions : int (optional)
+        The number of versions of the database kept for rollback. Default is 3.
+    --shard-workers : int (optional)
+        Embed the chunks in one shard per chapter, with this number of worker processes.
+        The shards unchanged since the published version are reused instead of being embedded again.
+        Default is to embed all the chunks in the main process, without shards.
+    --splitter : str (optional)
+        The text splitter: "langchain" (MarkdownHeaderTextSplitter then RecursiveCharacterTextSplitter)
+        or "native" (single-pass splitter on offsets of header_splitter.py, same chunks).
+        Default is "langchain".
+    --profile : str (optional)
+        Record the wall time, CPU time and peak memory of each stage and save the report to this path
+        (create_database_profile.json if no path is given). See stage_profiler.py.
+    --cprofile-dir : str (optional)
+        With --profile, also dump the cProfile statistics of each stage to this directory.
     
 
 Example:
@@ -46,7 +82,6 @@ import unicodedata
 
 import tiktoken
 from loguru import logger
-from langchain_openai import OpenAIEmbeddings
 from langchain_core.documents import Document
 from langchain_community.vectorstores import Chroma
 from langchain_community.document_loaders import TextLoader, DirectoryLoader
@@ -55,20 +90,59 @@ from langchain_text_splitters import (
     RecursiveCharacterTextSplitter,
 )
 
+# MODULE IMPORTS
+from index_config import write_index_config
+from chunk_store import save_chunk_store
+from index_versions import (
+    KEEP_VERSIONS,
+    hash_inputs,
+    create_version_dir,
+    write_manifest,
+    publish_version,
+    resolve_index_path,
+)
+from metadata_index import (
+    save_metadata_index,
+    load_metadata_index,
+    write_metadata_index,
+    add_duplicates_to_metadata_index,
+)
+from centroids import save_centroids
+from dedup import DEDUP_THRESHOLD, remove_near_duplicates, build_aliases, save_aliases
+from shards import PrecomputedEmbeddings, build_shards
+from token_ledger import TOKEN_LEDGER_PATH, record_usage
+from header_splitter import split_markdown
+from stage_profiler import StageProfiler, add_profile_arguments
+from providers import (
+    PROVIDERS,
+    DEFAULT_PROVIDER,
+    LOCAL_EMBEDDING_DIM,
+    get_embedding_function,
+)
+from vector_store import (
+    QUANTIZATIONS,
+    RecordingEmbeddings,
+    load_embeddings,
+    save_embeddings,
+    save_quantized_embeddings,
+)
+
 
 # CONSTANTS
 CHUNK_SIZE = 1000
 CHUNK_OVERLAP = 200
 EMBEDDING_MODEL = "text-embedding-3-large"
+PROFILE_PATH = "create_database_profile.json"
+SPLITTERS = ("langchain", "native")
 
 
 # FUNCTIONS
-def get_args() -> tuple[str, str, int, int]:
+def get_args() -> tuple[str, str, int, int, str, str, int, str, float, bool, int, int, str, str, str]:
     """Parse command-line arguments.
 
     Returns
     -------
-    data_path, chroma_output_path, chunk_size, chunk_overlap : Tuple[str, str, int, int]
+    data_path, chroma_output_path, chunk_size, chunk_overlap, ledger_path, provider, truncate_dim, quantization, dedup_threshold, compress_texts, keep_versions, shard_workers, profile_path, cprofile_dir, splitter : Tuple[str, str, int, int, str, str, int, str, float, bool, int, int, str, str, str]
         - data_path : str
             The directory containing the processed Markdown files of the python course.
         - chroma_output_path : str
@@ -77,6 +151,28 @@ def get_args() -> tuple[str, str, int, int]:
             The size of the text chunks to be created.
         - chunk_overlap : int
             The overlap between text chunks.
+        - ledger_path : str
+            The path to the token ledger file.
+        - provider : str
+            The embedding provider.
+        - truncate_dim : int or None
+            The number of embedding dimensions stored in ChromaDB (None for all).
+        - quantization : str or None
+            The quantized storage mode.
+        - dedup_threshold : float
+            The minimum estimated Jaccard similarity of two near-duplicate chunks.
+        - compress_texts : bool
+            Flag to compress the texts of the chunk store.
+        - keep_versions : int
+            The number of versions of the database kept for rollback.
+        - shard_workers : int or None
+            The number of worker processes embedding the shards (None for no shards).
+        - profile_path : str or None
+            The path of the profile report of the stages (None for no profiling).
+        - cprofile_dir : str or None
+            The directory of the cProfile statistics of the stages.
+        - splitter : str
+            The text splitter: "langchain" or "native".
     """
     # Create the parser
     parser = argparse.ArgumentParser(
@@ -111,6 +207,73 @@ def get_args() -> tuple[str, str, int, int]:
         default=CHUNK_OVERLAP,
         help="The overlap between text chunks.",
     )
+    parser.add_argument(
+        "-l",
+        "--ledger",
+        dest="ledger_path",
+        default=TOKEN_LEDGER_PATH,
+        help="The path to the token ledger file.",
+    )
+    parser.add_argument(
+        "-p",
+        "--provider",
+        dest="provider",
+        choices=PROVIDERS,
+        default=DEFAULT_PROVIDER,
+        help="The embedding provider.",
+    )
+    parser.add_argument(
+        "-t",
+        "--truncate-dim",
+        dest="truncate_dim",
+        type=int,
+        default=None,
+        help="The number of embedding dimensions stored in ChromaDB for the first-pass search.",
+    )
+    parser.add_argument(
+        "-q",
+        "--quantization",
+        dest="quantization",
+        choices=QUANTIZATIONS,
+        default=None,
+        help="The quantized storage mode.",
+    )
+    parser.add_argument(
+        "--dedup-threshold",
+        dest="dedup_threshold",
+        type=float,
+        default=DEDUP_THRESHOLD,
+        help="The minimum estimated Jaccard similarity of two near-duplicate chunks (0 to disable).",
+    )
+    parser.add_argument(
+        "--compress-texts",
+        dest="compress_texts",
+        action="store_true",
+        default=False,
+        help="Compress the text of each chunk with zlib in the chunk store.",
+    )
+    parser.add_argument(
+        "--keep-versions",
+        dest="keep_versions",
+        type=int,
+        default=KEEP_VERSIONS,
+        help="The number of versions of the database kept for rollback.",
+    )
+    parser.add_argument(
+        "--shard-workers",
+        dest="shard_workers",
+        type=int,
+        default=None,
+        help="Embed the chunks in one shard per chapter, with this number of worker processes.",
+    )
+    parser.add_argument(
+        "--splitter",
+        dest="splitter",
+        choices=SPLITTERS,
+        default="langchain",
+        help="The text splitter: the langchain splitters or the single-pass native splitter.",
+    )
+    add_profile_arguments(parser, PROFILE_PATH)
     # Parse the arguments
     args = parser.parse_args()
 
@@ -125,6 +288,21 @@ def get_args() -> tuple[str, str, int, int]:
     if args.chunk_overlap <= 0:
         logger.error("The chunk overlap should be a positive integer.")
         sys.exit(1)
+    if args.truncate_dim is not None and args.truncate_dim <= 0:
+        logger.error("The truncated dimension should be a positive integer.")
+        sys.exit(1)
+    if args.keep_versions <= 0:
+        logger.error("The number of kept versions should be a positive integer.")
+        sys.exit(1)
+    if args.shard_workers is not None and args.shard_workers <= 0:
+        logger.error("The number of shard workers should be a positive integer.")
+        sys.exit(1)
+    if not 0 <= args.dedup_threshold <= 1:
+        logger.error("The deduplication threshold should be in [0, 1].")
+        sys.exit(1)
+    if args.truncate_dim is not None and args.quantization is not None:
+        logger.error("The truncated dimension and the quantization cannot be combined.")
+        sys.exit(1)
     # chunk_overlap should be less than chunk_size
     if args.chunk_overlap >= args.chunk_size:
         logger.error(
@@ -137,6 +315,17 @@ def get_args() -> tuple[str, str, int, int]:
         args.chroma_path,
         args.chunk_size,
         args.chunk_overlap,
+        args.ledger_path,
+        args.provider,
+        args.truncate_dim,
+        args.quantization,
+        args.dedup_threshold,
+        args.compress_texts,
+        args.keep_versions,
+        args.shard_workers,
+        args.profile_path,
+        args.cprofile_dir,
+        args.splitter,
     )
 
 
@@ -226,7 +415,9 @@ def concatenate_content(documents: list[Document]) -> str:
     return concatenated_content
 
 
-def split_text(content: str, chunk_size: int, chunk_overlap: int) -> list[Document]:
+def split_text(
+    content: str, chunk_size: int, chunk_overlap: int, splitter: str = "langchain"
+) -> list[Document]:
     """Split concatenated Markdown content into chunks based on headers and word limits.
 
     Parameters:
@@ -237,6 +428,9 @@ def split_text(content: str, chunk_size: int, chunk_overlap: int) -> list[Docume
         The size of the text chunks to be created.
     chunk_overlap : int
         The overlap between text chunks.
+    splitter : str, optional
+        "langchain" for the langchain splitters, or "native" for the single-pass splitter
+        of header_splitter.py, which gives the same chunks faster. By default "langchain".
 
     Returns:
     --------
@@ -246,6 +440,11 @@ def split_text(content: str, chunk_size: int, chunk_overlap: int) -> list[Docume
     """
     logger.info("Splitting the documents...")
 
+    if splitter == "native":
+        chunks = split_markdown(content, chunk_size, chunk_overlap)
+        logger.success(f"Split documents into {len(chunks)} chunks.\n")
+        return chunks
+
     # create a Markdown header text splitter
     headers_to_split_on = [
         ("#", "chapter_name"),
@@ -503,7 +702,17 @@ def add_url_to_metadata(chunks: list[Document]) -> list[Document]:
     return chunks
 
 
-def save_to_chroma(chunks: list[Document], chroma_output_path: str) -> None:
+def save_to_chroma(
+    chunks: list[Document],
+    chroma_output_path: str,
+    ledger_path: str = TOKEN_LEDGER_PATH,
+    provider: str = DEFAULT_PROVIDER,
+    truncate_dim: int = None,
+    quantization: str = None,
+    compress_texts: bool = False,
+    shard_workers: int = None,
+    previous_path: str = None,
+) -> None:
     """Save text chunks to ChromaDB.
 
     Parameters
@@ -511,60 +720,265 @@ def save_to_chroma(chunks: list[Document], chroma_output_path: str) -> None:
     chunks : list of str
         List of text chunks to save to ChromaDB.
     chroma_output_path : str
-        The name of the output path to save the ChromaDB database.
+        The name of the output path to save the ChromaDB database
+        (the directory of a new version of the database).
+    ledger_path : str, optional
+        The path to the token ledger file, by default TOKEN_LEDGER_PATH.
+    provider : str, optional
+        The embedding provider, by default DEFAULT_PROVIDER.
+    truncate_dim : int, optional
+        The number of embedding dimensions stored in ChromaDB, by default None (all).
+        The full embeddings are always saved in a separate NumPy file.
+    quantization : str, optional
+        The quantized storage mode, "int8" or "binary", by default None.
+    compress_texts : bool, optional
+        Compress the texts of the chunk store, by default False.
+    shard_workers : int, optional
+        The number of worker processes embedding the chapter shards, by default None (no shards).
+    previous_path : str, optional
+        The directory of the published version, whose unchanged shards are reused, by default None.
     """
-    logger.info("Saving to Chroma...")
+    if shard_workers:
+        # Embed the chunks shard by shard, reusing the unchanged shards
+        vectors, nb_tokens = build_shards(
+            chunks, chroma_output_path, provider, EMBEDDING_MODEL, shard_workers, previous_path
+        )
+        embedding_function = PrecomputedEmbeddings(
+            {chunk.page_content: vector for chunk, vector in zip(chunks, vectors)}
+        )
+    else:
+        # The rate limiter reuses the numbers of tokens of the chunks
+        embedding_function = get_embedding_function(
+            provider,
+            EMBEDDING_MODEL,
+            token_counts={chunk.page_content: chunk.metadata["nb_tokens"] for chunk in chunks},
+        )
+        nb_tokens = sum(chunk.metadata["nb_tokens"] for chunk in chunks)
 
-    # Clear out the database first.
-    if os.path.exists(chroma_output_path):
-        shutil.rmtree(chroma_output_path)
+    logger.info("Saving to Chroma...")
 
     # Create a new DB from the documents and save it to disk
-    model_embedding = OpenAIEmbeddings(model=EMBEDDING_MODEL)
+    model_embedding = RecordingEmbeddings(embedding_function, truncate_dim)
     Chroma.from_documents(
         chunks,
         model_embedding,
+        ids=[str(chunk.metadata["id"]) for chunk in chunks],
         persist_directory=chroma_output_path,
         collection_metadata={"hnsw:space": "cosine"},
     )  # distance metric
 
+    # Save the full embeddings (row i is the embedding of the chunk with id i)
+    save_embeddings(model_embedding.vectors, chroma_output_path)
+    if quantization:
+        save_quantized_embeddings(model_embedding.vectors, chroma_output_path, quantization)
+    # Save the columnar store of the chunks
+    chunk_store = save_chunk_store(chunks, chroma_output_path, compress_texts)
+    # Save the index of the chunk ids by chapter, file and section
+    metadata_index = save_metadata_index(chunk_store, chroma_output_path)
+    # Save the chapter and section centroids for the two-stage search
+    save_centroids(load_embeddings(chroma_output_path), metadata_index, chroma_output_path)
+
+    # Save the embedding configuration for the query side
+    write_index_config(
+        chroma_output_path,
+        {
+            "provider": provider,
+            "embedding_model": EMBEDDING_MODEL,
+            "embedding_dimension": LOCAL_EMBEDDING_DIM if provider == "local" else None,
+            "truncate_dim": truncate_dim,
+            "quantization": quantization,
+        },
+    )
+
+    # Record the number of embedded tokens in the ledger
+    model_tag = EMBEDDING_MODEL if provider == "openai" else f"{provider}-hashing"
+    record_usage("embedding", model_tag, nb_tokens, ledger_path=ledger_path)
+
     logger.success(f"Saved {len(chunks)} chunks to {chroma_output_path}.")
 
 
-def generate_data_store() -> None:
-    """Generates data store by loading, splitting text into chunks, adding metadata and saving the chunks to ChromaDB."""
-    # get command-line arguments
-    data_path, chroma_path, chunk_size, chunk_overlap = get_args()
+def build_chunks(
+    data_path: str,
+    chunk_size: int,
+    chunk_overlap: int,
+    dedup_threshold: float = DEDUP_THRESHOLD,
+    profiler: StageProfiler = None,
+    splitter: str = "langchain",
+) -> tuple[list[Document], list[tuple[Document, Document]], list[str]]:
+    """Load the Markdown files and split them into chunks with their metadata.
+
+    Parameters
+    ----------
+    data_path : str
+        The directory containing the processed Markdown files of the python course.
+    chunk_size : int
+        The size of the text chunks to be created.
+    chunk_overlap : int
+        The overlap between text chunks.
+    dedup_threshold : float, optional
+        The minimum estimated Jaccard similarity of two near-duplicate chunks, by default DEDUP_THRESHOLD.
+        With 0, the near-duplicates are not removed.
+    profiler : StageProfiler, optional
+        The profiler of the stages, by default None (no profiling).
+    splitter : str, optional
+        The text splitter, "langchain" or "native", by default "langchain".
+
+    Returns
+    -------
+    chunks, duplicates, file_names : tuple
+        - chunks : list of Document
+            The chunks to save, with their id, number of tokens, file name and URL.
+        - duplicates : list of tuple
+            The (dropped, kept) pairs of near-duplicate chunks.
+        - file_names : list of str
+            The file names of the Markdown documents.
+    """
+    profiler = profiler or StageProfiler(enabled=False)
 
     # load documents from the specified directory
-    documents = load_documents(data_path)
+    with profiler.stage("load"):
+        documents = load_documents(data_path)
 
     # extract file names from the documents
-    file_names = get_file_names(documents)
+    with profiler.stage("file_names"):
+        file_names = get_file_names(documents)
 
     # concatenate the content of the documents
-    content = concatenate_content(documents)
+    with profiler.stage("concatenate"):
+        content = concatenate_content(documents)
 
     # split text into chunks
-    chunks = split_text(content, chunk_size, chunk_overlap)
+    with profiler.stage("split"):
+        chunks = split_text(content, chunk_size, chunk_overlap, splitter)
 
     # remove small chunks
-    chunks_cleaned = remove_small_chunks(chunks, min_nb_char=100)
+    with profiler.stage("filter"):
+        chunks_cleaned = remove_small_chunks(chunks, min_nb_char=100)
+
+    # remove near-duplicate chunks
+    with profiler.stage("dedup"):
+        if dedup_threshold > 0:
+            chunks_unique, duplicates = remove_near_duplicates(chunks_cleaned, dedup_threshold)
+        else:
+            chunks_unique, duplicates = chunks_cleaned, []
 
     # add index to the metadata
-    chunks_with_index = add_index_to_metadata(chunks_cleaned)
+    with profiler.stage("index"):
+        chunks_with_index = add_index_to_metadata(chunks_unique)
 
     # add number of tokens to the metadata
-    chunks_with_tokens = add_token_number_to_metadata(chunks_with_index)
+    with profiler.stage("tokens"):
+        chunks_with_tokens = add_token_number_to_metadata(chunks_with_index)
 
     # add file names to the chunks
-    chunks_with_file_names = add_file_names_to_metadata(chunks_with_tokens, file_names)
+    with profiler.stage("metadata_file_names"):
+        chunks_with_file_names = add_file_names_to_metadata(chunks_with_tokens, file_names)
 
     # add URL to the chunks
-    chunks_with_url = add_url_to_metadata(chunks_with_file_names)
+    with profiler.stage("urls"):
+        chunks_with_url = add_url_to_metadata(chunks_with_file_names)
 
-    # save the chunks to ChromaDB
-    save_to_chroma(chunks_with_url, chroma_path)
+    return chunks_with_url, duplicates, file_names
+
+
+def generate_data_store() -> None:
+    """Generates data store by loading, splitting text into chunks, adding metadata and saving the chunks to ChromaDB."""
+    # get command-line arguments
+    (
+        data_path,
+        chroma_path,
+        chunk_size,
+        chunk_overlap,
+        ledger_path,
+        provider,
+        truncate_dim,
+        quantization,
+        dedup_threshold,
+        compress_texts,
+        keep_versions,
+        shard_workers,
+        profile_path,
+        cprofile_dir,
+        splitter,
+    ) = get_args()
+    # time and memory of the stages (nothing is measured without --profile)
+    profiler = StageProfiler(enabled=profile_path is not None, cprofile_dir=cprofile_dir)
+
+    # load the documents and split them into chunks with their metadata
+    chunks_with_url, duplicates, file_names = build_chunks(
+        data_path, chunk_size, chunk_overlap, dedup_threshold, profiler, splitter
+    )
+
+    # build the new version of the database next to the published one
+    previous_path = resolve_index_path(chroma_path) if os.path.exists(chroma_path) else None
+    version_path = create_version_dir(chroma_path)
+    try:
+        # save the chunks to ChromaDB
+        with profiler.stage("save"):
+            save_to_chroma(
+                chunks_with_url,
+                version_path,
+                ledger_path,
+                provider,
+                truncate_dim,
+                quantization,
+                compress_texts,
+                shard_workers,
+                previous_path,
+            )
+
+        # save the citation metadata of the dropped near-duplicates as aliases of the kept chunks,
+        # and index the kept chunks in the chapters and sections of their aliases
+        with profiler.stage("aliases"):
+            dropped_chunks = [dropped for dropped, _kept in duplicates]
+            add_url_to_metadata(add_file_names_to_metadata(dropped_chunks, file_names))
+            save_aliases(build_aliases(duplicates), version_path)
+            if duplicates:
+                metadata_index = load_metadata_index(version_path)
+                add_duplicates_to_metadata_index(metadata_index, duplicates)
+                write_metadata_index(metadata_index, version_path)
+        write_index_config(
+            version_path, {"dedup_threshold": dedup_threshold, "nb_aliases": len(duplicates)}
+        )
+
+        # save the manifest of the build
+        write_manifest(
+            version_path,
+            {
+                "inputs_hash": hash_inputs(data_path),
+                "parameters": {
+                    "data_path": data_path,
+                    "chunk_size": chunk_size,
+                    "chunk_overlap": chunk_overlap,
+                    "provider": provider,
+                    "embedding_model": EMBEDDING_MODEL,
+                    "truncate_dim": truncate_dim,
+                    "quantization": quantization,
+                    "dedup_threshold": dedup_threshold,
+                    "compress_texts": compress_texts,
+                    "shard_workers": shard_workers,
+                    "splitter": splitter,
+                },
+                "counts": {
+                    "nb_files": len(file_names),
+                    "nb_chunks": len(chunks_with_url),
+                    "nb_aliases": len(duplicates),
+                    "nb_tokens": sum(chunk.metadata["nb_tokens"] for chunk in chunks_with_url),
+                },
+            },
+        )
+    except BaseException:
+        # an incomplete version is never published
+        logger.error(f"The build failed: removing the incomplete version '{version_path}'.")
+        shutil.rmtree(version_path, ignore_errors=True)
+        raise
+
+    # publish the new version atomically
+    publish_version(chroma_path, version_path, keep_versions)
+
+    # save the profile of the stages
+    if profile_path is not None:
+        profiler.write_report(profile_path, "create_database")
 
 
 # MAIN PROGRAM
@@ -0,0 +1,220 @@
+"""Request deadlines and circuit breakers of the remote API calls.
+
+A `Deadline` is the time budget of a request, shared by its stages (retrieval, generation):
+each stage is run with `run_with_deadline`, which gives up waiting for the stage when
+its budget is spent, so that the request can fall back to a degraded answer in time.
+
+A `CircuitBreaker` stops calling the API while it is failing: after `failure_threshold`
+consecutive failures (API errors or missed deadlines), the circuit opens and the calls are
+skipped for `reset_timeout` seconds. One trial call is then allowed (half-open circuit):
+the circuit closes if it succeeds, and opens again otherwise.
+"""
+
+# METADATA
+__authors__ = ("Pierre Poulain", "Essmay Touami")
+__contact__ = "pierre.poulain@u-paris.fr"
+__copyright__ = "BSD-3 clause"
+__date__ = "2024"
+__version__ = "1.0.0"
+
+
+# LIBRARY IMPORTS
+import time
+import threading
+from concurrent.futures import Future, TimeoutError
+from typing import Any, Callable, Tuple, Type
+
+from loguru import logger
+
+
+# CONSTANTS
+FAILURE_THRESHOLD = 3
+RESET_TIMEOUT = 30.0
+
+
+# CLASSES
+class DeadlineExceeded(TimeoutError):
+    """A stage of a request did not finish within its budget."""
+
+
+class Deadline:
+    """The time budget of a request.
+
+    Parameters
+    ----------
+    timeout : float
+        The duration of the budget, in seconds.
+    """
+
+    def __init__(self, timeout: float) -> None:
+        self.timeout = timeout
+        self.expires_at = time.monotonic() + timeout
+
+    def remaining(self) -> float:
+        """The time left before the deadline, in seconds (0 if it has passed)."""
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def expired(self) -> bool:
+        """Whether the deadline has passed."""
+        return self.remaining() == 0
+
+    def budget(self, stage_budget: float) -> float:
+        """The budget of a stage: its own budget, within the time left."""
+        return min(stage_budget, self.remaining())
+
+
+class CircuitBreaker:
+    """Skip the calls to a failing API for a while.
+
+    Parameters
+    ----------
+    name : str
+        The name of the API, used in the logs.
+    failure_threshold : int, optional
+        The number of consecutive failures opening the circuit.
+    reset_timeout : float, optional
+        The time during which the calls are skipped once the circuit is open, in seconds.
+    """
+
+    def __init__(
+        self, name: str, failure_threshold: int = FAILURE_THRESHOLD, reset_timeout: float = RESET_TIMEOUT
+    ) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.nb_failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """The state of the circuit: "closed", "open" or "half-open"."""
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half-open"
+
+    def allow(self) -> bool:
+        """Whether a call is allowed: always when closed, one trial call when half-open."""
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        """Record a successful call: the circuit closes."""
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info(f"The {self.name} API recovered: circuit closed.")
+            self.nb_failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def cancel_trial(self) -> None:
+        """Give back the trial call of a half-open circuit, for a call which is not an API failure."""
+        with self._lock:
+            self._trial = False
+
+    def record_failure(self) -> None:
+        """Record a failed call: the circuit opens after too many failures."""
+        with self._lock:
+            self.nb_failures += 1
+            if self._trial or self.nb_failures >= self.failure_threshold:
+                if self.opened_at is None or self._trial:
+                    logger.warning(
+                        f"The {self.name} API is failing: calls skipped for {self.reset_timeout:.0f} s."
+                    )
+                self.opened_at = time.monotonic()
+                self._trial = False
+
+
+# FUNCTIONS
+def run_with_deadline(function: Callable[[], Any], timeout: float) -> Any:
+    """Run a function, waiting for its result for a limited time.
+
+    The function runs in a daemon thread: when the time is up, the caller stops waiting
+    (the blocked call finishes in the background and its result is discarded).
+
+    Parameters
+    ----------
+    function : callable
+        The function to run.
+    timeout : float
+        The maximum waiting time, in seconds.
+
+    Returns
+    -------
+    The result of the function.
+
+    Raises
+    ------
+    DeadlineExceeded
+        If the function did not finish in time.
+    """
+    if timeout <= 0:
+        raise DeadlineExceeded("No time left for the stage.")
+    future = Future()
+
+    def target() -> None:
+        try:
+            future.set_result(function())
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=target, daemon=True).start()
+    try:
+        return future.result(timeout=timeout)
+    except TimeoutError:
+        raise DeadlineExceeded(f"The stage did not finish within {timeout:.2f} s.") from None
+
+
+def call_with_breaker(
+    breaker: CircuitBreaker,
+    function: Callable[[], Any],
+    timeout: float,
+    failure_errors: Tuple[Type[BaseException], ...] = (Exception,),
+) -> Any:
+    """Run a call to an API within a time budget, through its circuit breaker.
+
+    Parameters
+    ----------
+    breaker : CircuitBreaker
+        The circuit breaker of the API.
+    function : callable
+        The function calling the API.
+    timeout : float
+        The maximum waiting time, in seconds.
+    failure_errors : tuple of exception types, optional
+        The errors counted as failures of the API, by default all the errors.
+        A missed deadline is always a failure; the other errors are raised without being counted.
+
+    Returns
+    -------
+    The result of the function.
+
+    Raises
+    ------
+    DeadlineExceeded
+        If the circuit is open or the call did not finish in time.
+    Exception
+        The error of the call.
+    """
+    if not breaker.allow():
+        raise DeadlineExceeded(f"The circuit of the {breaker.name} API is open.")
+    try:
+        result = run_with_deadline(function, timeout)
+    except (DeadlineExceeded, *failure_errors):
+        breaker.record_failure()
+        raise
+    except Exception:
+        breaker.cancel_trial()
+        raise
+    breaker.record_success()
+
+    return result
@@ -0,0 +1,267 @@
+"""Near-duplicate detection of the text chunks with MinHash and LSH.
+
+With overlapping chunks and boilerplate repeated across chapters, some chunks are almost
+identical. They waste embedding calls, index memory and prompt tokens when several of them
+are retrieved together.
+
+Each chunk is represented by the set of its word shingles (sequences of consecutive words).
+The MinHash signature of this set estimates the Jaccard similarity between two chunks,
+and the locality-sensitive hashing (LSH) of the signature bands gives the candidate pairs
+without comparing all the pairs of chunks, across the whole course. For each group of
+near-duplicates, the first chunk is kept and the others are recorded as its aliases:
+
+    aliases.json: {"<id of the kept chunk>": [metadata of the dropped chunks], ...}
+
+so that the sources of the dropped chunks can still be cited. The kept chunk is also added
+to the chapters and sections of its aliases in the metadata index (see `metadata_index.py`),
+so that the chapter and section filters of the search still find the text of the dropped chunks.
+"""
+
+# METADATA
+__authors__ = ("Pierre Poulain", "Essmay Touami")
+__contact__ = "pierre.poulain@u-paris.fr"
+__copyright__ = "BSD-3 clause"
+__date__ = "2024"
+__version__ = "1.0.0"
+
+
+# LIBRARY IMPORTS
+import os
+import json
+import zlib
+
+import numpy as np
+from loguru import logger
+from langchain_core.documents import Document
+
+
+# CONSTANTS
+ALIASES_FILE = "aliases.json"
+DEDUP_THRESHOLD = 0.8
+SHINGLE_SIZE = 5
+NUM_PERM = 128
+NUM_BANDS = 16
+# Mersenne prime: the products of the hash functions fit in 64 bits
+HASH_PRIME = (1 << 31) - 1
+SEED = 42
+CITATION_FIELDS = (
+    "file_name",
+    "chapter_name",
+    "section_name",
+    "subsection_name",
+    "subsubsection_name",
+    "url",
+)
+
+
+# FUNCTIONS
+def get_shingles(text: str, size: int = SHINGLE_SIZE) -> np.ndarray:
+    """Hash the word shingles of a text.
+
+    Parameters
+    ----------
+    text : str
+        The text of a chunk.
+    size : int
+        The number of words of a shingle.
+
+    Returns
+    -------
+    np.ndarray
+        The hashes of the distinct shingles, as uint64.
+    """
+    words = text.lower().split()
+    shingles = {
+        " ".join(words[i : i + size]) for i in range(max(len(words) - size + 1, 1))
+    }
+
+    return np.array([zlib.crc32(shingle.encode("utf-8")) for shingle in shingles], dtype=np.uint64)
+
+
+def compute_signatures(
+    texts: list[str], num_perm: int = NUM_PERM, seed: int = SEED
+) -> np.ndarray:
+    """Compute the MinHash signatures of texts.
+
+    Each of the `num_perm` hash functions is h(x) = (a * x + b) mod HASH_PRIME.
+
+    Parameters
+    ----------
+    texts : list of str
+        The texts of the chunks.
+    num_perm : int
+        The number of hash functions.
+    seed : int
+        The seed of the hash functions.
+
+    Returns
+    -------
+    signatures : np.ndarray
+        One signature of `num_perm` values per text.
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, HASH_PRIME, size=num_perm, dtype=np.uint64)
+    b = rng.integers(0, HASH_PRIME, size=num_perm, dtype=np.uint64)
+    signatures = np.empty((len(texts), num_perm), dtype=np.uint64)
+    for i, text in enumerate(texts):
+        shingles = get_shingles(text) % np.uint64(HASH_PRIME)
+        signatures[i] = ((np.outer(shingles, a) + b) % np.uint64(HASH_PRIME)).min(axis=0)
+
+    return signatures
+
+
+def get_candidate_pairs(signatures: np.ndarray, num_bands: int = NUM_BANDS) -> set[tuple[int, int]]:
+    """Get the pairs of texts sharing at least one band of their signatures.
+
+    Parameters
+    ----------
+    signatures : np.ndarray
+        The MinHash signatures, one row per text.
+    num_bands : int
+        The number of bands of the signatures.
+
+    Returns
+    -------
+    pairs : set of tuple
+        The candidate pairs (i, j), with i < j.
+    """
+    rows_per_band = signatures.shape[1] // num_bands
+    pairs = set()
+    for band in range(num_bands):
+        buckets = {}
+        band_signatures = signatures[:, band * rows_per_band : (band + 1) * rows_per_band]
+        for i, band_signature in enumerate(band_signatures):
+            buckets.setdefault(band_signature.tobytes(), []).append(i)
+        for bucket in buckets.values():
+            for position, i in enumerate(bucket):
+                for j in bucket[position + 1 :]:
+                    pairs.add((i, j))
+
+    return pairs
+
+
+def remove_near_duplicates(
+    chunks: list[Document],
+    threshold: float = DEDUP_THRESHOLD,
+) -> tuple[list[Document], list[tuple[Document, Document]]]:
+    """Remove the near-duplicate chunks, keeping the first chunk of each group.
+
+    Parameters
+    ----------
+    chunks : list of Document
+        List of text chunks.
+    threshold : float
+        Minimum estimated Jaccard similarity of the shingles of two near-duplicates.
+
+    Returns
+    -------
+    chunks_kept : list of Document
+        List of text chunks without near-duplicates, in their original order.
+    duplicates : list of tuple
+        List of (dropped chunk, kept chunk).
+    """
+    logger.info("Removing near-duplicate chunks...")
+
+    signatures = compute_signatures([chunk.page_content for chunk in chunks])
+    representatives = {}
+    # Candidate pairs are sorted, so that each chunk is compared to the earlier chunks first
+    for i, j in sorted(get_candidate_pairs(signatures)):
+        if i in representatives or j in representatives:
+            continue
+        if np.mean(signatures[i] == signatures[j]) >= threshold:
+            representatives[j] = i
+    chunks_kept = [chunk for i, chunk in enumerate(chunks) if i not in representatives]
+    duplicates = [(chunks[j], chunks[i]) for j, i in sorted(representatives.items())]
+
+    nb_chars = sum(len(chunk.page_content) for chunk in chunks)
+    nb_chars_kept = sum(len(chunk.page_content) for chunk in chunks_kept)
+    logger.info(f"Number of chunks before removing near-duplicates: {len(chunks)}")
+    logger.info(f"Number of chunks after removing near-duplicates: {len(chunks_kept)}")
+    logger.info(
+        f"The index shrank by {len(duplicates)} chunks and {nb_chars - nb_chars_kept} characters "
+        f"({(nb_chars - nb_chars_kept) / max(nb_chars, 1):.1%})."
+    )
+    logger.success("Removed near-duplicate chunks successfully.\n")
+
+    return chunks_kept, duplicates
+
+
+def build_aliases(duplicates: list[tuple[Document, Document]]) -> dict[str, list[dict]]:
+    """Build the aliases of the kept chunks.
+
+    Parameters
+    ----------
+    duplicates : list of tuple
+        List of (dropped chunk, kept chunk), the kept chunks having their id.
+
+    Returns
+    -------
+    aliases : dict
+        The citation metadata of the dropped chunks, by id of their kept chunk.
+    """
+    aliases = {}
+    for dropped, kept in duplicates:
+        aliases.setdefault(str(kept.metadata["id"]), []).append(
+            {field: dropped.metadata[field] for field in CITATION_FIELDS if field in dropped.metadata}
+        )
+
+    return aliases
+
+
+def save_aliases(aliases: dict[str, list[dict]], vector_db_path: str) -> None:
+    """Save the aliases next to the vector database.
+
+    Parameters
+    ----------
+    aliases : dict
+        The citation metadata of the dropped chunks, by id of their kept chunk.
+    vector_db_path : str
+        The directory of the vector database.
+    """
+    aliases_path = os.path.join(vector_db_path, ALIASES_FILE)
+    with open(aliases_path, "w", encoding="utf-8") as f:
+        json.dump(aliases, f, ensure_ascii=False)
+
+    logger.info(
+        f"Saved {sum(len(chunk_aliases) for chunk_aliases in aliases.values())} aliases to '{aliases_path}'."
+    )
+
+
+def load_aliases(vector_db_path: str) -> dict[str, list[dict]]:
+    """Load the aliases saved next to the vector database.
+
+    Parameters
+    ----------
+    vector_db_path : str
+        The directory of the vector database.
+
+    Returns
+    -------
+    dict
+        The aliases, empty if the database has no aliases.
+    """
+    aliases_path = os.path.join(vector_db_path, ALIASES_FILE)
+    if not os.path.exists(aliases_path):
+        return {}
+    with open(aliases_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def resolve_aliases(metadatas: list[dict], aliases: dict[str, list[dict]]) -> list[dict]:
+    """Add the metadata of the aliases of the retrieved chunks, to cite their sources too.
+
+    Parameters
+    ----------
+    metadatas : list of dict
+        List of metadata dictionaries of the retrieved chunks.
+    aliases : dict
+        The citation metadata of the dropped chunks, by id of their kept chunk.
+
+    Returns
+    -------
+    list of dict
+        The metadata of the retrieved chunks followed by the metadata of their aliases.
+    """
+    return metadatas + [
+        alias for metadata in metadatas for alias in aliases.get(str(metadata["id"]), [])
+    ]
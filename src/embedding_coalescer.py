@@ -0,0 +1,164 @@
+"""Micro-batching of the query embeddings of concurrent requests.
+
+Each question is embedded with its own single-input request to the embedding API.
+Under concurrent load, the `EmbeddingCoalescer` collects the queries arriving within
+a short window (for example 5 ms), or up to a maximum number of queries, and embeds them
+with one batched call. Each caller waits for its own vector only, so the latency added
+to a request is bounded by the window.
+
+The coalescer is enabled in `load_database` with the following environment variables:
+
+- BIOPYASSISTANT_COALESCE_WINDOW_MS : the batching window, in milliseconds. Default is 0 (disabled).
+- BIOPYASSISTANT_COALESCE_MAX_BATCH : the maximum number of queries of a batch. Default is 32.
+"""
+
+# METADATA
+__authors__ = ("Pierre Poulain", "Essmay Touami")
+__contact__ = "pierre.poulain@u-paris.fr"
+__copyright__ = "BSD-3 clause"
+__date__ = "2024"
+__version__ = "1.0.0"
+
+
+# LIBRARY IMPORTS
+import os
+import time
+import threading
+from concurrent.futures import Future
+from typing import List
+
+from loguru import logger
+from langchain_core.embeddings import Embeddings
+
+
+# CONSTANTS
+COALESCE_WINDOW_MS = float(os.environ.get("BIOPYASSISTANT_COALESCE_WINDOW_MS", 0))
+COALESCE_MAX_BATCH = int(os.environ.get("BIOPYASSISTANT_COALESCE_MAX_BATCH", 32))
+
+
+# CLASSES
+class EmbeddingCoalescer:
+    """Embed the queries of concurrent callers in batches.
+
+    Parameters
+    ----------
+    embedding_function : Embeddings
+        The embedding function, whose `embed_documents` embeds a batch of queries.
+    window : float, optional
+        The time waited after the first query of a batch for other queries, in seconds.
+    max_batch : int, optional
+        The maximum number of queries of a batch: a full batch is sent without waiting.
+    """
+
+    def __init__(
+        self,
+        embedding_function: Embeddings,
+        window: float = COALESCE_WINDOW_MS / 1000,
+        max_batch: int = COALESCE_MAX_BATCH,
+    ) -> None:
+        self.embedding_function = embedding_function
+        self.window = window
+        self.max_batch = max_batch
+        self.nb_queries = 0
+        self.nb_batches = 0
+        self._pending = []
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="embedding-coalescer", daemon=True)
+        self._thread.start()
+
+    def submit(self, text: str) -> Future:
+        """Queue a query to embed.
+
+        Parameters
+        ----------
+        text : str
+            The query text.
+
+        Returns
+        -------
+        Future
+            The future of the embedding of the query.
+        """
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The embedding coalescer is closed.")
+            self._pending.append((text, future))
+            self._condition.notify()
+
+        return future
+
+    def _next_batch(self) -> list:
+        """Wait for a batch of queries: full, or whose window has elapsed."""
+        with self._condition:
+            while not self._pending and not self._closed:
+                self._condition.wait()
+            deadline = time.monotonic() + self.window
+            while len(self._pending) < self.max_batch and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            batch = self._pending[: self.max_batch]
+            del self._pending[: self.max_batch]
+
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+            # Identical queries of a batch are embedded once
+            texts = list(dict.fromkeys(text for text, _future in batch))
+            try:
+                vectors = dict(zip(texts, self.embedding_function.embed_documents(texts)))
+            except Exception as e:
+                for _text, future in batch:
+                    future.set_exception(e)
+                continue
+            self.nb_queries += len(batch)
+            self.nb_batches += 1
+            for text, future in batch:
+                future.set_result(vectors[text])
+
+    def close(self) -> None:
+        """Embed the queued queries and stop the batching thread."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        if self.nb_batches:
+            logger.info(
+                f"Embedded {self.nb_queries} queries in {self.nb_batches} batches "
+                f"({self.nb_queries / self.nb_batches:.1f} queries per call)."
+            )
+
+
+class CoalescingEmbeddings(Embeddings):
+    """Embedding function sending the queries of concurrent callers in batches.
+
+    The documents are embedded directly with the underlying embedding function.
+    """
+
+    def __init__(
+        self,
+        embedding_function: Embeddings,
+        window: float = COALESCE_WINDOW_MS / 1000,
+        max_batch: int = COALESCE_MAX_BATCH,
+    ) -> None:
+        self.embedding_function = embedding_function
+        self.coalescer = EmbeddingCoalescer(embedding_function, window, max_batch)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed documents with the underlying embedding function."""
+        return self.embedding_function.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a query in the next batch of queries."""
+        return self.coalescer.submit(text).result()
+
+    def close(self) -> None:
+        """Stop the batching thread."""
+        self.coalescer.close()
@@ -0,0 +1,330 @@
+"""Single-pass header-aware splitter of the Markdown content, working on offsets.
+
+This splitter gives the same chunks as the two langchain splitters of `create_database.split_text`
+(`MarkdownHeaderTextSplitter` with strip_headers=False, then `RecursiveCharacterTextSplitter`
+with the separators "\\n\\n" and "\\n"), without their intermediate copies:
+
+1. The content is scanned once, line by line, tracking the header stack and the code blocks.
+   The lines are normalized as by `MarkdownHeaderTextSplitter` (stripped, blank lines dropped
+   outside the code blocks, paragraphs of a section joined by "  \\n") and appended to a single
+   buffer, where each section is a (start, end) range with the metadata of its headers.
+2. Each section range is split into pieces at the separators and the pieces are merged into chunks
+   of at most `chunk_size` characters overlapping by up to `chunk_overlap` characters, as by
+   `RecursiveCharacterTextSplitter`. The chunks are (start, end) offsets in the buffer.
+
+The text of a chunk is only sliced from the buffer when its Document is created.
+"""
+
+# METADATA
+__authors__ = ("Pierre Poulain", "Essmay Touami")
+__contact__ = "pierre.poulain@u-paris.fr"
+__copyright__ = "BSD-3 clause"
+__date__ = "2024"
+__version__ = "1.0.0"
+
+
+# LIBRARY IMPORTS
+from typing import Optional, Tuple
+
+from langchain_core.documents import Document
+
+
+# CONSTANTS
+# Metadata name of the headers of each level
+HEADER_NAMES = {
+    1: "chapter_name",
+    2: "section_name",
+    3: "subsection_name",
+    4: "subsubsection_name",
+}
+SEPARATORS = ["\n\n", "\n"]
+# Separator of the paragraphs of a section, as in MarkdownHeaderTextSplitter
+PARAGRAPH_SEPARATOR = "  \n"
+
+
+# FUNCTIONS
+def normalize_line(line: str) -> str:
+    """Strip a line and remove its non-printable characters."""
+    line = line.strip()
+    if not line.isprintable():
+        line = "".join(filter(str.isprintable, line))
+
+    return line
+
+
+def get_header_level(line: str, header_names: dict[int, str]) -> int:
+    """Get the level of a header line, 0 if the line is not a header to split on."""
+    level = len(line) - len(line.lstrip("#"))
+    if level in header_names and (len(line) == level or line[level] == " "):
+        return level
+
+    return 0
+
+
+def build_sections(
+    content: str, header_names: dict[int, str] = HEADER_NAMES
+) -> Tuple[str, list[list]]:
+    """Normalize the Markdown content into a buffer of sections, in one pass.
+
+    Parameters
+    ----------
+    content : str
+        The Markdown content.
+    header_names : dict, optional
+        The metadata name of the headers of each level, by default HEADER_NAMES.
+
+    Returns
+    -------
+    buffer, sections : Tuple[str, list]
+        - buffer : str
+            The normalized content of the sections, one after the other.
+        - sections : list of [int, int, dict]
+            The start and end offsets of each section in the buffer and its metadata.
+    """
+    parts = []
+    sections = []
+    metadata = {}
+    header_stack = []
+    paragraph = []
+    state = {"length": 0, "last_line_is_header": False}
+    in_code_block = False
+    opening_fence = ""
+
+    def add_paragraph() -> None:
+        """Add the lines of the paragraph to the buffer: to the last section or to a new one."""
+        text = "\n".join(paragraph)
+        if sections and (
+            sections[-1][2] == metadata
+            # A section made of headers only is merged with its first subsection
+            or (len(sections[-1][2]) < len(metadata) and state["last_line_is_header"])
+        ):
+            parts.append(PARAGRAPH_SEPARATOR)
+            state["length"] += len(PARAGRAPH_SEPARATOR)
+            sections[-1][2] = dict(metadata)
+        else:
+            sections.append([state["length"], None, dict(metadata)])
+        parts.append(text)
+        state["length"] += len(text)
+        sections[-1][1] = state["length"]
+        state["last_line_is_header"] = paragraph[-1][:1] == "#"
+        paragraph.clear()
+
+    position = 0
+    while position <= len(content):
+        line_end = content.find("\n", position)
+        if line_end == -1:
+            line_end = len(content)
+        line = normalize_line(content[position:line_end])
+        position = line_end + 1
+
+        # Code blocks are kept as they are, headers and blank lines included
+        if not in_code_block:
+            if line.startswith("```") and line.count("```") == 1:
+                in_code_block = True
+                opening_fence = "```"
+            elif line.startswith("~~~"):
+                in_code_block = True
+                opening_fence = "~~~"
+        elif line.startswith(opening_fence):
+            in_code_block = False
+            opening_fence = ""
+        if in_code_block:
+            paragraph.append(line)
+            continue
+
+        level = get_header_level(line, header_names)
+        if level:
+            # A header closes the paragraph, and the headers of the same or lower level
+            if paragraph:
+                add_paragraph()
+            while header_stack and header_stack[-1] >= level:
+                metadata.pop(header_names[header_stack.pop()], None)
+            header_stack.append(level)
+            metadata[header_names[level]] = line[level:].strip()
+            paragraph.append(line)
+        elif line:
+            paragraph.append(line)
+        elif paragraph:
+            add_paragraph()
+    if paragraph:
+        add_paragraph()
+
+    return "".join(parts), sections
+
+
+def strip_span(buffer: str, start: int, end: int) -> Optional[Tuple[int, int]]:
+    """Remove the whitespace at both ends of a span, None if the span is blank."""
+    while start < end and buffer[start].isspace():
+        start += 1
+    while end > start and buffer[end - 1].isspace():
+        end -= 1
+
+    return (start, end) if start < end else None
+
+
+def find_pieces(buffer: str, start: int, end: int, separator: str) -> list[Tuple[int, int]]:
+    """Cut a span before each separator (the separator starts the next piece)."""
+    if not separator:
+        return [(i, i + 1) for i in range(start, end)]
+    pieces = []
+    piece_start = start
+    match = buffer.find(separator, start, end)
+    while match != -1:
+        if match > piece_start:
+            pieces.append((piece_start, match))
+        piece_start = match
+        match = buffer.find(separator, match + len(separator), end)
+    if end > piece_start:
+        pieces.append((piece_start, end))
+
+    return pieces
+
+
+def merge_pieces(
+    buffer: str, pieces: list[Tuple[int, int]], chunk_size: int, chunk_overlap: int
+) -> list[Tuple[int, int]]:
+    """Merge consecutive pieces into overlapping chunks of at most `chunk_size` characters.
+
+    A chunk is closed when the next piece does not fit, and the next chunk starts
+    with the last pieces of the closed chunk, up to `chunk_overlap` characters.
+    """
+    chunks = []
+    first = 0
+    total = 0
+    for i, (start, end) in enumerate(pieces):
+        length = end - start
+        if total + length > chunk_size:
+            if i > first:
+                span = strip_span(buffer, pieces[first][0], pieces[i - 1][1])
+                if span is not None:
+                    chunks.append(span)
+                # Keep the last pieces of the chunk as the overlap of the next one
+                while total > chunk_overlap or (total + length > chunk_size and total > 0):
+                    total -= pieces[first][1] - pieces[first][0]
+                    first += 1
+        total += length
+    if first < len(pieces):
+        span = strip_span(buffer, pieces[first][0], pieces[-1][1])
+        if span is not None:
+            chunks.append(span)
+
+    return chunks
+
+
+def split_span(
+    buffer: str,
+    start: int,
+    end: int,
+    chunk_size: int,
+    chunk_overlap: int,
+    separators: list[str] = SEPARATORS,
+) -> list[Tuple[int, int]]:
+    """Split a span of the buffer into chunks, at the first separator found in the span.
+
+    The pieces longer than the chunk size are split again at the next separators.
+
+    Parameters
+    ----------
+    buffer : str
+        The normalized content.
+    start, end : int
+        The offsets of the span.
+    chunk_size : int
+        The maximum size of the chunks.
+    chunk_overlap : int
+        The maximum overlap between consecutive chunks.
+    separators : list of str, optional
+        The separators, by order of preference, by default SEPARATORS.
+
+    Returns
+    -------
+    list of tuple
+        The (start, end) offsets of the chunks.
+    """
+    separator = separators[-1]
+    next_separators = []
+    for i, candidate in enumerate(separators):
+        if candidate == "":
+            separator = candidate
+            break
+        if buffer.find(candidate, start, end) != -1:
+            separator = candidate
+            next_separators = separators[i + 1 :]
+            break
+
+    chunks = []
+    short_pieces = []
+    for piece_start, piece_end in find_pieces(buffer, start, end, separator):
+        if piece_end - piece_start < chunk_size:
+            short_pieces.append((piece_start, piece_end))
+            continue
+        if short_pieces:
+            chunks.extend(merge_pieces(buffer, short_pieces, chunk_size, chunk_overlap))
+            short_pieces = []
+        if not next_separators:
+            chunks.append((piece_start, piece_end))
+        else:
+            chunks.extend(
+                split_span(buffer, piece_start, piece_end, chunk_size, chunk_overlap, next_separators)
+            )
+    if short_pieces:
+        chunks.extend(merge_pieces(buffer, short_pieces, chunk_size, chunk_overlap))
+
+    return chunks
+
+
+def split_markdown_offsets(
+    content: str, chunk_size: int, chunk_overlap: int
+) -> Tuple[str, list[Tuple[int, int, dict]]]:
+    """Split the Markdown content into chunks given as offsets.
+
+    Parameters
+    ----------
+    content : str
+        The Markdown content.
+    chunk_size : int
+        The maximum size of the chunks.
+    chunk_overlap : int
+        The maximum overlap between consecutive chunks.
+
+    Returns
+    -------
+    buffer, chunks : Tuple[str, list]
+        - buffer : str
+            The normalized content.
+        - chunks : list of (int, int, dict)
+            The start and end offsets of each chunk in the buffer
+            and the metadata of its headers (shared by the chunks of a section).
+    """
+    buffer, sections = build_sections(content)
+    chunks = []
+    for start, end, metadata in sections:
+        for chunk_start, chunk_end in split_span(buffer, start, end, chunk_size, chunk_overlap):
+            chunks.append((chunk_start, chunk_end, metadata))
+
+    return buffer, chunks
+
+
+def split_markdown(content: str, chunk_size: int, chunk_overlap: int) -> list[Document]:
+    """Split the Markdown content into chunks, as the langchain splitters of `split_text`.
+
+    Parameters
+    ----------
+    content : str
+        The Markdown content.
+    chunk_size : int
+        The maximum size of the chunks.
+    chunk_overlap : int
+        The maximum overlap between consecutive chunks.
+
+    Returns
+    -------
+    list of Document
+        The chunks, with the metadata of their headers.
+    """
+    buffer, chunks = split_markdown_offsets(content, chunk_size, chunk_overlap)
+
+    return [
+        Document(page_content=buffer[start:end], metadata=dict(metadata))
+        for start, end, metadata in chunks
+    ]
@@ -0,0 +1,67 @@
+"""Read and write the configuration stored next to a vector database.
+
+The configuration records how the database was built (embedding provider, model, dimension...)
+so that the query side uses the same embedding function as the build.
+It is saved as a JSON file in the directory of the database.
+"""
+
+# METADATA
+__authors__ = ("Pierre Poulain", "Essmay Touami")
+__contact__ = "pierre.poulain@u-paris.fr"
+__copyright__ = "BSD-3 clause"
+__date__ = "2024"
+__version__ = "1.0.0"
+
+
+# LIBRARY IMPORTS
+import os
+import json
+
+from loguru import logger
+
+
+# CONSTANTS
+INDEX_CONFIG_FILE = "index_config.json"
+
+
+# FUNCTIONS
+def write_index_config(vector_db_path: str, config: dict) -> None:
+    """Write the configuration of a vector database.
+
+    Existing keys of the configuration are updated, other keys are kept.
+
+    Parameters
+    ----------
+    vector_db_path : str
+        The directory of the vector database.
+    config : dict
+        The configuration to save.
+    """
+    config_path = os.path.join(vector_db_path, INDEX_CONFIG_FILE)
+    index_config = read_index_config(vector_db_path)
+    index_config.update(config)
+    with open(config_path, "w", encoding="utf-8") as f:
+        json.dump(index_config, f, indent=2)
+
+    logger.info(f"Saved the database configuration to '{config_path}'.")
+
+
+def read_index_config(vector_db_path: str) -> dict:
+    """Read the configuration of a vector database.
+
+    Parameters
+    ----------
+    vector_db_path : str
+        The directory of the vector database.
+
+    Returns
+    -------
+    dict
+        The configuration of the database, empty if the database has no configuration file
+        (databases built before the configuration file was introduced).
+    """
+    config_path = os.path.join(vector_db_path, INDEX_CONFIG_FILE)
+    if not os.path.exists(config_path):
+        return {}
+    with open(config_path, "r", encoding="utf-8") as f:
+        return json.load(f)
@@ -0,0 +1,363 @@
+"""Hot reload of the vector database in long-running query processes.
+
+`load_database` opens the version of the database published when it is called
+(see `index_versions.py`). A long-running process would keep this version forever:
+the `IndexReloader` polls the published version, loads a newly published version
+in a background thread, and swaps it in between requests:
+
+    reloader = IndexReloader("chroma_db")
+    reloader.start()
+    with reloader.acquire() as vector_db:
+        relevant_chunks = search_similarity_in_database(vector_db, query)
+
+Each request holds a reference to the index it acquired, so in-flight requests finish
+on the old index, which is closed when its last request releases it. Callbacks registered
+with `add_invalidation_callback` are called after each swap, to invalidate the cache entries
+tied to the old version.
+
+Usage:
+======
+    python src/index_reloader.py --chroma-path [chroma-path] [--poll-interval poll-interval] [--deadline deadline] [--model model]
+
+Arguments:
+==========
+    --chroma-path : str (optional)
+        The path of the published database. Default is chroma_db.
+    --poll-interval : float (optional)
+        The interval between two checks of the published version, in seconds. Default is 5.
+    --deadline : float (optional)
+        The time budget of each request, in seconds. Default is 10.
+    --model : str (optional)
+        The chat model answering each query. Default is to only search the relevant chunks.
+
+Example:
+========
+    python src/index_reloader.py --chroma-path chroma_db
+
+This command will read queries from the standard input, one per line, and display the ids of
+the relevant chunks and the version of the database used, reloading the database
+when a new version is published. The requests run within their deadline: when the
+embedding or chat API fails or is too slow, they fall back to the degraded mode
+(lexical search, excerpts answer), and the circuit of a failing API opens for all the
+next requests of the process (see `deadlines.py`).
+"""
+
+# METADATA
+__authors__ = ("Pierre Poulain", "Essmay Touami")
+__contact__ = "pierre.poulain@u-paris.fr"
+__copyright__ = "BSD-3 clause"
+__date__ = "2024"
+__version__ = "1.0.0"
+
+
+# LIBRARY IMPORTS
+import os
+import gc
+import sys
+import argparse
+import threading
+from functools import partial
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional, Tuple
+
+from loguru import logger
+
+# MODULE IMPORTS
+from index_versions import resolve_index_path
+from deadlines import Deadline
+from providers import DEFAULT_PROVIDER
+from query_chatbot import (
+    CHROMA_PATH,
+    RETRIEVAL_BUDGET,
+    load_database,
+    get_metadata,
+    search_with_deadline,
+    answer_with_deadline,
+)
+from vector_store import release_chroma
+
+
+# CONSTANTS
+POLL_INTERVAL = 5.0
+DEADLINE = 10.0
+
+
+# CLASSES
+class IndexHandle:
+    """A loaded version of the database and the number of requests using it."""
+
+    def __init__(self, version: str, vector_db: Any, nb_chunks: int) -> None:
+        self.version = version
+        self.vector_db = vector_db
+        self.nb_chunks = nb_chunks
+        self.refcount = 0
+        self.retired = False
+
+    def close(self) -> None:
+        """Release the database: its Chroma client and its memory-mapped files."""
+        # Databases searched by worker processes stop their workers
+        if hasattr(self.vector_db, "close"):
+            self.vector_db.close()
+        # The wrapping vector stores keep the Chroma database in their `chroma` attribute
+        release_chroma(getattr(self.vector_db, "chroma", self.vector_db))
+        self.vector_db = None
+        # The memory-mapped embeddings are unmapped once their arrays are collected
+        gc.collect()
+        logger.info(f"Closed the version '{os.path.basename(self.version)}' of the database.")
+
+
+class IndexReloader:
+    """Reload the vector database when a new version is published.
+
+    Parameters
+    ----------
+    chroma_path : str
+        The path of the published database.
+    poll_interval : float, optional
+        The interval between two checks of the published version, in seconds.
+    loader : callable, optional
+        The function loading a database from its path, returning (database, number of chunks),
+        by default `load_database`.
+    """
+
+    def __init__(
+        self,
+        chroma_path: str,
+        poll_interval: float = POLL_INTERVAL,
+        loader: Callable[[str], Tuple[Any, int]] = load_database,
+    ) -> None:
+        self.chroma_path = chroma_path
+        self.poll_interval = poll_interval
+        self.loader = loader
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._failed_version = None
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._handle = self._load(resolve_index_path(chroma_path))
+
+    @property
+    def version(self) -> str:
+        """The version of the database used by the new requests."""
+        return self._handle.version
+
+    def _load(self, version: str) -> IndexHandle:
+        vector_db, nb_chunks = self.loader(version)
+
+        return IndexHandle(version, vector_db, nb_chunks)
+
+    def add_invalidation_callback(self, callback: Callable[[str, str], None]) -> None:
+        """Register a function called with (old version, new version) after each swap."""
+        self._callbacks.append(callback)
+
+    def start(self) -> None:
+        """Start polling the published version in a background thread."""
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._watch, name="index-reloader", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop polling the published version."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _watch(self) -> None:
+        while not self._stop_event.wait(self.poll_interval):
+            self.check()
+
+    def check(self) -> bool:
+        """Load and swap in the published version if it changed.
+
+        Returns
+        -------
+        bool
+            True if a new version was swapped in.
+        """
+        version = resolve_index_path(self.chroma_path)
+        if version == self._handle.version or version == self._failed_version:
+            return False
+        logger.info(f"New version of the database published: '{os.path.basename(version)}'.")
+        try:
+            handle = self._load(version)
+        except Exception as e:
+            # The current version keeps serving the requests
+            logger.error(f"Failed to load the version '{os.path.basename(version)}': {e}")
+            self._failed_version = version
+            return False
+        self._swap(handle)
+
+        return True
+
+    def _swap(self, handle: IndexHandle) -> None:
+        with self._lock:
+            old_handle = self._handle
+            self._handle = handle
+            old_handle.retired = True
+            close_old_handle = old_handle.refcount == 0
+        if close_old_handle:
+            old_handle.close()
+        for callback in self._callbacks:
+            callback(old_handle.version, handle.version)
+        logger.success(
+            f"Swapped in the version '{os.path.basename(handle.version)}' "
+            f"of the database ({handle.nb_chunks} chunks)."
+        )
+
+    @contextmanager
+    def acquire(self) -> Iterator[Any]:
+        """Use the current version of the database for a request.
+
+        Yields
+        ------
+        The vector database, which stays open until the end of the request
+        even if a new version is swapped in meanwhile.
+        """
+        with self._lock:
+            handle = self._handle
+            handle.refcount += 1
+        try:
+            yield handle.vector_db
+        finally:
+            with self._lock:
+                handle.refcount -= 1
+                close_handle = handle.retired and handle.refcount == 0
+            if close_handle:
+                handle.close()
+
+
+# FUNCTIONS
+def answer_request(
+    vector_db: Any,
+    query: str,
+    deadline: Deadline,
+    model_name: Optional[str] = None,
+    provider: str = DEFAULT_PROVIDER,
+) -> Tuple[list[int], bool, Optional[str]]:
+    """Search the relevant chunks of a query and optionally answer it, within a deadline.
+
+    Parameters
+    ----------
+    vector_db : Chroma or ChunkVectorStore
+        The vector database.
+    query : str
+        The query text.
+    deadline : Deadline
+        The deadline of the request.
+    model_name : str, optional
+        The chat model answering the query, by default None (no answer).
+    provider : str, optional
+        The chat model provider, by default DEFAULT_PROVIDER.
+
+    Returns
+    -------
+    chunk_ids, lexical, answer : Tuple[list, bool, str]
+        - chunk_ids : list of int
+            The ids of the relevant chunks.
+        - lexical : bool
+            Whether the chunks come from the lexical search (degraded mode).
+        - answer : str or None
+            The answer (excerpts in the degraded mode), None without model or relevant chunks.
+    """
+    scored_chunks, lexical = search_with_deadline(vector_db, query, deadline)
+    relevant_chunks = [chunk for chunk, _score in scored_chunks]
+    answer = None
+    if model_name is not None and relevant_chunks:
+        metadatas = get_metadata(relevant_chunks, getattr(vector_db, "chunk_store", None))
+        answer = answer_with_deadline(
+            query, relevant_chunks, metadatas, model_name, deadline, provider
+        )[0]
+
+    return [chunk.metadata["id"] for chunk in relevant_chunks], lexical, answer
+
+
+def get_args() -> Tuple[str, float, float, Optional[str]]:
+    """Parse command-line arguments.
+
+    Returns
+    -------
+    chroma_path, poll_interval, deadline, model_name : Tuple[str, float, float, str]
+        - chroma_path : str
+            The path of the published database.
+        - poll_interval : float
+            The interval between two checks of the published version, in seconds.
+        - deadline : float
+            The time budget of each request, in seconds.
+        - model_name : str or None
+            The chat model answering each query.
+    """
+    parser = argparse.ArgumentParser(
+        description="Search the database from the standard input, reloading new versions."
+    )
+    parser.add_argument(
+        "--chroma-path",
+        dest="chroma_path",
+        default=CHROMA_PATH,
+        help="The path of the published database.",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        dest="poll_interval",
+        type=float,
+        default=POLL_INTERVAL,
+        help="The interval between two checks of the published version, in seconds.",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        default=DEADLINE,
+        help="The time budget of each request, in seconds.",
+    )
+    parser.add_argument(
+        "--model",
+        dest="model_name",
+        default=None,
+        help="The chat model answering each query (default: only search the relevant chunks).",
+    )
+    args = parser.parse_args()
+
+    # Checks
+    if not os.path.exists(args.chroma_path):
+        logger.error(f"The database '{args.chroma_path}' does not exist.")
+        sys.exit(1)
+    if args.deadline <= 0:
+        logger.error("The deadline should be positive.")
+        sys.exit(1)
+
+    return args.chroma_path, args.poll_interval, args.deadline, args.model_name
+
+
+def main() -> None:
+    """Search the database for each query of the standard input."""
+    chroma_path, poll_interval, deadline, model_name = get_args()
+
+    # The embedding calls are not retried and give up with the search
+    loader = partial(load_database, api_timeout=RETRIEVAL_BUDGET)
+    reloader = IndexReloader(chroma_path, poll_interval, loader)
+    reloader.start()
+    try:
+        for line in sys.stdin:
+            query = line.strip()
+            if not query:
+                continue
+            with reloader.acquire() as vector_db:
+                chunk_ids, lexical, answer = answer_request(
+                    vector_db, query, Deadline(deadline), model_name
+                )
+            search_mode = "lexical" if lexical else "semantic"
+            print(
+                f"{os.path.basename(reloader.version)}\t{query}\t{chunk_ids}\t{search_mode}",
+                flush=True,
+            )
+            if answer is not None:
+                print(answer, flush=True)
+    finally:
+        reloader.stop()
+
+
+# MAIN PROGRAM
+if __name__ == "__main__":
+    main()
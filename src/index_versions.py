@@ -0,0 +1,387 @@
+"""Versioned builds of the vector database, published by an atomic switch.
+
+Each build of the database is written to a new directory of `[chroma-path]_versions/`,
+with a manifest (hash of the inputs, build parameters, counts). Once the build is complete,
+it is published by atomically replacing the `current` symbolic link of this directory.
+The `[chroma-path]` path itself is a symbolic link to `current`, so the scripts opening
+`[chroma-path]` always see a complete database, even during a rebuild:
+
+    chroma_db -> chroma_db_versions/current
+    chroma_db_versions/
+        current -> 20241018T101500-4821
+        20241018T101500-4821/    (manifest.json, Chroma files, embeddings.npy...)
+        20241017T163012-1377/
+
+The last versions are kept to roll back instantly to a previous build. The manifest is
+written last: a directory without manifest is a build still running, or a build killed before
+its end (the removal of a failed build is skipped on SIGKILL or on a power loss). It is never
+listed, published or kept as a version, and is removed once its build process has ended.
+
+Usage:
+======
+    python src/index_versions.py --chroma-path [chroma-path] [--rollback [version]]
+
+Arguments:
+==========
+    --chroma-path : str
+        The path of the published database.
+    --rollback : str (optional)
+        Publish again a previous version: the given one, or the version built
+        before the current one if no version is given.
+
+Example:
+========
+    python src/index_versions.py --chroma-path chroma_db --rollback
+
+This command will list the versions of the `chroma_db` database and publish again the previous version.
+"""
+
+# METADATA
+__authors__ = ("Pierre Poulain", "Essmay Touami")
+__contact__ = "pierre.poulain@u-paris.fr"
+__copyright__ = "BSD-3 clause"
+__date__ = "2024"
+__version__ = "1.0.0"
+
+
+# LIBRARY IMPORTS
+import os
+import sys
+import glob
+import json
+import errno
+import shutil
+import hashlib
+import argparse
+from datetime import datetime
+
+from loguru import logger
+
+
+# CONSTANTS
+VERSIONS_SUFFIX = "_versions"
+CURRENT_LINK = "current"
+MANIFEST_FILE = "manifest.json"
+LEGACY_VERSION = "00000000T000000-legacy"
+KEEP_VERSIONS = 3
+
+
+# FUNCTIONS
+def get_versions_dir(chroma_path: str) -> str:
+    """Get the directory of the versions of a database."""
+    return os.path.normpath(chroma_path) + VERSIONS_SUFFIX
+
+
+def resolve_index_path(chroma_path: str) -> str:
+    """Resolve the directory of the version of a database published at the time of the call.
+
+    The files of the database should be opened from the resolved path, so that they all
+    belong to the same version even if a new version is published meanwhile.
+
+    Parameters
+    ----------
+    chroma_path : str
+        The path of the published database (or of a database without versions).
+
+    Returns
+    -------
+    str
+        The real path of the published version.
+    """
+    # While a database built before the versions is moved into them (see `publish_version`),
+    # the path is missing for an instant but the current link is already published
+    current_link = os.path.join(get_versions_dir(chroma_path), CURRENT_LINK)
+    if not os.path.lexists(chroma_path) and os.path.islink(current_link):
+        return os.path.realpath(current_link)
+
+    return os.path.realpath(chroma_path)
+
+
+def hash_inputs(data_path: str) -> str:
+    """Hash the names and the contents of the Markdown files used to build a database.
+
+    Parameters
+    ----------
+    data_path : str
+        The directory containing the processed Markdown files.
+
+    Returns
+    -------
+    str
+        The SHA-256 hash of the inputs.
+    """
+    inputs_hash = hashlib.sha256()
+    for file_path in sorted(glob.glob(os.path.join(data_path, "*.md"))):
+        inputs_hash.update(os.path.basename(file_path).encode("utf-8"))
+        with open(file_path, "rb") as f:
+            inputs_hash.update(f.read())
+
+    return inputs_hash.hexdigest()
+
+
+def create_version_dir(chroma_path: str) -> str:
+    """Get the path of the directory of a new version of a database.
+
+    Parameters
+    ----------
+    chroma_path : str
+        The path of the published database.
+
+    Returns
+    -------
+    str
+        The path of the new version directory (not created: Chroma creates it).
+    """
+    versions_dir = get_versions_dir(chroma_path)
+    os.makedirs(versions_dir, exist_ok=True)
+    version = f"{datetime.now():%Y%m%dT%H%M%S}-{os.getpid()}"
+
+    return os.path.join(versions_dir, version)
+
+
+def write_manifest(version_path: str, manifest: dict) -> None:
+    """Write the manifest of a version.
+
+    Parameters
+    ----------
+    version_path : str
+        The directory of the version.
+    manifest : dict
+        The hash of the inputs, the parameters and the counts of the build.
+    """
+    manifest = {
+        "version": os.path.basename(version_path),
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        **manifest,
+    }
+    with open(os.path.join(version_path, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def read_manifest(version_path: str) -> dict:
+    """Read the manifest of a version, empty if the version has no manifest."""
+    manifest_path = os.path.join(version_path, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def list_version_dirs(chroma_path: str) -> list[str]:
+    """List the directories of the versions of a database, complete or not (links excluded)."""
+    versions_dir = get_versions_dir(chroma_path)
+    if not os.path.isdir(versions_dir):
+        return []
+
+    return sorted(
+        name
+        for name in os.listdir(versions_dir)
+        if os.path.isdir(os.path.join(versions_dir, name))
+        and not os.path.islink(os.path.join(versions_dir, name))
+    )
+
+
+def is_complete_version(version_path: str) -> bool:
+    """Check that the build of a version is complete, i.e. that its manifest is written."""
+    # The legacy version is a complete database moved at once (see `publish_version`)
+    if os.path.basename(version_path) == LEGACY_VERSION:
+        return True
+
+    return os.path.isfile(os.path.join(version_path, MANIFEST_FILE))
+
+
+def list_versions(chroma_path: str) -> list[str]:
+    """List the complete versions of a database, from the oldest to the most recent."""
+    versions_dir = get_versions_dir(chroma_path)
+
+    return [
+        name
+        for name in list_version_dirs(chroma_path)
+        if is_complete_version(os.path.join(versions_dir, name))
+    ]
+
+
+def is_build_running(version: str) -> bool:
+    """Check whether the process building a version (the pid ending its name) is still running.
+
+    The versions whose process cannot be checked are considered as running.
+    """
+    pid = version.rsplit("-", 1)[-1]
+    # os.kill(pid, 0) terminates the process on Windows
+    if not pid.isdigit() or os.name != "posix":
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+
+    return True
+
+
+def list_incomplete_builds(chroma_path: str) -> list[str]:
+    """List the directories of the builds of a database that ended without a manifest."""
+    versions_dir = get_versions_dir(chroma_path)
+
+    return [
+        name
+        for name in list_version_dirs(chroma_path)
+        if not is_complete_version(os.path.join(versions_dir, name)) and not is_build_running(name)
+    ]
+
+
+def get_current_version(chroma_path: str) -> str:
+    """Get the published version of a database, None if no version is published."""
+    current_link = os.path.join(get_versions_dir(chroma_path), CURRENT_LINK)
+    if not os.path.islink(current_link):
+        return None
+
+    return os.readlink(current_link)
+
+
+def switch_link(link_path: str, target: str) -> None:
+    """Atomically point a symbolic link to a target.
+
+    A temporary link is created and renamed over the link: the rename is atomic,
+    so the link always points either to the old target or to the new one.
+    """
+    tmp_link = f"{link_path}.tmp-{os.getpid()}"
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(target, tmp_link)
+    os.replace(tmp_link, link_path)
+
+
+def publish_version(chroma_path: str, version_path: str, keep_versions: int = KEEP_VERSIONS) -> None:
+    """Publish a complete version of a database and remove the oldest versions.
+
+    Parameters
+    ----------
+    chroma_path : str
+        The path of the published database.
+    version_path : str
+        The directory of the version to publish.
+    keep_versions : int
+        The number of versions kept for rollback (including the published one).
+    """
+    versions_dir = get_versions_dir(chroma_path)
+    chroma_path = os.path.normpath(chroma_path)
+
+    # Atomic switch of the published version
+    switch_link(os.path.join(versions_dir, CURRENT_LINK), os.path.basename(version_path))
+    if not os.path.islink(chroma_path):
+        # The link is created under a temporary name, then renamed over the path
+        tmp_link = f"{chroma_path}.tmp-{os.getpid()}"
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(os.path.join(os.path.basename(versions_dir), CURRENT_LINK), tmp_link)
+        # A database built before the versions is moved into the versions once.
+        # A directory cannot be replaced by a link: until the link is renamed over the path,
+        # `resolve_index_path` resolves the current link, already published above.
+        if os.path.isdir(chroma_path):
+            logger.info(f"Moving the existing database '{chroma_path}' to the '{LEGACY_VERSION}' version.")
+            os.replace(chroma_path, os.path.join(versions_dir, LEGACY_VERSION))
+            write_manifest(os.path.join(versions_dir, LEGACY_VERSION), {"legacy": True})
+        os.replace(tmp_link, chroma_path)
+    logger.success(f"Published the version '{os.path.basename(version_path)}' as '{chroma_path}'.")
+
+    # Remove the builds killed before their end
+    for version in list_incomplete_builds(chroma_path):
+        shutil.rmtree(os.path.join(versions_dir, version), ignore_errors=True)
+        logger.info(f"Removed the incomplete build '{version}'.")
+
+    # Keep the last complete versions for rollback
+    current_version = os.path.basename(version_path)
+    old_versions = [version for version in list_versions(chroma_path) if version != current_version]
+    for version in old_versions[: max(len(old_versions) - (keep_versions - 1), 0)]:
+        shutil.rmtree(os.path.join(versions_dir, version))
+        logger.info(f"Removed the old version '{version}'.")
+
+
+def rollback(chroma_path: str, version: str = None) -> str:
+    """Publish again a previous version of a database.
+
+    Parameters
+    ----------
+    chroma_path : str
+        The path of the published database.
+    version : str, optional
+        The version to publish, by default the version preceding the published one.
+
+    Returns
+    -------
+    str
+        The published version.
+    """
+    versions = list_versions(chroma_path)
+    current_version = get_current_version(chroma_path)
+    if version is None:
+        previous_versions = [v for v in versions if v < current_version] if current_version else []
+        if not previous_versions:
+            raise ValueError("There is no version before the published one.")
+        version = previous_versions[-1]
+    if version not in versions:
+        raise ValueError(f"The version '{version}' does not exist or is incomplete.")
+    switch_link(os.path.join(get_versions_dir(chroma_path), CURRENT_LINK), version)
+    logger.success(f"Rolled back '{chroma_path}' to the version '{version}'.")
+
+    return version
+
+
+def get_args() -> tuple[str, bool, str]:
+    """Parse command-line arguments.
+
+    Returns
+    -------
+    chroma_path, rollback_flag, version : Tuple[str, bool, str]
+        - chroma_path : str
+            The path of the published database.
+        - rollback_flag : bool
+            Flag to roll back to a previous version.
+        - version : str or None
+            The version to roll back to (None for the previous one).
+    """
+    parser = argparse.ArgumentParser(description="List and roll back the versions of a database.")
+    parser.add_argument(
+        "--chroma-path",
+        dest="chroma_path",
+        required=True,
+        help="The path of the published database.",
+    )
+    parser.add_argument(
+        "--rollback",
+        nargs="?",
+        const="",
+        default=None,
+        help="Publish again the given version, or the previous one.",
+    )
+    args = parser.parse_args()
+
+    return args.chroma_path, args.rollback is not None, args.rollback or None
+
+
+def main() -> None:
+    """List the versions of a database and optionally roll back."""
+    chroma_path, rollback_flag, version = get_args()
+
+    if rollback_flag:
+        try:
+            rollback(chroma_path, version)
+        except ValueError as e:
+            logger.error(e)
+            sys.exit(1)
+
+    current_version = get_current_version(chroma_path)
+    for version in list_incomplete_builds(chroma_path):
+        logger.warning(f"The build '{version}' ended without a manifest: it is not a version.")
+    for version in list_versions(chroma_path):
+        manifest = read_manifest(os.path.join(get_versions_dir(chroma_path), version))
+        marker = "*" if version == current_version else " "
+        print(
+            f"{marker} {version:<24} {manifest.get('counts', {}).get('nb_chunks', '?'):>6} chunks"
+            f"   inputs {manifest.get('inputs_hash', '?')[:12]}"
+        )
+
+
+# MAIN PROGRAM
+if __name__ == "__main__":
+    main()
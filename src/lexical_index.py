@@ -0,0 +1,170 @@
+"""Local lexical index of the chunks, searched when the embedding API is unavailable.
+
+The chunks are indexed with the BM25 ranking function over their words
+(lowercased and without accents), in an inverted index held in memory.
+The index is built from the texts stored in the database, without any API call,
+the first time the lexical search of a database is needed.
+
+The BM25 scores are divided by the highest score the words of the query could reach,
+so that the scores are in [0, 1] and the chunks sharing only a few common words
+with the query (scoring below a minimum) are not returned, as the chunks below
+the score threshold of the semantic search.
+"""
+
+# METADATA
+__authors__ = ("Pierre Poulain", "Essmay Touami")
+__contact__ = "pierre.poulain@u-paris.fr"
+__copyright__ = "BSD-3 clause"
+__date__ = "2024"
+__version__ = "1.0.0"
+
+
+# LIBRARY IMPORTS
+import re
+import threading
+import unicodedata
+from collections import Counter
+from typing import Any, Optional, Tuple
+from weakref import WeakKeyDictionary
+
+import numpy as np
+from loguru import logger
+
+
+# CONSTANTS
+BM25_K1 = 1.5
+BM25_B = 0.75
+MIN_WORD_LENGTH = 2
+# Minimum normalized BM25 score of a relevant chunk: the questions sharing only
+# common words with the course score below 0.05, the related ones above 0.1
+LEXICAL_SCORE_THRESHOLD = 0.1
+# Lexical indexes of the loaded databases
+_lexical_indexes = WeakKeyDictionary()
+_lexical_indexes_lock = threading.Lock()
+
+
+# CLASSES
+class LexicalIndex:
+    """BM25 inverted index of texts.
+
+    Parameters
+    ----------
+    ids : list of int
+        The ids of the texts.
+    texts : list of str
+        The texts to index.
+    """
+
+    def __init__(self, ids: list[int], texts: list[str]) -> None:
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.nb_texts = len(texts)
+        postings = {}
+        lengths = np.zeros(len(texts), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = tokenize(text)
+            lengths[row] = len(words)
+            for word, count in Counter(words).items():
+                postings.setdefault(word, ([], []))
+                postings[word][0].append(row)
+                postings[word][1].append(count)
+        # Normalized length of each text, part of the BM25 denominator
+        length_norms = BM25_K1 * (1 - BM25_B + BM25_B * lengths / max(lengths.mean(), 1))
+        self.postings = {}
+        self.idfs = {}
+        for word, (rows, counts) in postings.items():
+            rows = np.array(rows, dtype=np.int64)
+            counts = np.array(counts, dtype=np.float32)
+            self.idfs[word] = self.get_idf(len(rows))
+            # BM25 weight of the word in each text containing it
+            self.postings[word] = (
+                rows,
+                self.idfs[word] * counts * (BM25_K1 + 1) / (counts + length_norms[rows]),
+            )
+
+    def get_idf(self, nb_texts_with_word: int) -> float:
+        """Get the inverse document frequency of a word found in a number of texts."""
+        return float(
+            np.log(1 + (self.nb_texts - nb_texts_with_word + 0.5) / (nb_texts_with_word + 0.5))
+        )
+
+    def search(
+        self,
+        query: str,
+        k: int,
+        rows: Optional[np.ndarray] = None,
+        min_score: float = LEXICAL_SCORE_THRESHOLD,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Search the texts matching the words of a query.
+
+        Parameters
+        ----------
+        query : str
+            The query text.
+        k : int
+            The number of texts to return.
+        rows : np.ndarray, optional
+            The ids of the texts to search, by default all the texts.
+        min_score : float, optional
+            The minimum normalized score of the returned texts, by default LEXICAL_SCORE_THRESHOLD.
+
+        Returns
+        -------
+        tuple of np.ndarray
+            The ids of the best k texts and their normalized BM25 scores in [0, 1],
+            by decreasing score (texts scoring below `min_score` or without any word
+            of the query are not returned).
+        """
+        words = set(tokenize(query))
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for word in words:
+            if word in self.postings:
+                word_rows, weights = self.postings[word]
+                scores[word_rows] += weights
+        # The BM25 weight of a word is below idf * (k1 + 1): the words of the query
+        # absent from the texts count with the idf of a word found in no text
+        max_score = sum(self.idfs.get(word, self.get_idf(0)) for word in words) * (BM25_K1 + 1)
+        scores /= max(max_score, 1e-6)
+        if rows is not None:
+            scores[~np.isin(self.ids, rows)] = 0
+        best = np.argsort(-scores)[:k]
+        best = best[(scores[best] > 0) & (scores[best] >= min_score)]
+
+        return self.ids[best], scores[best]
+
+
+# FUNCTIONS
+def tokenize(text: str) -> list[str]:
+    """Split a text into lowercased words without accents."""
+    text = unicodedata.normalize("NFKD", text.lower()).encode("ascii", "ignore").decode("ascii")
+
+    return [word for word in re.findall(r"\w+", text) if len(word) >= MIN_WORD_LENGTH]
+
+
+def get_lexical_index(vector_db: Any) -> LexicalIndex:
+    """Get the lexical index of a database, built from its texts on first use.
+
+    Parameters
+    ----------
+    vector_db : Chroma or ChunkVectorStore
+        The vector database.
+
+    Returns
+    -------
+    LexicalIndex
+        The lexical index of the chunks of the database.
+    """
+    with _lexical_indexes_lock:
+        if vector_db not in _lexical_indexes:
+            chunk_store = getattr(vector_db, "chunk_store", None)
+            if chunk_store is not None:
+                ids = chunk_store.arrays["id"]
+                texts = [chunk_store.get_text(row) for row in range(len(chunk_store))]
+            else:
+                # The Chroma ids of the databases built before the chunk store are not the chunk ids
+                results = vector_db.get(include=["documents", "metadatas"])
+                ids = [metadata["id"] for metadata in results["metadatas"]]
+                texts = results["documents"]
+            _lexical_indexes[vector_db] = LexicalIndex(ids, texts)
+            logger.info(f"Built the lexical index of {len(texts)} chunks.")
+
+        return _lexical_indexes[vector_db]
@@ -0,0 +1,213 @@
+"""Inverted index from chunk metadata values to chunk ids.
+
+The index is built when the database is created and saved next to it as a JSON file:
+
+    {"file_name": {"05_boucles": [120, 121, ...], ...},
+     "chapter_name": {...},
+     "section_name": {...}}
+
+It gives the ids of the chunks of a chapter, an appendix or a section without scanning
+the metadata of the whole collection, so that a filtered search only scans these chunks.
+The index is built from the interned string columns of the chunk store. The chunks
+dropped as near-duplicates (see `dedup.py`) are indexed as their kept chunk, so that
+a filtered search still finds their text in their own chapters and sections.
+"""
+
+# METADATA
+__authors__ = ("Pierre Poulain", "Essmay Touami")
+__contact__ = "pierre.poulain@u-paris.fr"
+__copyright__ = "BSD-3 clause"
+__date__ = "2024"
+__version__ = "1.0.0"
+
+
+# LIBRARY IMPORTS
+import os
+import json
+from typing import Optional, Union
+
+import numpy as np
+from loguru import logger
+from langchain_core.documents import Document
+
+# MODULE IMPORTS
+from chunk_store import ChunkStore
+
+
+# CONSTANTS
+METADATA_INDEX_FILE = "metadata_index.json"
+INDEXED_FIELDS = ("file_name", "chapter_name", "section_name")
+
+
+# FUNCTIONS
+def build_metadata_index(chunk_store: ChunkStore) -> dict[str, dict[str, list[int]]]:
+    """Build the inverted index of the metadata of the chunks.
+
+    Parameters
+    ----------
+    chunk_store : ChunkStore
+        The store of the chunks (the rows of the store are the chunk ids).
+
+    Returns
+    -------
+    metadata_index : dict
+        For each indexed field, the sorted ids of the chunks of each value.
+    """
+    return {field: chunk_store.group_rows(field) for field in INDEXED_FIELDS}
+
+
+def save_metadata_index(
+    chunk_store: ChunkStore, vector_db_path: str
+) -> dict[str, dict[str, list[int]]]:
+    """Build and save the inverted index of the metadata next to the vector database.
+
+    Parameters
+    ----------
+    chunk_store : ChunkStore
+        The store of the chunks.
+    vector_db_path : str
+        The directory of the vector database.
+
+    Returns
+    -------
+    metadata_index : dict
+        The saved metadata index.
+    """
+    metadata_index = build_metadata_index(chunk_store)
+    write_metadata_index(metadata_index, vector_db_path)
+
+    return metadata_index
+
+
+def write_metadata_index(
+    metadata_index: dict[str, dict[str, list[int]]], vector_db_path: str
+) -> None:
+    """Write the inverted index of the metadata next to the vector database.
+
+    Parameters
+    ----------
+    metadata_index : dict
+        The metadata index.
+    vector_db_path : str
+        The directory of the vector database.
+    """
+    index_path = os.path.join(vector_db_path, METADATA_INDEX_FILE)
+    with open(index_path, "w", encoding="utf-8") as f:
+        json.dump(metadata_index, f, ensure_ascii=False)
+
+    logger.info(
+        f"Saved the metadata index of {len(metadata_index['file_name'])} files to '{index_path}'."
+    )
+
+
+def add_duplicates_to_metadata_index(
+    metadata_index: dict[str, dict[str, list[int]]],
+    duplicates: list[tuple[Document, Document]],
+) -> dict[str, dict[str, list[int]]]:
+    """Index the kept chunk of each near-duplicate under the metadata values of the dropped chunk.
+
+    Parameters
+    ----------
+    metadata_index : dict
+        The metadata index of the kept chunks.
+    duplicates : list of tuple
+        List of (dropped chunk, kept chunk), the kept chunks having their id
+        and the dropped chunks their file name.
+
+    Returns
+    -------
+    metadata_index : dict
+        The metadata index, where the ids of the kept chunks are added to
+        the chapters and sections of their dropped chunks.
+    """
+    for field in INDEXED_FIELDS:
+        added = {}
+        for dropped, kept in duplicates:
+            if dropped.metadata.get(field) is not None:
+                added.setdefault(dropped.metadata[field], set()).add(int(kept.metadata["id"]))
+        for value, ids in added.items():
+            metadata_index[field][value] = sorted(ids.union(metadata_index[field].get(value, [])))
+
+    return metadata_index
+
+
+def load_metadata_index(vector_db_path: str) -> dict[str, dict[str, list[int]]]:
+    """Load the inverted index of the metadata saved next to the vector database.
+
+    Parameters
+    ----------
+    vector_db_path : str
+        The directory of the vector database.
+
+    Returns
+    -------
+    dict
+        The metadata index, empty if the database has no metadata index.
+    """
+    index_path = os.path.join(vector_db_path, METADATA_INDEX_FILE)
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def get_filter_rows(
+    metadata_index: dict[str, dict[str, list[int]]],
+    chapter: Optional[Union[int, str]] = None,
+    appendix: Optional[str] = None,
+    section: Optional[str] = None,
+) -> np.ndarray:
+    """Get the ids of the chunks matching all the given filters.
+
+    Parameters
+    ----------
+    metadata_index : dict
+        The metadata index.
+    chapter : int or str, optional
+        The chapter number (for example 5), by default None.
+    appendix : str, optional
+        The appendix letter (for example "A"), by default None.
+    section : str, optional
+        The section number (for example "5.2") or full section name, by default None.
+
+    Returns
+    -------
+    np.ndarray
+        The sorted ids of the matching chunks.
+    """
+    if not metadata_index:
+        raise ValueError("The database has no metadata index: rebuild it with create_database.py.")
+
+    selections = []
+    if chapter is not None:
+        prefix = f"{int(chapter):02d}_"
+        selections.append(
+            {
+                chunk_id
+                for file_name, ids in metadata_index["file_name"].items()
+                if file_name.startswith(prefix)
+                for chunk_id in ids
+            }
+        )
+    if appendix is not None:
+        selections.append(
+            {
+                chunk_id
+                for file_name, ids in metadata_index["file_name"].items()
+                if file_name.startswith("annexe_")
+                and file_name.split("_")[1].upper() == appendix.upper()
+                for chunk_id in ids
+            }
+        )
+    if section is not None:
+        selections.append(
+            {
+                chunk_id
+                for section_name, ids in metadata_index["section_name"].items()
+                if section_name == section or section_name.startswith(f"{section} ")
+                for chunk_id in ids
+            }
+        )
+    rows = set.intersection(*selections) if selections else set()
+
+    return np.array(sorted(rows), dtype=np.int64)
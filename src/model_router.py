@@ -0,0 +1,308 @@
+"""Latency-aware routing of the questions between chat models.
+
+Simple questions ("Comment quitter l'interpréteur Python ?") do not need the strongest
+and slowest model. The router chooses the chat model of each question from measurable features:
+
+- query_tokens : the number of tokens of the question,
+- top_score : the relevance score of the best retrieved chunk (cosine similarity),
+  unknown when the chunks come from the lexical search of the degraded mode,
+- nb_chunks : the number of relevant chunks retrieved,
+- history_turns : the number of previous turns of the discussion.
+
+The routes are evaluated in order and the first route whose conditions all hold is chosen.
+A condition gives a bound of a feature, as "max_query_tokens" or "min_top_score".
+A condition on an unknown feature does not hold. The last route has no conditions,
+so that every question is routed:
+
+    [
+        {"name": "simple", "model": "gpt-4o-mini", "max_query_tokens": 25,
+         "min_top_score": 0.55, "max_history_turns": 2},
+        {"name": "default", "model": "gpt-4o"}
+    ]
+
+The routes are read from the JSON file given by the BIOPYASSISTANT_ROUTES environment variable
+(DEFAULT_ROUTES otherwise). The latency of the generation of each routed question is appended,
+with its route and features, to a CSV log, to tune the routes from the data.
+
+Usage:
+======
+    python src/model_router.py --log [log-path]
+
+Arguments:
+==========
+    --log : str (optional)
+        The path to the latency log of the routes. Default is model_routes.csv.
+
+Example:
+========
+    python src/model_router.py --log model_routes.csv
+
+This command will display, for each route and model, the number of questions,
+the 50th and 90th percentiles of the latency and the mean features of the questions.
+"""
+
+# METADATA
+__authors__ = ("Pierre Poulain", "Essmay Touami")
+__contact__ = "pierre.poulain@u-paris.fr"
+__copyright__ = "BSD-3 clause"
+__date__ = "2024"
+__version__ = "1.0.0"
+
+
+# LIBRARY IMPORTS
+import os
+import sys
+import csv
+import json
+import argparse
+from datetime import datetime, timezone
+from statistics import mean, quantiles
+from typing import Optional, Tuple, Union
+
+import tiktoken
+from loguru import logger
+
+# MODULE IMPORTS
+from token_ledger import display_summary
+
+
+# CONSTANTS
+ROUTING_MODEL = "auto"
+ROUTES_PATH = os.environ.get("BIOPYASSISTANT_ROUTES", "")
+ROUTE_LOG_PATH = "model_routes.csv"
+FEATURES = ("query_tokens", "top_score", "nb_chunks", "history_turns")
+DEFAULT_ROUTES = [
+    {
+        "name": "simple",
+        "model": "gpt-4o-mini",
+        "max_query_tokens": 25,
+        "min_top_score": 0.55,
+        "max_history_turns": 2,
+    },
+    {"name": "default", "model": "gpt-4o"},
+]
+ROUTE_LOG_FIELDS = ["timestamp", "route", "model", *FEATURES, "latency"]
+
+
+# FUNCTIONS
+def load_routes(routes_path: str = ROUTES_PATH) -> list[dict]:
+    """Load the routes from a JSON file, or the default routes if no file is given.
+
+    Parameters
+    ----------
+    routes_path : str, optional
+        The path of the JSON file of the routes, by default ROUTES_PATH.
+
+    Returns
+    -------
+    routes : list of dict
+        The routes, in their order of evaluation.
+    """
+    if not routes_path:
+        return DEFAULT_ROUTES
+    with open(routes_path, "r", encoding="utf-8") as f:
+        routes = json.load(f)
+    # Checks
+    for route in routes:
+        for condition in route:
+            bound, _, feature = condition.partition("_")
+            if condition not in ("name", "model") and (
+                bound not in ("min", "max") or feature not in FEATURES
+            ):
+                raise ValueError(f"Unknown condition '{condition}' in the route {route}.")
+    # The last route catches the questions matching no other route
+    if not routes or set(routes[-1]) - {"name", "model"}:
+        raise ValueError(
+            f"The last route of '{routes_path}' should have no conditions, to match every question."
+        )
+
+    return routes
+
+
+def get_route_features(
+    query: str, scored_chunks: list[tuple], chat_history: list = [], lexical: bool = False
+) -> dict[str, Optional[float]]:
+    """Compute the routing features of a question.
+
+    Parameters
+    ----------
+    query : str
+        The user query.
+    scored_chunks : list of tuple
+        The relevant chunks and their relevance scores, by decreasing score.
+    chat_history : list, optional
+        The previous (question, answer) turns of the discussion, by default [].
+    lexical : bool, optional
+        Whether the chunks come from the lexical search, by default False.
+        Their scores are not cosine similarities: the top score is then unknown (None).
+
+    Returns
+    -------
+    dict
+        The value of each feature.
+    """
+    encoding = tiktoken.get_encoding("cl100k_base")
+    if lexical:
+        top_score = None
+    else:
+        top_score = round(scored_chunks[0][1], 4) if scored_chunks else 0.0
+
+    return {
+        "query_tokens": len(encoding.encode(query)),
+        "top_score": top_score,
+        "nb_chunks": len(scored_chunks),
+        "history_turns": len(chat_history or []),
+    }
+
+
+def route_model(features: dict[str, float], routes: list[dict]) -> Tuple[str, str]:
+    """Choose the chat model of a question.
+
+    Parameters
+    ----------
+    features : dict
+        The routing features of the question.
+    routes : list of dict
+        The routes, in their order of evaluation.
+
+    Returns
+    -------
+    model, route_name : Tuple[str, str]
+        The chat model and the name of the chosen route.
+    """
+    for route in routes:
+        if all(
+            (
+                features[feature] is not None
+                and features[feature] >= route.get(f"min_{feature}", float("-inf"))
+                and features[feature] <= route.get(f"max_{feature}", float("inf"))
+            )
+            # An unknown feature only satisfies the routes without condition on it
+            or (
+                features[feature] is None
+                and f"min_{feature}" not in route
+                and f"max_{feature}" not in route
+            )
+            for feature in FEATURES
+        ):
+            logger.info(f"Route '{route['name']}': model {route['model']} for {features}.")
+            return route["model"], route["name"]
+    raise ValueError(f"No route matches the features {features}: add a route without conditions.")
+
+
+def record_route_latency(
+    route_name: str,
+    model: str,
+    features: dict[str, float],
+    latency: float,
+    log_path: str = ROUTE_LOG_PATH,
+) -> None:
+    """Append the latency of a routed generation to the log of the routes.
+
+    Parameters
+    ----------
+    route_name : str
+        The name of the route.
+    model : str
+        The chat model of the route.
+    features : dict
+        The routing features of the question.
+    latency : float
+        The duration of the generation of the answer, in seconds.
+    log_path : str, optional
+        The path to the latency log, by default ROUTE_LOG_PATH.
+    """
+    write_header = not os.path.exists(log_path) or os.path.getsize(log_path) == 0
+    timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+    with open(log_path, "a", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        if write_header:
+            writer.writerow(ROUTE_LOG_FIELDS)
+        writer.writerow(
+            [
+                timestamp,
+                route_name,
+                model,
+                *("" if features[feature] is None else features[feature] for feature in FEATURES),
+                round(latency, 3),
+            ]
+        )
+
+
+def get_mean_feature(rows: list[dict], feature: str) -> Union[float, str]:
+    """Get the mean of a feature over the logged questions where it is known."""
+    values = [float(row[feature]) for row in rows if row[feature] != ""]
+
+    return round(mean(values), 2) if values else "-"
+
+
+def summarize_routes(log_path: str) -> list[dict]:
+    """Summarize the latency of each route and model.
+
+    Parameters
+    ----------
+    log_path : str
+        The path to the latency log.
+
+    Returns
+    -------
+    summary : list of dict
+        One dictionary per route and model with the number of questions,
+        the percentiles of the latency and the mean features ("-" if unknown for all the questions).
+    """
+    groups = {}
+    with open(log_path, "r", newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            groups.setdefault((row["route"], row["model"]), []).append(row)
+
+    summary = []
+    for (route_name, model), rows in sorted(groups.items()):
+        latencies = [float(row["latency"]) for row in rows]
+        if len(latencies) > 1:
+            percentiles = quantiles(latencies, n=100, method="inclusive")
+            p50, p90 = percentiles[49], percentiles[89]
+        else:
+            p50 = p90 = latencies[0]
+        summary.append(
+            {
+                "route": route_name,
+                "model": model,
+                "questions": len(rows),
+                "p50_s": round(p50, 2),
+                "p90_s": round(p90, 2),
+                **{f"mean_{feature}": get_mean_feature(rows, feature) for feature in FEATURES},
+            }
+        )
+
+    return summary
+
+
+def get_args() -> str:
+    """Parse command-line arguments.
+
+    Returns
+    -------
+    log_path : str
+        The path to the latency log of the routes.
+    """
+    parser = argparse.ArgumentParser(description="Summarize the latency of the model routes.")
+    parser.add_argument(
+        "--log",
+        dest="log_path",
+        default=ROUTE_LOG_PATH,
+        help="The path to the latency log of the routes.",
+    )
+    args = parser.parse_args()
+
+    # Checks
+    if not os.path.exists(args.log_path):
+        logger.error(f"The log file '{args.log_path}' does not exist.")
+        sys.exit(1)
+
+    return args.log_path
+
+
+# MAIN PROGRAM
+if __name__ == "__main__":
+    log_path = get_args()
+    display_summary(summarize_routes(log_path))
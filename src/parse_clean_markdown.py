@@ -4,13 +4,19 @@ This module provides functions for processing Markdown files. It includes functi
 
 Usage:
 ======
-    python src/parse_clean_markdown.py --in source_dir --out dest_dir
+    python src/parse_clean_markdown.py --in source_dir --out dest_dir [--profile [report-path]]
+                                       [--cprofile-dir cprofile-dir]
 
 Where:
     source_dir : str
         The source directory containing Markdown files to be processed.
     dest_dir : str
         The destination directory to save the processed Markdown files.
+    report-path : str (optional)
+        Record the wall time, CPU time and peak memory of each stage and save the report to this path
+        (parse_clean_markdown_profile.json if no path is given). See stage_profiler.py.
+    cprofile-dir : str (optional)
+        With --profile, also dump the cProfile statistics of each stage to this directory.
 
 Example:
 ========
@@ -35,15 +41,24 @@ from typing import Union
 
 from loguru import logger
 
+# MODULE IMPORTS
+from stage_profiler import StageProfiler, add_profile_arguments
+
+
+# CONSTANTS
+PROFILE_PATH = "parse_clean_markdown_profile.json"
+
 
 # FUNCTIONS
-def get_args() -> tuple[str, str]:
+def get_args() -> tuple[str, str, str, str]:
     """Get source and destination directories from command line arguments.
 
     Returns
     -------
-    tuple[str, str]
-        A tuple containing the source and destination directories.
+    tuple[str, str, str, str]
+        A tuple containing the source and destination directories,
+        the path of the profile report of the stages (None for no profiling)
+        and the directory of the cProfile statistics of the stages.
     """
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -58,8 +73,9 @@ def get_args() -> tuple[str, str]:
         required=True,
         help="Destination directory to save processed files.",
     )
+    add_profile_arguments(parser, PROFILE_PATH)
     args = parser.parse_args()
-    return args.source_dir, args.dest_dir
+    return args.source_dir, args.dest_dir, args.profile_path, args.cprofile_dir
 
 
 def clean_python_comments(content: str) -> str:
@@ -173,7 +189,9 @@ def renumber_headers(content: str, chapter_number: Union[int, str]) -> str:
     return "\n".join(processed_content)
 
 
-def process_md_files(source_dir: str, dest_dir: str) -> None:
+def process_md_files(
+    source_dir: str, dest_dir: str, profiler: StageProfiler = None
+) -> None:
     """Process Markdown files in the source directory and save them to the destination directory.
 
     Parameters
@@ -182,8 +200,12 @@ def process_md_files(source_dir: str, dest_dir: str) -> None:
         The source directory containing Markdown files.
     dest_dir : str
         The destination directory to save processed files.
+    profiler : StageProfiler, optional
+        The profiler of the stages, by default None (no profiling).
+        The stages run for each file are reported once, with their number of calls.
     """
     logger.info("Processing Markdown files...\n")
+    profiler = profiler or StageProfiler(enabled=False)
     if not os.path.exists(dest_dir):
         os.makedirs(dest_dir)
 
@@ -198,28 +220,35 @@ def process_md_files(source_dir: str, dest_dir: str) -> None:
         dest_path = os.path.join(dest_dir, filename)
 
         # Read the content of the source file
-        with open(source_path, "r", encoding="utf-8") as file:
-            content = file.read()
+        with profiler.stage("read"):
+            with open(source_path, "r", encoding="utf-8") as file:
+                content = file.read()
 
         # Clean Python comments
-        content = clean_python_comments(content)
+        with profiler.stage("clean_comments"):
+            content = clean_python_comments(content)
 
         # Renumber headers
-        if filename.startswith("annexe"):
-            annex_character = str(filename.split("_")[1])
-            content = renumber_headers(content, annex_character)
-        if re.match(r"\d{2}_", filename):
-            chapter_number = int(filename.split("_")[0])
-            content = renumber_headers(content, chapter_number)
+        with profiler.stage("renumber_headers"):
+            if filename.startswith("annexe"):
+                annex_character = str(filename.split("_")[1])
+                content = renumber_headers(content, annex_character)
+            if re.match(r"\d{2}_", filename):
+                chapter_number = int(filename.split("_")[0])
+                content = renumber_headers(content, chapter_number)
 
         # Save the processed content to the destination file
-        with open(dest_path, "w", encoding="utf-8") as file:
-            file.write(content)
+        with profiler.stage("write"):
+            with open(dest_path, "w", encoding="utf-8") as file:
+                file.write(content)
 
     logger.success("Markdown files processed successfully.\n")
 
 
 # MAIN PROGRAM
 if __name__ == "__main__":
-    source_dir, dest_dir = get_args()  # Get source and destination directories
-    process_md_files(source_dir, dest_dir)
+    source_dir, dest_dir, profile_path, cprofile_dir = get_args()  # Get source and destination directories
+    profiler = StageProfiler(enabled=profile_path is not None, cprofile_dir=cprofile_dir)
+    process_md_files(source_dir, dest_dir, profiler)
+    if profile_path is not None:
+        profiler.write_report(profile_path, "parse_clean_markdown")
@@ -0,0 +1,207 @@
+"""Embedding and chat model providers.
+
+This module selects the embedding function and the chat model used by the pipeline.
+Two providers are available:
+
+- "openai": the OpenAI embeddings and chat models (requires an OpenAI API key).
+- "local": a deterministic offline backend. Embeddings are hashed character n-gram
+  features of a configurable dimension, and the chat model returns a templated answer
+  after a configurable simulated latency. It allows to build databases and to benchmark
+  the whole pipeline, except the remote model, without network access.
+
+The provider is selected with the `--provider` option of the scripts,
+or with the following environment variables:
+
+- BIOPYASSISTANT_PROVIDER : "openai" or "local". Default is "openai".
+- BIOPYASSISTANT_EMBEDDING_DIM : dimension of the local embeddings. Default is 256.
+- BIOPYASSISTANT_STUB_LATENCY : simulated latency of the local chat model, in seconds. Default is 0.
+
+The OpenAI embeddings wait for the rate limiter shared by the processes of the host
+if it is enabled (see `rate_limiter.py`). The OpenAI clients used within the deadline
+of a request (see `deadlines.py`) are built with a timeout and without retries,
+so that a call given up by the request does not keep calling a failing API.
+"""
+
+# METADATA
+__authors__ = ("Pierre Poulain", "Essmay Touami")
+__contact__ = "pierre.poulain@u-paris.fr"
+__copyright__ = "BSD-3 clause"
+__date__ = "2024"
+__version__ = "1.0.0"
+
+
+# LIBRARY IMPORTS
+import os
+import re
+import time
+import zlib
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_openai import OpenAIEmbeddings, ChatOpenAI
+
+# MODULE IMPORTS
+from rate_limiter import RateLimitedEmbeddings, get_rate_limiter
+
+
+# CONSTANTS
+PROVIDERS = ("openai", "local")
+DEFAULT_PROVIDER = os.environ.get("BIOPYASSISTANT_PROVIDER", "openai")
+LOCAL_EMBEDDING_DIM = int(os.environ.get("BIOPYASSISTANT_EMBEDDING_DIM", 256))
+LOCAL_NGRAM_SIZES = (3, 4, 5)
+STUB_LATENCY = float(os.environ.get("BIOPYASSISTANT_STUB_LATENCY", 0))
+STUB_ANSWER_TEMPLATE = (
+    "Réponse simulée par le modèle {model_name} à la question : {question}"
+)
+
+
+# CLASSES
+class HashingEmbeddings(Embeddings):
+    """Deterministic embeddings built from hashed character n-grams.
+
+    Each word is padded with spaces and cut into character n-grams.
+    Each n-gram is hashed with CRC32 into one of `dimension` buckets, with a sign
+    given by another bit of the hash, and the resulting vector is L2-normalized.
+    Texts sharing many n-grams therefore have a high cosine similarity.
+    """
+
+    def __init__(
+        self, dimension: int = LOCAL_EMBEDDING_DIM, ngram_sizes: tuple = LOCAL_NGRAM_SIZES
+    ) -> None:
+        self.dimension = dimension
+        self.ngram_sizes = ngram_sizes
+
+    def _embed(self, text: str) -> List[float]:
+        """Embed a single text."""
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        hashes = [
+            zlib.crc32(f" {word} "[i : i + size].encode("utf-8"))
+            for word in text.lower().split()
+            for size in self.ngram_sizes
+            for i in range(max(len(word) + 3 - size, 1))
+        ]
+        if hashes:
+            hashes = np.array(hashes, dtype=np.int64)
+            signs = np.where(hashes & (1 << 31), -1.0, 1.0).astype(np.float32)
+            np.add.at(vector, hashes % self.dimension, signs)
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+
+        return vector.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed a list of documents."""
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a query."""
+        return self._embed(text)
+
+
+class StubChatModel(BaseChatModel):
+    """Chat model returning a templated answer after a simulated latency."""
+
+    model_name: str = "stub"
+    latency: float = STUB_LATENCY
+    answer_template: str = STUB_ANSWER_TEMPLATE
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub-chat"
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        """Return the templated answer for the question found in the last message."""
+        time.sleep(self.latency)
+        prompt = messages[-1].content if messages else ""
+        # The question is written between quotes in the prompt template
+        question = re.search(r'Question : "(.*?)"', prompt, re.DOTALL)
+        answer = self.answer_template.format(
+            model_name=self.model_name,
+            question=question.group(1) if question else prompt[:100],
+        )
+
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=answer))])
+
+
+# FUNCTIONS
+def get_embedding_function(
+    provider: str = DEFAULT_PROVIDER,
+    model_name: str = "text-embedding-3-large",
+    dimension: int = LOCAL_EMBEDDING_DIM,
+    timeout: Optional[float] = None,
+    token_counts: Optional[Dict[str, int]] = None,
+) -> Embeddings:
+    """Get the embedding function of a provider.
+
+    Parameters
+    ----------
+    provider : str, optional
+        The name of the provider: "openai" or "local", by default DEFAULT_PROVIDER.
+    model_name : str, optional
+        The name of the OpenAI embedding model, by default "text-embedding-3-large".
+    dimension : int, optional
+        The dimension of the local embeddings, by default LOCAL_EMBEDDING_DIM.
+    timeout : float, optional
+        The timeout of the OpenAI calls, in seconds, by default None: the client's default
+        timeout and retries. With a timeout, the failed calls are not retried.
+    token_counts : dict, optional
+        The numbers of tokens of the texts to embed, already counted, by default None.
+        The rate limiter only tokenizes the other texts.
+
+    Returns
+    -------
+    Embeddings
+        The embedding function.
+    """
+    if provider == "openai":
+        if timeout is None:
+            embeddings = OpenAIEmbeddings(model=model_name)
+        else:
+            embeddings = OpenAIEmbeddings(model=model_name, timeout=timeout, max_retries=0)
+        rate_limiter = get_rate_limiter()
+        if rate_limiter is not None:
+            return RateLimitedEmbeddings(embeddings, rate_limiter, model_name, token_counts)
+        return embeddings
+    if provider == "local":
+        return HashingEmbeddings(dimension=dimension)
+    raise ValueError(f"Unknown provider '{provider}'. Choose among {PROVIDERS}.")
+
+
+def get_chat_model(
+    model_name: str, provider: str = DEFAULT_PROVIDER, timeout: Optional[float] = None
+) -> BaseChatModel:
+    """Get the chat model of a provider.
+
+    Parameters
+    ----------
+    model_name : str
+        The name of the chat model.
+    provider : str, optional
+        The name of the provider: "openai" or "local", by default DEFAULT_PROVIDER.
+    timeout : float, optional
+        The timeout of the OpenAI calls, in seconds, by default None: the client's default
+        timeout and retries. With a timeout, the failed calls are not retried.
+
+    Returns
+    -------
+    BaseChatModel
+        The chat model.
+    """
+    if provider == "openai":
+        if timeout is None:
+            return ChatOpenAI(model=model_name)
+        return ChatOpenAI(model=model_name, timeout=timeout, max_retries=0)
+    if provider == "local":
+        return StubChatModel(model_name=model_name)
+    raise ValueError(f"Unknown provider '{provider}'. Choose among {PROVIDERS}.")
@@ -7,7 +7,15 @@ responses to the query using an OpenAI model.
 Usage:
 ======
     python src/query_chatbot.py --query "Your question here"  [--model "model_name"]
-                                                              [--include-metadata]                                
+                                                              [--include-metadata]
+                                                              [--ledger "ledger_path"]
+                                                              [--provider "provider"]
+                                                              [--chapter chapter] [--appendix appendix]
+                                                              [--section section]
+                                                              [--two-stage nb_groups]
+                                                              [--two-stage-level level]
+                                                              [--search-workers nb_workers]
+                                                              [--deadline seconds]
                                                            
 Arguments:
 ==========
@@ -16,12 +24,42 @@ Arguments:
     Options:
     ========
     --model "model_name" : The name or identifier of the model to be used for generating responses.
+                           Use "auto" to route the question to a model chosen from its features
+                           (see model_router.py).
                            (Default model: OPENAI_MODEL_NAME)
     
     --include-metadata : Optional flag to specify whether to include metadata in the response.
                          If provided, metadata will be included; otherwise, it will be excluded.
                          (Default: metadata is excluded)
 
+    --ledger "ledger_path" : The path to the token ledger file where the prompt and completion tokens are recorded.
+                             (Default: TOKEN_LEDGER_PATH)
+
+    --provider "provider" : The chat model provider: "openai" or "local".
+                            The embedding provider is the one used to build the database.
+                            (Default: DEFAULT_PROVIDER)
+
+    --chapter chapter : Restrict the search to the chunks of a chapter, given by its number (for example 5).
+    --appendix appendix : Restrict the search to the chunks of an appendix, given by its letter (for example A).
+    --section section : Restrict the search to the chunks of a section, given by its number (for example 5.2).
+                        (Default: the search covers the whole course)
+
+    --two-stage nb_groups : Two-stage search: select the nb_groups chapters (or sections) whose
+                            centroid embeddings are the most similar to the query, then search their chunks only.
+                            (Default: single-stage search)
+    --two-stage-level level : The groups of the two-stage search: "chapter" or "section".
+                              (Default: "chapter")
+
+    --search-workers nb_workers : Search the chapter shards of the database (built with --shard-workers)
+                                  in parallel with nb_workers worker processes.
+                                  (Default: search in the main process)
+
+    --deadline seconds : The time budget of the request. If the query embedding misses its budget
+                         (RETRIEVAL_BUDGET within the deadline), the chunks are searched in a local
+                         lexical index; if the generation misses the deadline, the answer gives
+                         the excerpts of the relevant chunks and their sources.
+                         (Default: no deadline)
+
 Example:
 ========
     python src/query_chatbot.py --query "D'où vient le nom Python ?" --model "gpt-4o" --include-metadata
@@ -39,28 +77,83 @@ __version__ = "1.0.0"
 
 
 # LIBRARY IMPORTS
+import os
 import re
 import sys
+import time
 import random
 import argparse
-from typing import Tuple, Union, List
+from typing import Iterator, Tuple, Union, List
 
 import tiktoken
 from loguru import logger
-from openai import OpenAI
+from openai import OpenAI, APIError
 from langchain_core.documents import Document
 from langchain_community.vectorstores import Chroma
 from langchain_core.output_parsers import StrOutputParser
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 from langchain.schema import AIMessage, HumanMessage
 from langchain.prompts import ChatPromptTemplate
 
+# MODULE IMPORTS
+from index_config import read_index_config
+from token_ledger import TOKEN_LEDGER_PATH, record_usage
+from rate_limiter import get_rate_limiter
+from model_router import (
+    ROUTING_MODEL,
+    load_routes,
+    get_route_features,
+    route_model,
+    record_route_latency,
+)
+from providers import (
+    PROVIDERS,
+    DEFAULT_PROVIDER,
+    LOCAL_EMBEDDING_DIM,
+    get_chat_model,
+    get_embedding_function,
+)
+from metadata_index import load_metadata_index
+from centroids import CENTROID_LEVELS, load_centroids
+from dedup import load_aliases, resolve_aliases
+from chunk_store import ChunkStore
+from index_versions import resolve_index_path
+from embedding_coalescer import COALESCE_WINDOW_MS, CoalescingEmbeddings
+from shards import ShardSearcher, ShardedVectorStore, read_shards_manifest
+from deadlines import Deadline, CircuitBreaker, DeadlineExceeded, call_with_breaker
+from lexical_index import get_lexical_index
+from vector_store import (
+    EMBEDDINGS_FILE,
+    RecordingEmbeddings,
+    ChunkVectorStore,
+    RescoringVectorStore,
+    QuantizedVectorStore,
+    load_embeddings,
+    load_quantized_embeddings,
+    open_chroma,
+)
+
 
 # CONSTANTS
 CHROMA_PATH = "chroma_db"
 OPENAI_MODEL_NAME = "gpt-4o"
 PYTHON_LEVEL = "intermédiaire"
 EMBEDDING_MODEL = "text-embedding-3-large"
+# Number of tokens of an answer taken from the rate limiter before the call,
+# corrected with the actual number of tokens of the answer after the call
+ESTIMATED_ANSWER_TOKENS = 500
+# Time budget of the semantic search within the deadline of a request, in seconds
+RETRIEVAL_BUDGET = 5.0
+# Circuit breakers of the embedding and chat APIs, shared by the requests of the process:
+# they open in the long-running processes (`index_reloader.py`, `collection_manager.py`)
+EMBEDDING_BREAKER = CircuitBreaker("embedding")
+CHAT_BREAKER = CircuitBreaker("chat")
+# Errors of the API calls: the requests fall back to the degraded mode on these errors only
+API_ERRORS = (APIError, DeadlineExceeded)
+EXCERPT_LENGTH = 300
+MSG_DEGRADED_ANSWER = (
+    "Le service de génération des réponses est momentanément indisponible. "
+    "Voici les extraits du cours les plus proches de votre question :"
+)
 
 PROMPT_TEMPLATE = """
 Tu es un assistant pour les tâches de question-réponse des étudiants dans un cours de programmation Python.
@@ -105,13 +198,17 @@ def check_openai_model_validity(model_name):
         return False
 
 
-def get_args() -> Tuple[str, str, bool]:
+def get_args() -> Tuple[str, str, bool, str, str, dict, int, float]:
     """Parse the command line arguments.
 
     Returns
     -------
-    Tuple[str, str, bool]
-        A tuple containing the query, the model name and a flag to include metadata.
+    Tuple[str, str, bool, str, str, dict, int, float]
+        A tuple containing the query, the model name, a flag to include metadata,
+        the path to the token ledger, the chat model provider,
+        the options of the search (chapter, appendix and section filters, two-stage mode),
+        the number of worker processes searching the shards
+        and the deadline of the request in seconds.
     """
     logger.info("Parsing the command line arguments.")
     parser = argparse.ArgumentParser()  # Create a parser object
@@ -134,6 +231,61 @@ def get_args() -> Tuple[str, str, bool]:
         default=False,
         help="Flag to specify whether to include metadata in the response. If provided, metadata will be included.",
     )
+    parser.add_argument(
+        "--ledger",
+        type=str,
+        default=TOKEN_LEDGER_PATH,
+        help="The path to the token ledger file where the prompt and completion tokens are recorded.",
+    )
+    parser.add_argument(
+        "--provider",
+        type=str,
+        choices=PROVIDERS,
+        default=DEFAULT_PROVIDER,
+        help="The chat model provider.",
+    )
+    parser.add_argument(
+        "--chapter",
+        type=int,
+        default=None,
+        help="Restrict the search to the chunks of a chapter, given by its number.",
+    )
+    parser.add_argument(
+        "--appendix",
+        type=str,
+        default=None,
+        help="Restrict the search to the chunks of an appendix, given by its letter.",
+    )
+    parser.add_argument(
+        "--section",
+        type=str,
+        default=None,
+        help="Restrict the search to the chunks of a section, given by its number.",
+    )
+    parser.add_argument(
+        "--two-stage",
+        type=int,
+        default=None,
+        help="Search only the chunks of the chapters (or sections) closest to the query.",
+    )
+    parser.add_argument(
+        "--two-stage-level",
+        choices=list(CENTROID_LEVELS),
+        default="chapter",
+        help="The groups of the two-stage search.",
+    )
+    parser.add_argument(
+        "--search-workers",
+        type=int,
+        default=None,
+        help="Search the chapter shards of the database with this number of worker processes.",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        default=None,
+        help="The time budget of the request in seconds, after which a degraded answer is given.",
+    )
     # Parse the command line arguments
     args = parser.parse_args()
 
@@ -143,34 +295,154 @@ def get_args() -> Tuple[str, str, bool]:
         logger.error("Please provide a query")
         sys.exit(1)
     # model name validity
-    if not check_openai_model_validity(args.model):
+    if (
+        args.provider == "openai"
+        and args.model != ROUTING_MODEL
+        and not check_openai_model_validity(args.model)
+    ):
         logger.error(f"The model {args.model} is not valid.")
         sys.exit(1)
+    # number of groups of the two-stage search
+    if args.two_stage is not None and args.two_stage <= 0:
+        logger.error("The number of groups of the two-stage search should be positive.")
+        sys.exit(1)
+    if args.search_workers is not None and args.search_workers <= 0:
+        logger.error("The number of search workers should be positive.")
+        sys.exit(1)
+    if args.deadline is not None and args.deadline <= 0:
+        logger.error("The deadline should be positive.")
+        sys.exit(1)
 
     logger.info(f"Query : {args.query}")
     logger.info(f"Model name: {args.model}")
     logger.info(f"Include metadata: {args.include_metadata}")
+    logger.info(f"Token ledger: {args.ledger}")
+    logger.info(f"Provider: {args.provider}")
+    search_options = {
+        "chapter": args.chapter,
+        "appendix": args.appendix,
+        "section": args.section,
+        "two_stage": args.two_stage,
+        "two_stage_level": args.two_stage_level,
+    }
+    logger.info(f"Search options: {search_options}")
     logger.success("Command line arguments parsed successfully.\n")
 
-    return args.query, args.model, args.include_metadata
+    return (
+        args.query,
+        args.model,
+        args.include_metadata,
+        args.ledger,
+        args.provider,
+        search_options,
+        args.search_workers,
+        args.deadline,
+    )
 
 
-def load_database(vector_db_path: str) -> Tuple[Chroma, int]:
+def load_database(
+    vector_db_path: str, search_workers: int = None, api_timeout: float = None
+) -> Tuple[Chroma, int]:
     """Prepare the vector database.
 
+    The embedding function is the one recorded in the configuration of the database
+    at build time (OpenAI embeddings for databases without configuration).
+    Databases saved with their full embeddings are wrapped in a vector store
+    which can restrict the search to a chapter, an appendix or a section,
+    or to the chapters or sections closest to the query (two-stage search).
+    Databases built with truncated embeddings rescore the Chroma candidates
+    with the full embeddings. Databases built with quantized embeddings are searched
+    in their codes and rescored with the full embeddings.
+    Databases built with chapter shards can be searched by a pool of worker processes.
+    The query embeddings of concurrent requests are sent in batches if the
+    BIOPYASSISTANT_COALESCE_WINDOW_MS environment variable is set (see `embedding_coalescer.py`),
+    except for the databases without full embeddings, which stay plain Chroma stores.
+    For versioned databases, the version published at the time of the call is loaded.
+
+    Parameters
+    ----------
+    vector_db_path : str
+        The path of the vector database.
+    search_workers : int, optional
+        The number of worker processes searching the shards of the database, by default None
+        (search in the main process).
+    api_timeout : float, optional
+        The timeout of the calls to the embedding API, without retries, by default None
+        (the client's defaults). Set it for the searches run within a deadline.
+
     Returns
     -------
         Chroma: The prepared vector database.
         int: The number of chunks in the database.
     """
     logger.info("Loading the vector database.")
-    embedding_function = OpenAIEmbeddings(
-        model=EMBEDDING_MODEL
+    # Open all the files from the version published now, even if a new one is published meanwhile
+    vector_db_path = resolve_index_path(vector_db_path)
+    index_config = read_index_config(vector_db_path)
+    embedding_function = get_embedding_function(
+        index_config.get("provider", "openai"),
+        index_config.get("embedding_model", EMBEDDING_MODEL),
+        index_config.get("embedding_dimension") or LOCAL_EMBEDDING_DIM,
+        api_timeout,
     )  # define the embedding model
+    # The databases without full embeddings stay plain Chroma stores, which cannot
+    # stop the thread of the coalescer when they are closed
+    full_embeddings = os.path.exists(os.path.join(vector_db_path, EMBEDDINGS_FILE))
+    if COALESCE_WINDOW_MS > 0 and full_embeddings:
+        # Embed the queries of concurrent requests in batches
+        logger.info(f"Query embeddings batched within {COALESCE_WINDOW_MS} ms.")
+        embedding_function = CoalescingEmbeddings(embedding_function)
+    elif COALESCE_WINDOW_MS > 0:
+        logger.warning(
+            "Query embeddings not batched: the database has no full embeddings "
+            "(rebuild it with create_database.py)."
+        )
     # Load the database from the specified directory
-    vector_db = Chroma(
-        persist_directory=vector_db_path, embedding_function=embedding_function
-    )
+    truncate_dim = index_config.get("truncate_dim")
+    vector_db = open_chroma(vector_db_path, RecordingEmbeddings(embedding_function, truncate_dim))
+    quantization = index_config.get("quantization")
+    if truncate_dim:
+        logger.info(f"Embeddings truncated to {truncate_dim} dimensions in Chroma.")
+        vector_db = RescoringVectorStore(
+            vector_db,
+            embedding_function,
+            load_embeddings(vector_db_path),
+            load_metadata_index(vector_db_path),
+            truncate_dim,
+            centroids=load_centroids(vector_db_path),
+            chunk_store=ChunkStore.load(vector_db_path),
+        )
+    elif quantization:
+        logger.info(f"Searching the {quantization} codes of the embeddings.")
+        vector_db = QuantizedVectorStore(
+            vector_db,
+            embedding_function,
+            load_embeddings(vector_db_path),
+            load_metadata_index(vector_db_path),
+            load_quantized_embeddings(vector_db_path),
+            quantization,
+            centroids=load_centroids(vector_db_path),
+            chunk_store=ChunkStore.load(vector_db_path),
+        )
+    elif search_workers and read_shards_manifest(vector_db_path):
+        vector_db = ShardedVectorStore(
+            vector_db,
+            embedding_function,
+            load_embeddings(vector_db_path),
+            load_metadata_index(vector_db_path),
+            centroids=load_centroids(vector_db_path),
+            chunk_store=ChunkStore.load(vector_db_path),
+            shard_searcher=ShardSearcher(vector_db_path, search_workers),
+        )
+    elif full_embeddings:
+        vector_db = ChunkVectorStore(
+            vector_db,
+            embedding_function,
+            load_embeddings(vector_db_path),
+            load_metadata_index(vector_db_path),
+            centroids=load_centroids(vector_db_path),
+            chunk_store=ChunkStore.load(vector_db_path),
+        )
     # Count the number of chunks in the database
     nb_chunks = vector_db._collection.count()
     logger.info(f"Chunks in the database: {nb_chunks}")
@@ -186,9 +458,21 @@ def search_similarity_in_database(
     nb_chunks: int = 3,
     score_threshold: float = 0.35,
     logger_flag: bool = True,
+    chapter: Union[int, str] = None,
+    appendix: str = None,
+    section: str = None,
+    two_stage: int = None,
+    two_stage_level: str = "chapter",
+    return_scores: bool = False,
 ) -> List[Document]:
     """Search for relevant documents in the database based on the query text.
 
+    The search can be restricted to the chunks of a chapter, an appendix and/or a section.
+    The ids of these chunks are given by the metadata index of the database,
+    and only their embeddings are scanned.
+    In the two-stage mode, the query is first compared to the centroid embeddings
+    of the chapters (or sections), and only the chunks of the closest ones are searched.
+
     Parameters
     ----------
     vector_db : Chroma
@@ -201,23 +485,51 @@ def search_similarity_in_database(
         The relevance score threshold for filtering the results.
     logger_flag : bool
         Flag to indicate whether to log the search results.
+    chapter : int or str, optional
+        The number of the chapter to search in, by default None.
+    appendix : str, optional
+        The letter of the appendix to search in, by default None.
+    section : str, optional
+        The number of the section to search in, by default None.
+    two_stage : int, optional
+        The number of chapters (or sections) searched in the two-stage mode, by default None.
+    two_stage_level : str, optional
+        "chapter" or "section", by default "chapter".
+    return_scores : bool, optional
+        Return the relevance scores of the documents, by default False.
 
     Returns
     -------
     relevant_chunks : list
-        List of relevant documents found in the database.
+        List of relevant documents found in the database,
+        or of (document, relevance score) if `return_scores` is True.
     """
     if logger_flag:
         logger.info("Searching for relevant documents in the database...")
-    
-    # Define the retriever
-    retriever = vector_db.as_retriever(
-        search_type="similarity_score_threshold",
-        search_kwargs={"k": nb_chunks, "score_threshold": score_threshold},
-    )
+
+    search_kwargs = {"k": nb_chunks, "score_threshold": score_threshold}
+    # Restrict the search to the chunks matching the filters
+    if chapter is not None or appendix is not None or section is not None:
+        if not isinstance(vector_db, ChunkVectorStore):
+            logger.error("Filtered search requires a database rebuilt with create_database.py.")
+            sys.exit(1)
+        search_kwargs["rows"] = vector_db.filter_rows(chapter, appendix, section)
+        if logger_flag:
+            logger.info(f"Searching in {len(search_kwargs['rows'])} chunks.")
+    # Search only the chunks of the chapters (or sections) closest to the query
+    if two_stage:
+        if not isinstance(vector_db, ChunkVectorStore):
+            logger.error("Two-stage search requires a database rebuilt with create_database.py.")
+            sys.exit(1)
+        search_kwargs["two_stage"] = two_stage
+        search_kwargs["two_stage_level"] = two_stage_level
+        if logger_flag:
+            logger.info(f"Two-stage search in the {two_stage} closest {two_stage_level}(s).")
 
     # Perform a similarity search with relevance scores
-    relevant_chunks = retriever.invoke(user_query)
+    # (the search of the "similarity_score_threshold" retriever, keeping the scores)
+    scored_chunks = vector_db.similarity_search_with_relevance_scores(user_query, **search_kwargs)
+    relevant_chunks = [chunk for chunk, _score in scored_chunks]
 
     if logger_flag:
         # Display information about the relevant chunks
@@ -228,7 +540,79 @@ def search_similarity_in_database(
 
         logger.success("Search completed successfully.\n")
 
-    return relevant_chunks
+    return scored_chunks if return_scores else relevant_chunks
+
+
+def search_with_deadline(
+    vector_db: Chroma,
+    user_query: str,
+    deadline: Deadline,
+    nb_chunks: int = 3,
+    **search_options,
+) -> Tuple[list[Tuple[Document, float]], bool]:
+    """Search for relevant documents within the deadline of the request.
+
+    The semantic search embeds the query with the remote API. If it does not finish
+    within its budget, fails with an API error or if the embedding API is failing
+    (open circuit), the chunks are searched in the local lexical index of the database instead.
+
+    Parameters
+    ----------
+    vector_db : Chroma
+        The textual database to search.
+    user_query : str
+        The query text.
+    deadline : Deadline
+        The deadline of the request.
+    nb_chunks : int
+        The number of top matching documents to retrieve.
+    **search_options
+        The options of `search_similarity_in_database` (filters, two-stage mode).
+
+    Returns
+    -------
+    scored_chunks, lexical : Tuple[list, bool]
+        - scored_chunks : list
+            List of (document, relevance score), by decreasing score.
+        - lexical : bool
+            Whether the chunks come from the lexical search: their scores are then
+            normalized BM25 scores, not cosine similarities.
+    """
+    filters = [search_options.get(name) for name in ("chapter", "appendix", "section")]
+    # Same check as the semantic search, which cannot be skipped in the degraded mode
+    if any(value is not None for value in filters) and not isinstance(vector_db, ChunkVectorStore):
+        logger.error("Filtered search requires a database rebuilt with create_database.py.")
+        sys.exit(1)
+    try:
+        scored_chunks = call_with_breaker(
+            EMBEDDING_BREAKER,
+            lambda: search_similarity_in_database(
+                vector_db, user_query, nb_chunks, return_scores=True, **search_options
+            ),
+            deadline.budget(RETRIEVAL_BUDGET),
+            failure_errors=API_ERRORS,
+        )
+        return scored_chunks, False
+    except API_ERRORS as e:
+        logger.warning(f"Semantic search unavailable ({e}): searching the lexical index.")
+
+    rows = None
+    if any(value is not None for value in filters):
+        rows = vector_db.filter_rows(*filters)
+    ids, scores = get_lexical_index(vector_db).search(user_query, nb_chunks, rows)
+    if isinstance(vector_db, ChunkVectorStore):
+        documents = vector_db.get_documents(ids)
+    else:
+        # The chunks are found by their id in the metadata (the Chroma ids may be UUIDs)
+        results = vector_db.get(where={"id": {"$in": ids.tolist()}}) if len(ids) else {}
+        documents_by_id = {
+            metadata["id"]: Document(page_content=content, metadata=metadata)
+            for content, metadata in zip(results.get("documents", []), results.get("metadatas", []))
+        }
+        documents = [documents_by_id[chunk_id] for chunk_id in ids.tolist()]
+    logger.success(f"Found {len(documents)} chunks in the lexical index.\n")
+
+    return list(zip(documents, scores.tolist())), True
 
 
 def format_relevant_chunks(relevant_chunks: list) -> str:
@@ -333,13 +717,16 @@ def contextualize_question(chat_history_formatted: list[Union[HumanMessage, AIMe
     return chat_context
 
 
-def get_metadata(relevant_chunks: list) -> list[dict]:
+def get_metadata(relevant_chunks: list, chunk_store: ChunkStore = None) -> list[dict]:
     """Get the metadata of the top matching documents.
 
     Parameters
     ----------
     relevant_chunks : list
         List of top matching documents and their metadata.
+    chunk_store : ChunkStore, optional
+        The store of the chunks of the database, by default None.
+        If given, the metadata are read-only views of the store.
 
     Returns
     -------
@@ -347,7 +734,10 @@ def get_metadata(relevant_chunks: list) -> list[dict]:
         List of metadata dictionaries for the top matching documents.
     """
     logger.info("Extracting metadata of the top matching documents.")
-    metadatas = [doc.metadata for doc in relevant_chunks]
+    if chunk_store is not None:
+        metadatas = [chunk_store[doc.metadata["id"]] for doc in relevant_chunks]
+    else:
+        metadatas = [doc.metadata for doc in relevant_chunks]
     logger.success("Metadata extracted successfully.\n")
 
     return metadatas
@@ -373,8 +763,94 @@ def calculate_nb_tokens(text: str) -> int:
     return nb_tokens
 
 
+def fill_prompt(query: str, chat_context: str, relevant_chunks: str) -> str:
+    """Fill the prompt template with the user query, the chat context and the relevant chunks.
+
+    Parameters
+    ----------
+    query : str
+        The user query.
+    chat_context : str
+        The contextualized chat history.
+    relevant_chunks : str
+        The formatted relevant documents.
+
+    Returns
+    -------
+    str
+        The prompt sent to the model.
+    """
+    answer_prompt = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
+
+    return answer_prompt.format(
+        contexte=relevant_chunks,
+        niveau_python=PYTHON_LEVEL,
+        question=query,
+        chat_history=chat_context,
+    )
+
+
+def wait_for_rate_limit(
+    query: str, chat_context: str, relevant_chunks: str, model_name: str, provider: str
+) -> int:
+    """Wait until the shared rate limiter allows a call of the chat model, if it is enabled.
+
+    The call takes one request, the number of tokens of the filled prompt and
+    an estimate of the number of tokens of the answer, corrected after the call
+    by `correct_rate_limit`.
+
+    Parameters
+    ----------
+    query : str
+        The user query.
+    chat_context : str
+        The contextualized chat history.
+    relevant_chunks : str
+        The formatted relevant documents.
+    model_name : str
+        The name of the chat model.
+    provider : str
+        The chat model provider: only the OpenAI calls are rate limited.
+
+    Returns
+    -------
+    int
+        The number of tokens taken for the answer (0 if the call is not rate limited).
+    """
+    rate_limiter = get_rate_limiter()
+    if rate_limiter is None or provider != "openai":
+        return 0
+    nb_tokens_prompt = calculate_nb_tokens(fill_prompt(query, chat_context, relevant_chunks))
+    rate_limiter.acquire(model_name, nb_tokens_prompt + ESTIMATED_ANSWER_TOKENS)
+
+    return ESTIMATED_ANSWER_TOKENS
+
+
+def correct_rate_limit(answer: str, nb_tokens_taken: int, model_name: str) -> None:
+    """Correct the tokens taken for the answer of a call with its actual number of tokens.
+
+    Parameters
+    ----------
+    answer : str
+        The answer generated (empty if the call failed).
+    nb_tokens_taken : int
+        The number of tokens taken for the answer by `wait_for_rate_limit`.
+    model_name : str
+        The name of the chat model.
+    """
+    if not nb_tokens_taken:
+        return
+    get_rate_limiter().adjust(model_name, calculate_nb_tokens(answer) - nb_tokens_taken)
+
+
 def generate_answer(
-    query: str, chat_context: str, relevant_chunks: list, model_name: str, logger_flag: bool = True
+    query: str,
+    chat_context: str,
+    relevant_chunks: list,
+    model_name: str,
+    logger_flag: bool = True,
+    provider: str = DEFAULT_PROVIDER,
+    timeout: float = None,
 ) -> str:
     """Generate an answer to the user query.
 
@@ -390,6 +866,11 @@ def generate_answer(
         The name of the OpenAI model to use for generating the answer.
     logger_flag : bool, optional
         Flag to indicate whether to log the output, by default True.
+    provider : str, optional
+        The chat model provider, by default DEFAULT_PROVIDER.
+    timeout : float, optional
+        The timeout of the call to the chat API, without retries, by default None
+        (the client's defaults).
 
     Returns
     -------
@@ -399,8 +880,12 @@ def generate_answer(
     if logger_flag:
         logger.info("Generating an answer to the user query...")
 
+    # Wait for the rate limit of the model shared with the other processes
+    nb_tokens_taken = wait_for_rate_limit(
+        query, chat_context, relevant_chunks, model_name, provider
+    )
     # Define the model
-    chat_model = ChatOpenAI(model=model_name)
+    chat_model = get_chat_model(model_name, provider, timeout)
     # Define the prompt template
     answer_prompt = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
     # Define the chained prompt
@@ -414,18 +899,76 @@ def generate_answer(
     }
     if logger_flag:
         # Fill the prompt with the input data
-        filled_prompt = answer_prompt.format(**input_data)
+        filled_prompt = fill_prompt(query, chat_context, relevant_chunks)
         logger.info(f"Filled prompt: {filled_prompt}")
         nb_tokens_prompt = calculate_nb_tokens(filled_prompt)
         logger.info(f"Number of tokens in the prompt: {nb_tokens_prompt}\n")
     # Generate the answer
-    answer = answer_chain.invoke(input_data)
+    answer = ""
+    try:
+        answer = answer_chain.invoke(input_data)
+    finally:
+        correct_rate_limit(answer, nb_tokens_taken, model_name)
     if logger_flag:
         logger.success("Answer generated from LLM successfully.\n")
 
     return answer
 
 
+def stream_answer(
+    query: str,
+    chat_context: str,
+    relevant_chunks: list,
+    model_name: str,
+    provider: str = DEFAULT_PROVIDER,
+) -> Iterator[str]:
+    """Generate an answer to the user query, streamed piece by piece.
+
+    Parameters
+    ----------
+    query : str
+        The user query.
+    chat_context : str
+        The contextualized chat history.
+    relevant_chunks : list
+        List of relevant documents from the database.
+    model_name : str
+        The name of the OpenAI model to use for generating the answer.
+    provider : str, optional
+        The chat model provider, by default DEFAULT_PROVIDER.
+
+    Returns
+    -------
+    Iterator[str]
+        The pieces of the answer generated by the model.
+    """
+    # Wait for the rate limit of the model shared with the other processes
+    nb_tokens_taken = wait_for_rate_limit(
+        query, chat_context, relevant_chunks, model_name, provider
+    )
+    # Define the chained prompt
+    answer_prompt = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
+    answer_chain = answer_prompt | get_chat_model(model_name, provider) | StrOutputParser()
+    # Input data for the prompt
+    input_data = {
+        "contexte": relevant_chunks,
+        "niveau_python": PYTHON_LEVEL,
+        "question": query,
+        "chat_history": chat_context,
+    }
+
+    def stream_pieces() -> Iterator[str]:
+        pieces = []
+        try:
+            for piece in answer_chain.stream(input_data):
+                pieces.append(piece)
+                yield piece
+        finally:
+            correct_rate_limit("".join(pieces), nb_tokens_taken, model_name)
+
+    return stream_pieces()
+
+
 def add_metadata_to_answer(
     answer_from_model, metadatas: list[dict], iu: bool = False
 ) -> str:
@@ -511,6 +1054,90 @@ def add_metadata_to_answer(
     return response_with_metadata
 
 
+def format_excerpts_answer(relevant_chunks: list, metadatas: list[dict]) -> str:
+    """Answer with the excerpts of the relevant documents and their sources.
+
+    Parameters
+    ----------
+    relevant_chunks : list
+        List of relevant documents from the database.
+    metadatas : list
+        List of metadata dictionaries for the relevant documents.
+
+    Returns
+    -------
+    str
+        The excerpts of the documents, followed by their sources.
+    """
+    excerpts = []
+    for chunk in relevant_chunks:
+        excerpt = " ".join(chunk.page_content.split())
+        if len(excerpt) > EXCERPT_LENGTH:
+            excerpt = excerpt[:EXCERPT_LENGTH].rsplit(" ", 1)[0] + "..."
+        excerpts.append(f"> {excerpt}")
+    excerpts_text = "\n\n".join(excerpts)
+
+    return add_metadata_to_answer(f"{MSG_DEGRADED_ANSWER}\n\n{excerpts_text}", metadatas)
+
+
+def answer_with_deadline(
+    query: str,
+    relevant_chunks: list,
+    metadatas: list[dict],
+    model_name: str,
+    deadline: Deadline,
+    provider: str = DEFAULT_PROVIDER,
+) -> Tuple[str, bool]:
+    """Generate an answer to the user query within the deadline of the request.
+
+    If the generation does not finish in the time left, fails with an API error
+    or if the chat API is failing (open circuit), the answer is made of the excerpts
+    of the relevant documents and their sources.
+
+    Parameters
+    ----------
+    query : str
+        The user query.
+    relevant_chunks : list
+        List of relevant documents from the database.
+    metadatas : list
+        List of metadata dictionaries for the relevant documents.
+    model_name : str
+        The name of the model to use for generating the answer.
+    deadline : Deadline
+        The deadline of the request.
+    provider : str, optional
+        The chat model provider, by default DEFAULT_PROVIDER.
+
+    Returns
+    -------
+    answer, degraded : Tuple[str, bool]
+        The answer and whether it is made of excerpts instead of a generated answer.
+    """
+    relevant_chunks_formatted = format_relevant_chunks(relevant_chunks)
+    # The call is not retried and gives up at the deadline: it stops with the request
+    timeout = deadline.remaining()
+    try:
+        answer = call_with_breaker(
+            CHAT_BREAKER,
+            lambda: generate_answer(
+                query,
+                None,
+                relevant_chunks_formatted,
+                model_name,
+                provider=provider,
+                timeout=timeout,
+            ),
+            timeout,
+            failure_errors=API_ERRORS,
+        )
+        return answer, False
+    except API_ERRORS as e:
+        logger.warning(f"Answer generation unavailable ({e}): answering with the excerpts.")
+
+    return format_excerpts_answer(relevant_chunks, metadatas), True
+
+
 def display_answer(user_query: str, final_response: Union[str, dict]) -> None:
     """Display the results.
 
@@ -536,13 +1163,36 @@ def display_answer(user_query: str, final_response: Union[str, dict]) -> None:
 def interrogate_model() -> None:
     """Interrogate the AI model to search for answers in a vector database."""
     # Load the query text from the command line arguments
-    user_query, model_name, include_metadata = get_args()
+    (
+        user_query,
+        model_name,
+        include_metadata,
+        ledger_path,
+        provider,
+        search_options,
+        search_workers,
+        deadline,
+    ) = get_args()
 
     # CONTEXT RETRIEVAL
-    # Load the vector database
-    vector_db = load_database(CHROMA_PATH)[0]
+    # Load the vector database and its aliases from the same version
+    vector_db_path = resolve_index_path(CHROMA_PATH)
+    # Under a deadline, the embedding calls are not retried and give up with the search
+    api_timeout = RETRIEVAL_BUDGET if deadline is not None else None
+    vector_db = load_database(vector_db_path, search_workers, api_timeout)[0]
+    # The deadline starts once the database is loaded
+    request_deadline = Deadline(deadline) if deadline is not None else None
     # Search for relevant documents in the database
-    relevant_chunks = search_similarity_in_database(vector_db, user_query)
+    lexical = False
+    if request_deadline is None:
+        scored_chunks = search_similarity_in_database(
+            vector_db, user_query, return_scores=True, **search_options
+        )
+    else:
+        scored_chunks, lexical = search_with_deadline(
+            vector_db, user_query, request_deadline, **search_options
+        )
+    relevant_chunks = [chunk for chunk, _score in scored_chunks]
 
     # ANSWER GENERATION
     # Check if there are relevant documents
@@ -555,17 +1205,49 @@ def interrogate_model() -> None:
         # Format the relevant documents for the model
         relevant_chunks_formatted = format_relevant_chunks(relevant_chunks)
         # Get the metadata of the top matching documents
-        metadatas = get_metadata(relevant_chunks)
+        metadatas = get_metadata(relevant_chunks, getattr(vector_db, "chunk_store", None))
+        # Route the question to a model chosen from its features
+        route_name = None
+        if model_name == ROUTING_MODEL:
+            route_features = get_route_features(user_query, scored_chunks, lexical=lexical)
+            model_name, route_name = route_model(route_features, load_routes())
         # Generate the answer
-        answer = generate_answer(query=user_query, chat_context=None, relevant_chunks=relevant_chunks_formatted, model_name=model_name)
+        start = time.perf_counter()
+        if request_deadline is None:
+            answer = generate_answer(query=user_query, chat_context=None, relevant_chunks=relevant_chunks_formatted, model_name=model_name, provider=provider)
+        else:
+            answer, degraded = answer_with_deadline(
+                user_query, relevant_chunks, metadatas, model_name, request_deadline, provider
+            )
+            # The excerpts answer already cites its sources
+            if degraded:
+                display_answer(user_query, answer)
+                return
+        # Record the latency of the route to tune the routes
+        if route_name is not None:
+            record_route_latency(route_name, model_name, route_features, time.perf_counter() - start)
         # Calculate the number of tokens in the answer
         logger.info("Calculating the number of tokens in the answer.")
         nb_tokens_answer = calculate_nb_tokens(answer)
         logger.success(f"Number of tokens in the answer: {nb_tokens_answer}\n")
+        # Record the prompt and completion tokens in the ledger
+        nb_tokens_prompt = calculate_nb_tokens(
+            fill_prompt(user_query, None, relevant_chunks_formatted)
+        )
+        record_usage(
+            "query",
+            model_name,
+            nb_tokens_prompt,
+            nb_tokens_answer,
+            chapters=[metadata["chapter_name"] for metadata in metadatas],
+            ledger_path=ledger_path,
+        )
 
         # ANSWER FORMATTING
         # Add metadata to the answer
         if include_metadata:
+            # Cite also the sources of the near-duplicates of the retrieved chunks
+            metadatas = resolve_aliases(metadatas, load_aliases(vector_db_path))
             answer_with_metadata = add_metadata_to_answer(answer, metadatas)
             display_answer(user_query, answer_with_metadata)
         else:
@@ -0,0 +1,346 @@
+"""Token-bucket rate limiter of the OpenAI calls, shared by the processes of a host.
+
+The batch evaluations, the query service and the database builds call the OpenAI API
+independently and together exceed its rate limits. With the rate limiter, every call
+first takes one request and its number of tokens from the buckets of its model,
+stored in a local SQLite file shared by all the processes:
+
+- the request bucket holds up to the requests-per-minute budget of the model,
+- the token bucket holds up to the tokens-per-minute budget of the model,
+
+and both are refilled continuously. A caller whose buckets are empty waits instead of
+failing with a 429 error. The waiting callers are served in their order of arrival
+(first-in first-out tickets), so that a large call is not starved by smaller ones.
+A call whose number of tokens is only known afterwards (the answer of a chat call)
+takes an estimate, corrected with `RateLimiter.adjust` once the call is done.
+
+The rate limiter is enabled with the following environment variable:
+
+- BIOPYASSISTANT_RATE_LIMIT_DB : the path of the SQLite file. Default is "" (disabled).
+
+Usage:
+======
+    python src/rate_limiter.py --db [db-path]
+
+Arguments:
+==========
+    --db : str (optional)
+        The path of the SQLite file. Default is the BIOPYASSISTANT_RATE_LIMIT_DB environment variable.
+
+Example:
+========
+    python src/rate_limiter.py --db rate_limits.sqlite
+
+This command will display the requests and tokens available for each model
+and the number of waiting callers.
+"""
+
+# METADATA
+__authors__ = ("Pierre Poulain", "Essmay Touami")
+__contact__ = "pierre.poulain@u-paris.fr"
+__copyright__ = "BSD-3 clause"
+__date__ = "2024"
+__version__ = "1.0.0"
+
+
+# LIBRARY IMPORTS
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import threading
+from typing import Dict, List, Optional
+
+import tiktoken
+from loguru import logger
+from langchain_core.embeddings import Embeddings
+
+
+# CONSTANTS
+RATE_LIMIT_DB = os.environ.get("BIOPYASSISTANT_RATE_LIMIT_DB", "")
+# Budgets of each model: (requests per minute, tokens per minute)
+MODEL_RATE_LIMITS = {
+    "gpt-4o": (500, 30_000),
+    "gpt-4o-mini": (500, 200_000),
+    "gpt-3.5-turbo": (500, 200_000),
+    "text-embedding-3-large": (3_000, 1_000_000),
+    "text-embedding-3-small": (3_000, 1_000_000),
+}
+DEFAULT_RATE_LIMIT = (500, 30_000)
+# Maximum number of texts embedded by one rate-limited call
+EMBEDDING_BATCH_SIZE = 100
+POLL_INTERVAL = 0.05
+# Tickets not refreshed for this time belong to dead processes
+TICKET_TIMEOUT = 10.0
+
+
+# CLASSES
+class RateLimiter:
+    """Token buckets of requests and tokens per model, stored in a SQLite file.
+
+    Parameters
+    ----------
+    db_path : str
+        The path of the SQLite file shared by the processes.
+    limits : dict, optional
+        The (requests per minute, tokens per minute) budgets, by model.
+    """
+
+    def __init__(self, db_path: str, limits: Optional[dict] = None) -> None:
+        self.db_path = db_path
+        self.limits = {**MODEL_RATE_LIMITS, **(limits or {})}
+        self._local = threading.local()
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS buckets "
+                "(model TEXT PRIMARY KEY, requests REAL, tokens REAL, updated REAL)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS tickets "
+                "(id INTEGER PRIMARY KEY AUTOINCREMENT, model TEXT, heartbeat REAL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        """Get the connection of the current thread (SQLite connections are not shared)."""
+        if not hasattr(self._local, "connection"):
+            self._local.connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        return self._local.connection
+
+    def _try_take(self, ticket: int, model: str, nb_tokens: int) -> float:
+        """Take a request and tokens if the ticket is the first one and the buckets allow it.
+
+        Returns
+        -------
+        float
+            0 if the request and the tokens were taken, the time to wait otherwise.
+        """
+        requests_per_minute, tokens_per_minute = self.limits.get(model, DEFAULT_RATE_LIMIT)
+        connection = self._connect()
+        now = time.time()
+        # BEGIN IMMEDIATE serializes the callers of all the processes
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute("UPDATE tickets SET heartbeat = ? WHERE id = ?", (now, ticket))
+            connection.execute("DELETE FROM tickets WHERE heartbeat < ?", (now - TICKET_TIMEOUT,))
+            first_ticket = connection.execute(
+                "SELECT MIN(id) FROM tickets WHERE model = ?", (model,)
+            ).fetchone()[0]
+            row = connection.execute(
+                "SELECT requests, tokens, updated FROM buckets WHERE model = ?", (model,)
+            ).fetchone()
+            requests, tokens, updated = row or (requests_per_minute, tokens_per_minute, now)
+            # Refill the buckets for the elapsed time
+            elapsed = max(now - updated, 0)
+            requests = min(requests_per_minute, requests + elapsed * requests_per_minute / 60)
+            tokens = min(tokens_per_minute, tokens + elapsed * tokens_per_minute / 60)
+            # A call larger than the budget waits for a full bucket
+            nb_tokens = min(nb_tokens, tokens_per_minute)
+            if first_ticket != ticket:
+                wait = POLL_INTERVAL
+            else:
+                wait = max(
+                    (1 - requests) * 60 / requests_per_minute,
+                    (nb_tokens - tokens) * 60 / tokens_per_minute,
+                    0,
+                )
+            if wait == 0:
+                requests -= 1
+                tokens -= nb_tokens
+                connection.execute("DELETE FROM tickets WHERE id = ?", (ticket,))
+            connection.execute(
+                "INSERT OR REPLACE INTO buckets (model, requests, tokens, updated) VALUES (?, ?, ?, ?)",
+                (model, requests, tokens, now),
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+        return wait
+
+    def acquire(self, model: str, nb_tokens: int) -> float:
+        """Wait until a call of a model with a number of tokens is allowed.
+
+        Parameters
+        ----------
+        model : str
+            The name of the model called.
+        nb_tokens : int
+            The number of tokens of the call (prompt or embedded texts).
+
+        Returns
+        -------
+        float
+            The time waited, in seconds.
+        """
+        connection = self._connect()
+        start = time.monotonic()
+        with connection:
+            ticket = connection.execute(
+                "INSERT INTO tickets (model, heartbeat) VALUES (?, ?)", (model, time.time())
+            ).lastrowid
+        try:
+            while True:
+                wait = self._try_take(ticket, model, nb_tokens)
+                if wait == 0:
+                    break
+                # Short sleeps keep the heartbeat of the ticket fresh
+                time.sleep(min(wait, POLL_INTERVAL * 20))
+        except BaseException:
+            with connection:
+                connection.execute("DELETE FROM tickets WHERE id = ?", (ticket,))
+            raise
+        waited = time.monotonic() - start
+        if waited > 1:
+            logger.info(f"Waited {waited:.1f} s for the rate limit of '{model}' ({nb_tokens} tokens).")
+
+        return waited
+
+    def adjust(self, model: str, nb_tokens: int) -> None:
+        """Correct the tokens taken by a call, once its actual number of tokens is known.
+
+        Parameters
+        ----------
+        model : str
+            The name of the model called.
+        nb_tokens : int
+            The tokens used beyond the tokens taken (negative to give back
+            the tokens taken but not used).
+        """
+        if nb_tokens == 0:
+            return
+        _requests_per_minute, tokens_per_minute = self.limits.get(model, DEFAULT_RATE_LIMIT)
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            # The bucket can go below zero: the next callers wait for the tokens used
+            connection.execute(
+                "UPDATE buckets SET tokens = MIN(tokens - ?, ?) WHERE model = ?",
+                (nb_tokens, tokens_per_minute, model),
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def get_state(self) -> list[dict]:
+        """Get the requests and tokens available and the waiting callers of each model."""
+        connection = self._connect()
+        now = time.time()
+        waiting = dict(
+            connection.execute("SELECT model, COUNT(*) FROM tickets GROUP BY model").fetchall()
+        )
+        state = []
+        for model, requests, tokens, updated in connection.execute(
+            "SELECT model, requests, tokens, updated FROM buckets ORDER BY model"
+        ).fetchall():
+            requests_per_minute, tokens_per_minute = self.limits.get(model, DEFAULT_RATE_LIMIT)
+            elapsed = max(now - updated, 0)
+            state.append(
+                {
+                    "model": model,
+                    "requests": min(requests_per_minute, requests + elapsed * requests_per_minute / 60),
+                    "tokens": min(tokens_per_minute, tokens + elapsed * tokens_per_minute / 60),
+                    "waiting": waiting.get(model, 0),
+                }
+            )
+
+        return state
+
+
+class RateLimitedEmbeddings(Embeddings):
+    """Embedding function waiting for the rate limiter before each call.
+
+    The documents are embedded by batches of `EMBEDDING_BATCH_SIZE` texts,
+    each batch taking one request and its number of tokens from the buckets.
+    The numbers of tokens already counted (the `nb_tokens` metadata of the chunks)
+    can be given by text, the other texts are tokenized.
+    """
+
+    def __init__(
+        self,
+        embedding_function: Embeddings,
+        rate_limiter: RateLimiter,
+        model: str,
+        token_counts: Optional[Dict[str, int]] = None,
+    ) -> None:
+        self.embedding_function = embedding_function
+        self.rate_limiter = rate_limiter
+        self.model = model
+        self.token_counts = token_counts or {}
+        self.encoding = tiktoken.get_encoding("cl100k_base")
+
+    def count_tokens(self, texts: List[str]) -> int:
+        """Count the tokens of texts, tokenizing only the texts not counted yet."""
+        uncounted = [text for text in texts if text not in self.token_counts]
+        nb_tokens = sum(self.token_counts[text] for text in texts if text in self.token_counts)
+        if uncounted:
+            nb_tokens += sum(len(tokens) for tokens in self.encoding.encode_batch(uncounted))
+
+        return nb_tokens
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed documents, by batches allowed by the rate limiter."""
+        vectors = []
+        for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+            batch = texts[start : start + EMBEDDING_BATCH_SIZE]
+            self.rate_limiter.acquire(self.model, self.count_tokens(batch))
+            vectors.extend(self.embedding_function.embed_documents(batch))
+
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a query once allowed by the rate limiter."""
+        self.rate_limiter.acquire(self.model, self.count_tokens([text]))
+
+        return self.embedding_function.embed_query(text)
+
+
+# FUNCTIONS
+_rate_limiter = None
+
+
+def get_rate_limiter() -> Optional[RateLimiter]:
+    """Get the rate limiter of the process, None if the rate limiter is disabled."""
+    global _rate_limiter
+    if RATE_LIMIT_DB and _rate_limiter is None:
+        _rate_limiter = RateLimiter(RATE_LIMIT_DB)
+
+    return _rate_limiter
+
+
+def get_args() -> str:
+    """Parse command-line arguments.
+
+    Returns
+    -------
+    db_path : str
+        The path of the SQLite file of the rate limiter.
+    """
+    parser = argparse.ArgumentParser(description="Display the state of the shared rate limiter.")
+    parser.add_argument(
+        "--db",
+        dest="db_path",
+        default=RATE_LIMIT_DB,
+        help="The path of the SQLite file of the rate limiter.",
+    )
+    args = parser.parse_args()
+
+    # Checks
+    if not args.db_path or not os.path.exists(args.db_path):
+        logger.error(f"The rate limiter file '{args.db_path}' does not exist.")
+        sys.exit(1)
+
+    return args.db_path
+
+
+# MAIN PROGRAM
+if __name__ == "__main__":
+    db_path = get_args()
+    for row in RateLimiter(db_path).get_state():
+        print(
+            f"{row['model']:<24} requests {row['requests']:>8.1f}  "
+            f"tokens {row['tokens']:>10.0f}  waiting {row['waiting']:>3}"
+        )
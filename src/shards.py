@@ -0,0 +1,385 @@
+"""Chapter shards of the embeddings, built and searched in parallel processes.
+
+The chunks of a chapter (or an appendix) form a shard, given by their `file_name` metadata.
+The full embeddings of each shard are saved in their own NumPy file next to the database:
+
+    shards/<file_name>.npy: the full normalized embeddings of the chunks of the chapter
+    shards/shards.json: {"<file_name>": {"hash": ..., "ids": [...], "nb_tokens": ...}, ...}
+
+The shards are embedded in parallel worker processes. The hash of a shard covers
+the embedding model and the texts of its chunks: a shard whose hash did not change
+since the published version is copied from it instead of being embedded again,
+so that a single changed chapter only rebuilds its own shard.
+
+At query time, the unfiltered searches can fan out over worker processes (`--search-workers`).
+The shards are split into groups of about the same number of chunks, and each group is pinned
+to its own worker process, which memory-maps only the shards of its group and returns
+their top k chunks. The sorted results of the shards are merged by score with a heap.
+Each query then costs a round trip to every worker: at the size of the course, the workers
+are faster than the HNSW index of Chroma but slower than an exact scan in the main process
+(see `benchmarks/benchmark_shard_search.py`), so they only pay off on larger corpora
+and with one CPU per worker.
+"""
+
+# METADATA
+__authors__ = ("Pierre Poulain", "Essmay Touami")
+__contact__ = "pierre.poulain@u-paris.fr"
+__copyright__ = "BSD-3 clause"
+__date__ = "2024"
+__version__ = "1.0.0"
+
+
+# LIBRARY IMPORTS
+import os
+import re
+import json
+import heapq
+import shutil
+import hashlib
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+# MODULE IMPORTS
+from providers import LOCAL_EMBEDDING_DIM, get_embedding_function
+from vector_store import ChunkVectorStore, normalize_vectors
+
+
+# CONSTANTS
+SHARDS_DIR = "shards"
+SHARDS_MANIFEST_FILE = "shards.json"
+UNASSIGNED_SHARD = "_unassigned"
+# Shards memory-mapped by each search worker process (only the shards of its group)
+_worker_shards = {}
+
+
+# CLASSES
+class PrecomputedEmbeddings(Embeddings):
+    """Embedding function returning the embeddings computed by the shards, by text."""
+
+    def __init__(self, vectors_by_text: dict[str, np.ndarray]) -> None:
+        self.vectors_by_text = vectors_by_text
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Get the precomputed embeddings of documents."""
+        return [self.vectors_by_text[text].tolist() for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        raise NotImplementedError("Precomputed embeddings only embed the chunks of the database.")
+
+
+class ShardSearcher:
+    """Pool of worker processes searching the shards of a database.
+
+    Parameters
+    ----------
+    vector_db_path : str
+        The directory of the vector database.
+    workers : int
+        The number of worker processes. The shards are split into one group per worker
+        so that each worker scans about the same number of chunks, and each group
+        is always searched by the same worker, which only maps the shards of its group.
+    """
+
+    def __init__(self, vector_db_path: str, workers: int) -> None:
+        shards = read_shards_manifest(vector_db_path)
+        workers = max(min(workers, len(shards)), 1)
+        # Largest shards first, each one given to the least loaded worker
+        self.groups = [[] for _ in range(workers)]
+        loads = [(0, worker) for worker in range(workers)]
+        for name in sorted(shards, key=lambda name: -len(shards[name]["ids"])):
+            load, worker = heapq.heappop(loads)
+            self.groups[worker].append(name)
+            heapq.heappush(loads, (load + len(shards[name]["ids"]), worker))
+        self.groups = [names for names in self.groups if names]
+        # One single-process pool per group: a group is never searched by another worker
+        self.pools = [
+            ProcessPoolExecutor(
+                max_workers=1,
+                initializer=init_search_worker,
+                initargs=(vector_db_path, names),
+            )
+            for names in self.groups
+        ]
+        logger.info(f"Searching {len(shards)} shards with {workers} worker processes.")
+
+    def search(self, query_vector: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Search the k chunks most similar to the query in all the shards.
+
+        Parameters
+        ----------
+        query_vector : np.ndarray
+            The full normalized query embedding.
+        k : int
+            The number of chunks to return.
+
+        Returns
+        -------
+        tuple of np.ndarray
+            The ids of the best k chunks and their cosine similarities, by decreasing similarity.
+        """
+        futures = [
+            pool.submit(search_shards, names, query_vector, k)
+            for pool, names in zip(self.pools, self.groups)
+        ]
+        results = [result for future in futures for result in future.result()]
+        best = list(islice(heapq.merge(*results, key=lambda result: -result[0]), k))
+
+        return (
+            np.array([chunk_id for _score, chunk_id in best], dtype=np.int64),
+            np.array([score for score, _chunk_id in best], dtype=np.float32),
+        )
+
+    def close(self) -> None:
+        """Stop the worker processes."""
+        for pool in self.pools:
+            pool.shutdown()
+
+
+class ShardedVectorStore(ChunkVectorStore):
+    """Read-only vector store searching the shards of the database in parallel.
+
+    The unfiltered searches compute the exact cosine similarities of the query
+    with all the chunks, scanned shard by shard in the worker processes of a `ShardSearcher`.
+    The filtered and two-stage searches are unchanged.
+    """
+
+    def __init__(self, *args: Any, shard_searcher: ShardSearcher, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.shard_searcher = shard_searcher
+
+    def search_all(
+        self, query_vector: np.ndarray, k: int, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        """Search all the shards in parallel and merge their results."""
+        best_rows, best_scores = self.shard_searcher.search(query_vector, k)
+
+        return list(zip(self.get_documents(best_rows), best_scores.tolist()))
+
+    def close(self) -> None:
+        """Stop the worker processes of the shard searcher."""
+        super().close()
+        self.shard_searcher.close()
+
+
+# FUNCTIONS
+def get_shard_name(chunk: Document) -> str:
+    """Get the name of the shard of a chunk: the file name of its chapter."""
+    file_name = chunk.metadata.get("file_name") or UNASSIGNED_SHARD
+
+    return re.sub(r"[^\w-]", "_", file_name)
+
+
+def group_chunks_by_shard(chunks: list[Document]) -> dict[str, list[Document]]:
+    """Group the chunks by shard, keeping their order."""
+    shards = {}
+    for chunk in chunks:
+        shards.setdefault(get_shard_name(chunk), []).append(chunk)
+
+    return shards
+
+
+def hash_shard(chunks: list[Document], embedding_key: str) -> str:
+    """Hash the embedding model and the texts of the chunks of a shard.
+
+    Parameters
+    ----------
+    chunks : list of Document
+        The chunks of the shard.
+    embedding_key : str
+        The provider, model and dimension of the embeddings.
+
+    Returns
+    -------
+    str
+        The SHA-256 hash of the shard.
+    """
+    shard_hash = hashlib.sha256(embedding_key.encode("utf-8"))
+    for chunk in chunks:
+        shard_hash.update(b"\0" + chunk.page_content.encode("utf-8"))
+
+    return shard_hash.hexdigest()
+
+
+def read_shards_manifest(vector_db_path: str) -> dict:
+    """Read the manifest of the shards of a database, empty if the database has no shards."""
+    manifest_path = os.path.join(vector_db_path, SHARDS_DIR, SHARDS_MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def embed_shard(
+    provider: str, model_name: str, texts: list[str], nb_tokens: list[int]
+) -> np.ndarray:
+    """Embed the texts of a shard, in a worker process.
+
+    Parameters
+    ----------
+    provider : str
+        The embedding provider.
+    model_name : str
+        The embedding model.
+    texts : list of str
+        The texts of the chunks of the shard.
+    nb_tokens : list of int
+        The numbers of tokens of the texts, reused by the rate limiter.
+
+    Returns
+    -------
+    np.ndarray
+        The full normalized embeddings of the chunks.
+    """
+    embedding_function = get_embedding_function(
+        provider, model_name, token_counts=dict(zip(texts, nb_tokens))
+    )
+
+    return normalize_vectors(embedding_function.embed_documents(texts))
+
+
+def build_shards(
+    chunks: list[Document],
+    vector_db_path: str,
+    provider: str,
+    model_name: str,
+    workers: int,
+    previous_path: Optional[str] = None,
+) -> Tuple[np.ndarray, int]:
+    """Embed the chunks shard by shard in parallel and save the shards.
+
+    Parameters
+    ----------
+    chunks : list of Document
+        List of text chunks, ordered by id, with their metadata.
+    vector_db_path : str
+        The directory of the vector database being built.
+    provider : str
+        The embedding provider.
+    model_name : str
+        The embedding model.
+    workers : int
+        The number of worker processes embedding the shards.
+    previous_path : str, optional
+        The directory of the published version, whose unchanged shards are reused.
+
+    Returns
+    -------
+    vectors, nb_embedded_tokens : tuple
+        - vectors : np.ndarray
+            The full normalized embeddings, one row per chunk id.
+        - nb_embedded_tokens : int
+            The number of tokens embedded (the reused shards are not embedded again).
+    """
+    logger.info("Building the shards of the embeddings...")
+
+    shards_path = os.path.join(vector_db_path, SHARDS_DIR)
+    os.makedirs(shards_path, exist_ok=True)
+    previous_shards = read_shards_manifest(previous_path) if previous_path else {}
+    embedding_key = f"{provider}/{model_name}/{LOCAL_EMBEDDING_DIM if provider == 'local' else ''}"
+
+    manifest = {}
+    vectors_by_shard = {}
+    futures = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for name, shard_chunks in group_chunks_by_shard(chunks).items():
+            shard_hash = hash_shard(shard_chunks, embedding_key)
+            manifest[name] = {
+                "hash": shard_hash,
+                "ids": [chunk.metadata["id"] for chunk in shard_chunks],
+                "nb_tokens": sum(chunk.metadata.get("nb_tokens", 0) for chunk in shard_chunks),
+            }
+            if previous_shards.get(name, {}).get("hash") == shard_hash:
+                # Unchanged shard: reuse the embeddings of the published version
+                shutil.copyfile(
+                    os.path.join(previous_path, SHARDS_DIR, f"{name}.npy"),
+                    os.path.join(shards_path, f"{name}.npy"),
+                )
+                vectors_by_shard[name] = np.load(os.path.join(shards_path, f"{name}.npy"))
+            else:
+                futures[name] = pool.submit(
+                    embed_shard,
+                    provider,
+                    model_name,
+                    [chunk.page_content for chunk in shard_chunks],
+                    [chunk.metadata["nb_tokens"] for chunk in shard_chunks],
+                )
+        for name, future in futures.items():
+            vectors_by_shard[name] = future.result()
+            np.save(os.path.join(shards_path, f"{name}.npy"), vectors_by_shard[name])
+
+    with open(os.path.join(shards_path, SHARDS_MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+
+    # Reassemble the embeddings by chunk id
+    dimension = next(iter(vectors_by_shard.values())).shape[1] if vectors_by_shard else 0
+    vectors = np.zeros((len(chunks), dimension), dtype=np.float32)
+    for name, shard_vectors in vectors_by_shard.items():
+        vectors[manifest[name]["ids"]] = shard_vectors
+    nb_embedded_tokens = sum(manifest[name]["nb_tokens"] for name in futures)
+
+    logger.info(
+        f"Embedded {len(futures)} shards ({nb_embedded_tokens} tokens) "
+        f"and reused {len(manifest) - len(futures)} unchanged shards."
+    )
+    logger.success(f"Built {len(manifest)} shards successfully.\n")
+
+    return vectors, nb_embedded_tokens
+
+
+def init_search_worker(vector_db_path: str, names: list[str]) -> None:
+    """Memory-map the shards of the group of a search worker process.
+
+    Parameters
+    ----------
+    vector_db_path : str
+        The directory of the vector database.
+    names : list of str
+        The names of the shards searched by the worker.
+    """
+    shards_path = os.path.join(vector_db_path, SHARDS_DIR)
+    shards = read_shards_manifest(vector_db_path)
+    for name in names:
+        shard = shards[name]
+        _worker_shards[name] = (
+            np.load(os.path.join(shards_path, f"{name}.npy"), mmap_mode="r"),
+            np.array(shard["ids"], dtype=np.int64),
+        )
+
+
+def search_shards(
+    names: list[str], query_vector: np.ndarray, k: int
+) -> list[list[tuple[float, int]]]:
+    """Search the k chunks most similar to the query in each shard, in a worker process.
+
+    Parameters
+    ----------
+    names : list of str
+        The names of the shards to search.
+    query_vector : np.ndarray
+        The full normalized query embedding.
+    k : int
+        The number of chunks to return per shard.
+
+    Returns
+    -------
+    list of list of tuple
+        For each shard, the (cosine similarity, chunk id) of its best chunks,
+        by decreasing similarity.
+    """
+    results = []
+    for name in names:
+        vectors, ids = _worker_shards[name]
+        if len(ids) == 0:
+            continue
+        scores = vectors @ query_vector
+        best = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        results.append(list(zip(scores[best].tolist(), ids[best].tolist())))
+
+    return results
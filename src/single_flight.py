@@ -0,0 +1,368 @@
+"""Single-flight collapsing of identical concurrent questions.
+
+When a question is projected in a classroom, many students submit the same text within
+seconds. With single-flight collapsing, the first request of a question (the leader)
+runs the retrieval and the generation of the answer, and the identical requests arriving
+while it is in flight subscribe to its result instead of running their own.
+Requests are identical if they have the same normalized question, provider, model and database version.
+
+With streaming, the answer is generated in a background thread and every subscriber
+receives the whole stream: the pieces already generated, then the next ones as they arrive.
+The numbers of calls and collapsed requests are given by `get_metrics`.
+
+Usage:
+======
+    python src/single_flight.py --query "Your question here" [--nb-requests nb-requests]
+                                [--model "model_name"] [--provider "provider"] [--stream]
+
+Arguments:
+==========
+    --query : str
+        The question submitted by all the simulated requests.
+    --nb-requests : int (optional)
+        The number of concurrent identical requests. Default is 30.
+    --model : str (optional)
+        The chat model. Default is gpt-4o.
+    --provider : str (optional)
+        The chat model provider: "openai" or "local". Default is DEFAULT_PROVIDER.
+    --stream : flag (optional)
+        Stream the shared answer to every request.
+
+Example:
+========
+    python src/single_flight.py --query "Qu'est-ce qu'une liste ?" --nb-requests 30 --provider local
+
+This command will submit the same question 30 times concurrently, answer it once
+and display the numbers of calls and collapsed requests.
+"""
+
+# METADATA
+__authors__ = ("Pierre Poulain", "Essmay Touami")
+__contact__ = "pierre.poulain@u-paris.fr"
+__copyright__ = "BSD-3 clause"
+__date__ = "2024"
+__version__ = "1.0.0"
+
+
+# LIBRARY IMPORTS
+import re
+import sys
+import random
+import argparse
+import threading
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Hashable, Iterable, Iterator, Tuple
+
+from loguru import logger
+
+# MODULE IMPORTS
+from providers import PROVIDERS, DEFAULT_PROVIDER
+from index_versions import resolve_index_path
+from query_chatbot import (
+    CHROMA_PATH,
+    OPENAI_MODEL_NAME,
+    MSGS_QUERY_NOT_RELATED,
+    load_database,
+    search_similarity_in_database,
+    format_relevant_chunks,
+    generate_answer,
+    stream_answer,
+)
+
+
+# CONSTANTS
+NB_REQUESTS = 30
+
+
+# CLASSES
+class Flight:
+    """A call in flight, with the pieces of its result already produced."""
+
+    def __init__(self) -> None:
+        self.pieces = []
+        self.result = None
+        self.error = None
+        self.done = False
+        self._condition = threading.Condition()
+
+    def append(self, piece: str) -> None:
+        """Add a piece of the streamed result."""
+        with self._condition:
+            self.pieces.append(piece)
+            self._condition.notify_all()
+
+    def finish(self, result: Any = None, error: BaseException = None) -> None:
+        """Set the result (by default the joined pieces) or the error of the call."""
+        with self._condition:
+            self.result = "".join(self.pieces) if result is None else result
+            self.error = error
+            self.done = True
+            self._condition.notify_all()
+
+    def wait(self) -> Any:
+        """Wait for the result of the call."""
+        with self._condition:
+            while not self.done:
+                self._condition.wait()
+        if self.error is not None:
+            raise self.error
+
+        return self.result
+
+    def iter_pieces(self) -> Iterator[str]:
+        """Iterate over the pieces of the streamed result, from the first one."""
+        position = 0
+        while True:
+            with self._condition:
+                while position >= len(self.pieces) and not self.done:
+                    self._condition.wait()
+                pieces = self.pieces[position:]
+                position = len(self.pieces)
+                done = self.done
+            yield from pieces
+            if done and position == len(self.pieces):
+                break
+        if self.error is not None:
+            raise self.error
+
+
+class SingleFlight:
+    """Collapse the concurrent calls sharing the same key into one call."""
+
+    def __init__(self) -> None:
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.nb_calls = 0
+        self.nb_collapsed = 0
+
+    def _join(self, key: Hashable) -> Tuple[Flight, bool]:
+        """Get the flight of a key, creating it if there is none: (flight, leader)."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.nb_collapsed += 1
+                return flight, False
+            flight = self._flights[key] = Flight()
+            self.nb_calls += 1
+
+        return flight, True
+
+    def _land(self, key: Hashable) -> None:
+        """Remove the flight of a key: the next calls start a new one."""
+        with self._lock:
+            del self._flights[key]
+
+    def do(self, key: Hashable, function: Callable[[], Any]) -> Any:
+        """Call a function, or wait for the result of the identical call in flight.
+
+        Parameters
+        ----------
+        key : hashable
+            The key of the call.
+        function : callable
+            The function called by the first caller of the key.
+
+        Returns
+        -------
+        The result of the function, shared by all the concurrent callers of the key.
+        """
+        flight, leader = self._join(key)
+        if not leader:
+            return flight.wait()
+        try:
+            result = function()
+        except BaseException as e:
+            flight.finish(error=e)
+            raise
+        else:
+            flight.finish(result)
+        finally:
+            self._land(key)
+
+        return result
+
+    def stream(self, key: Hashable, function: Callable[[], Iterable[str]]) -> Iterator[str]:
+        """Stream the result of a function, shared with the identical calls in flight.
+
+        The function is consumed in a background thread, so that slow subscribers
+        do not slow down the others.
+
+        Parameters
+        ----------
+        key : hashable
+            The key of the call.
+        function : callable
+            The function returning the stream, called by the first caller of the key.
+
+        Returns
+        -------
+        Iterator[str]
+            The pieces of the stream, from the first one.
+        """
+        flight, leader = self._join(key)
+        if leader:
+
+            def produce() -> None:
+                try:
+                    for piece in function():
+                        flight.append(piece)
+                except BaseException as e:
+                    flight.finish(error=e)
+                else:
+                    flight.finish()
+                finally:
+                    self._land(key)
+
+            threading.Thread(target=produce, name="single-flight", daemon=True).start()
+
+        return flight.iter_pieces()
+
+    def get_metrics(self) -> dict[str, int]:
+        """Get the numbers of calls, collapsed requests and calls in flight."""
+        with self._lock:
+            return {
+                "calls": self.nb_calls,
+                "collapsed": self.nb_collapsed,
+                "in_flight": len(self._flights),
+            }
+
+
+# FUNCTIONS
+def normalize_query(query: str) -> str:
+    """Normalize a question: Unicode composition, case and whitespace."""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", query)).strip().casefold()
+
+
+def answer_query(
+    single_flight: SingleFlight,
+    vector_db: Any,
+    version: str,
+    query: str,
+    model_name: str = OPENAI_MODEL_NAME,
+    provider: str = DEFAULT_PROVIDER,
+    stream: bool = False,
+) -> Any:
+    """Answer a question, sharing the retrieval and the generation with the identical requests.
+
+    Parameters
+    ----------
+    single_flight : SingleFlight
+        The single-flight group of the requests.
+    vector_db : Chroma
+        The vector database.
+    version : str
+        The version of the database, part of the key of the requests.
+    query : str
+        The question.
+    model_name : str, optional
+        The chat model, by default OPENAI_MODEL_NAME.
+    provider : str, optional
+        The chat model provider, by default DEFAULT_PROVIDER.
+    stream : bool, optional
+        Stream the answer, by default False.
+
+    Returns
+    -------
+    str or Iterator[str]
+        The answer, or the pieces of the answer if it is streamed.
+    """
+    # The same model name can be served by several providers (the local stub and OpenAI)
+    key = (normalize_query(query), provider, model_name, version)
+
+    def retrieve() -> str:
+        relevant_chunks = search_similarity_in_database(vector_db, query, logger_flag=False)
+        return format_relevant_chunks(relevant_chunks) if relevant_chunks else None
+
+    if stream:
+
+        def stream_function() -> Iterable[str]:
+            relevant_chunks = retrieve()
+            if relevant_chunks is None:
+                return [random.choice(MSGS_QUERY_NOT_RELATED)]
+            return stream_answer(query, None, relevant_chunks, model_name, provider)
+
+        return single_flight.stream(key, stream_function)
+
+    def answer_function() -> str:
+        relevant_chunks = retrieve()
+        if relevant_chunks is None:
+            return random.choice(MSGS_QUERY_NOT_RELATED)
+        return generate_answer(query, None, relevant_chunks, model_name, False, provider)
+
+    return single_flight.do(key, answer_function)
+
+
+def get_args() -> Tuple[str, int, str, str, bool]:
+    """Parse command-line arguments.
+
+    Returns
+    -------
+    query, nb_requests, model_name, provider, stream : Tuple[str, int, str, str, bool]
+        - query : str
+            The question submitted by all the requests.
+        - nb_requests : int
+            The number of concurrent identical requests.
+        - model_name : str
+            The chat model.
+        - provider : str
+            The chat model provider.
+        - stream : bool
+            Flag to stream the shared answer.
+    """
+    parser = argparse.ArgumentParser(
+        description="Submit the same question concurrently and answer it once."
+    )
+    parser.add_argument("--query", required=True, help="The question submitted by all the requests.")
+    parser.add_argument(
+        "--nb-requests",
+        dest="nb_requests",
+        type=int,
+        default=NB_REQUESTS,
+        help="The number of concurrent identical requests.",
+    )
+    parser.add_argument("--model", default=OPENAI_MODEL_NAME, help="The chat model.")
+    parser.add_argument(
+        "--provider", choices=PROVIDERS, default=DEFAULT_PROVIDER, help="The chat model provider."
+    )
+    parser.add_argument(
+        "--stream", action="store_true", default=False, help="Stream the shared answer."
+    )
+    args = parser.parse_args()
+
+    # Checks
+    if args.nb_requests <= 0:
+        logger.error("The number of requests should be a positive integer.")
+        sys.exit(1)
+
+    return args.query, args.nb_requests, args.model, args.provider, args.stream
+
+
+def main() -> None:
+    """Submit the same question concurrently and display the single-flight metrics."""
+    query, nb_requests, model_name, provider, stream = get_args()
+
+    version = resolve_index_path(CHROMA_PATH)
+    vector_db = load_database(version)[0]
+    single_flight = SingleFlight()
+
+    def request(i: int) -> str:
+        # Students do not type exactly the same text
+        student_query = query.upper() if i % 2 else f"  {query} "
+        answer = answer_query(
+            single_flight, vector_db, version, student_query, model_name, provider, stream
+        )
+        return "".join(answer) if stream else answer
+
+    with ThreadPoolExecutor(max_workers=nb_requests) as executor:
+        answers = list(executor.map(request, range(nb_requests)))
+
+    metrics = single_flight.get_metrics()
+    print(f"Answer: {answers[0]}")
+    print(f"Requests: {nb_requests}, distinct answers: {len(set(answers))}")
+    print(f"Calls: {metrics['calls']}, collapsed requests: {metrics['collapsed']}")
+
+
+# MAIN PROGRAM
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+"""Wall time, CPU time and peak memory of the stages of the scripts.
+
+The ingestion scripts (`create_database.py`, `parse_clean_markdown.py` and
+`analysis/get_chunk_stats.py`) run their stages inside `StageProfiler.stage` blocks.
+With their `--profile [report-path]` option, each stage records:
+
+- wall_s : the elapsed time, in seconds,
+- cpu_s : the CPU time of the process, in seconds,
+- peak_mb : the peak of the memory allocated by Python during the stage (tracemalloc),
+  above the memory allocated when the stage started, in MB,
+- net_mb : the memory still allocated at the end of the stage, in MB.
+
+A stage run several times (once per file for instance) is reported once, with the sum
+of its times, the maximum of its peaks and its number of calls. The report is saved
+as JSON, with the maximum resident memory of the process, to be compared across runs.
+Tracing the allocations slows down the stages unevenly (2 to 10 times):
+a profiler created with `trace_memory=False` only measures the times (peak_mb and net_mb are 0).
+With `--cprofile-dir [directory]`, the calls of each stage are also profiled with cProfile,
+and the statistics are dumped to `[directory]/[stage].prof` (to read with `pstats` or snakeviz).
+
+Usage:
+======
+    python src/stage_profiler.py --report [report-path] [--baseline baseline-path]
+
+Arguments:
+==========
+    --report : str
+        The path of the JSON report of a profiled run.
+    --baseline : str (optional)
+        The path of the JSON report of a previous run, to compare the stages with.
+
+Example:
+========
+    python src/create_database.py --data-path data/markdown_processed --chroma-path chroma_db --profile profile_new.json
+    python src/stage_profiler.py --report profile_new.json --baseline profile_old.json
+
+This command will display the time and the memory of each stage of the database build,
+and their ratios to the ones of the previous run.
+"""
+
+# METADATA
+__authors__ = ("Pierre Poulain", "Essmay Touami")
+__contact__ = "pierre.poulain@u-paris.fr"
+__copyright__ = "BSD-3 clause"
+__date__ = "2024"
+__version__ = "1.0.0"
+
+
+# LIBRARY IMPORTS
+import os
+import re
+import sys
+import json
+import time
+import cProfile
+import argparse
+import platform
+import resource
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+from typing import ContextManager, Iterator, Optional, Tuple
+
+from loguru import logger
+
+# MODULE IMPORTS
+from token_ledger import display_summary
+
+
+# CONSTANTS
+MB = 1024 * 1024
+
+
+# CLASSES
+class StageProfiler:
+    """Record the time and the memory of the stages of a script.
+
+    Parameters
+    ----------
+    enabled : bool, optional
+        Profile the stages, by default True. A disabled profiler does not measure anything.
+    cprofile_dir : str, optional
+        The directory of the cProfile statistics of the stages, by default None (no cProfile).
+    trace_memory : bool, optional
+        Measure the memory of the stages with tracemalloc, by default True.
+    """
+
+    def __init__(
+        self, enabled: bool = True, cprofile_dir: Optional[str] = None, trace_memory: bool = True
+    ) -> None:
+        self.enabled = enabled
+        self.cprofile_dir = cprofile_dir
+        self.trace_memory = trace_memory
+        self.stages = {}
+        self._open_stages = []
+        self._cprofiles = {}
+        self._cprofile_active = False
+        self._started_tracemalloc = False
+        if enabled and trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        if enabled and cprofile_dir:
+            os.makedirs(cprofile_dir, exist_ok=True)
+
+    def stage(self, name: str) -> ContextManager:
+        """Measure a stage: `with profiler.stage("split"): ...`.
+
+        The stages can be nested: the name of a nested stage is prefixed with
+        the name of its parent stage ("save/embed").
+        """
+        if not self.enabled:
+            return nullcontext()
+        return self._measure(name)
+
+    @contextmanager
+    def _measure(self, name: str) -> Iterator[None]:
+        """Measure the time and the memory of a stage."""
+        current, peak = self._get_traced_memory()
+        if self._open_stages:
+            parent = self._open_stages[-1]
+            name = f"{parent['name']}/{name}"
+            # Keep the peak reached by the parent so far, before the peak is reset
+            parent["peak_memory"] = max(parent["peak_memory"], peak)
+        record = {"name": name, "start_memory": current, "peak_memory": current}
+        self._open_stages.append(record)
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        # Only one cProfile profiler can run at once: the nested stages are in their parent's
+        profiler = None
+        if self.cprofile_dir and not self._cprofile_active:
+            # The calls of all the runs of a stage are accumulated in its profiler
+            profiler = self._cprofiles.setdefault(name, cProfile.Profile())
+            self._cprofile_active = True
+            profiler.enable()
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start_wall
+            cpu = time.process_time() - start_cpu
+            if profiler is not None:
+                profiler.disable()
+                self._cprofile_active = False
+            current, peak = self._get_traced_memory()
+            record["peak_memory"] = max(record["peak_memory"], peak)
+            self._open_stages.pop()
+            # The peak of a nested stage is also a peak of its parent
+            if self._open_stages:
+                parent = self._open_stages[-1]
+                parent["peak_memory"] = max(parent["peak_memory"], record["peak_memory"])
+            self._add(
+                name,
+                wall,
+                cpu,
+                record["peak_memory"] - record["start_memory"],
+                current - record["start_memory"],
+            )
+
+    def _get_traced_memory(self) -> Tuple[int, int]:
+        """The current and peak memory traced by tracemalloc, (0, 0) without memory tracing."""
+        if not self.trace_memory:
+            return 0, 0
+        return tracemalloc.get_traced_memory()
+
+    def _add(self, name: str, wall: float, cpu: float, peak: int, net: int) -> None:
+        """Add a run of a stage to its totals."""
+        stage = self.stages.setdefault(
+            name, {"stage": name, "calls": 0, "wall_s": 0.0, "cpu_s": 0.0, "peak_mb": 0.0, "net_mb": 0.0}
+        )
+        stage["calls"] += 1
+        stage["wall_s"] += wall
+        stage["cpu_s"] += cpu
+        stage["peak_mb"] = max(stage["peak_mb"], peak / MB)
+        stage["net_mb"] += net / MB
+
+    def get_report(self, script: str) -> dict:
+        """Get the report of the stages, in their order of first run.
+
+        Parameters
+        ----------
+        script : str
+            The name of the profiled script.
+
+        Returns
+        -------
+        dict
+            The report: run information, maximum resident memory and stages.
+        """
+        stages = [
+            {
+                **stage,
+                "wall_s": round(stage["wall_s"], 4),
+                "cpu_s": round(stage["cpu_s"], 4),
+                "peak_mb": round(stage["peak_mb"], 3),
+                "net_mb": round(stage["net_mb"], 3),
+            }
+            for stage in self.stages.values()
+        ]
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        max_rss_mb = max_rss / MB if sys.platform == "darwin" else max_rss / 1024
+
+        return {
+            "script": script,
+            "timestamp": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "max_rss_mb": round(max_rss_mb, 1),
+            "stages": stages,
+        }
+
+    def write_report(self, report_path: str, script: str) -> None:
+        """Save the report of the stages as JSON and display it.
+
+        Parameters
+        ----------
+        report_path : str
+            The path of the JSON report.
+        script : str
+            The name of the profiled script.
+        """
+        if not self.enabled:
+            return
+        report = self.get_report(script)
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+        with open(report_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        for name, profiler in self._cprofiles.items():
+            file_name = re.sub(r"[^\w.-]", "_", name)
+            profiler.dump_stats(os.path.join(self.cprofile_dir, f"{file_name}.prof"))
+        display_summary(report["stages"])
+        logger.success(f"Saved the profile of the stages to '{report_path}'.")
+
+
+# FUNCTIONS
+def add_profile_arguments(parser: argparse.ArgumentParser, default_report: str) -> None:
+    """Add the --profile and --cprofile-dir options to the parser of a script.
+
+    Parameters
+    ----------
+    parser : argparse.ArgumentParser
+        The parser of the script.
+    default_report : str
+        The path of the report when --profile is given without a path.
+    """
+    parser.add_argument(
+        "--profile",
+        dest="profile_path",
+        nargs="?",
+        const=default_report,
+        default=None,
+        help="Profile the time and the memory of the stages and save the JSON report to this path.",
+    )
+    parser.add_argument(
+        "--cprofile-dir",
+        dest="cprofile_dir",
+        default=None,
+        help="Also dump the cProfile statistics of each stage to this directory (with --profile).",
+    )
+
+
+def compare_reports(report: dict, baseline: dict) -> list[dict]:
+    """Compare the stages of a run to the ones of a previous run.
+
+    Parameters
+    ----------
+    report : dict
+        The report of the run.
+    baseline : dict
+        The report of the previous run.
+
+    Returns
+    -------
+    comparison : list of dict
+        For each stage of the run, its time and peak memory and their ratios
+        to the previous run ("-" for the stages absent from the previous run).
+    """
+    baseline_stages = {stage["stage"]: stage for stage in baseline["stages"]}
+    comparison = []
+    for stage in report["stages"]:
+        previous = baseline_stages.get(stage["stage"])
+        row = {"stage": stage["stage"], "wall_s": stage["wall_s"], "peak_mb": stage["peak_mb"]}
+        for key in ("wall_s", "peak_mb"):
+            if previous is None:
+                row[f"{key}_ratio"] = "-"
+            else:
+                row[f"{key}_ratio"] = round(stage[key] / max(previous[key], 1e-6), 2)
+        comparison.append(row)
+    comparison.append(
+        {
+            "stage": "max_rss_mb",
+            "wall_s": "-",
+            "peak_mb": report["max_rss_mb"],
+            "wall_s_ratio": "-",
+            "peak_mb_ratio": round(report["max_rss_mb"] / max(baseline["max_rss_mb"], 1e-6), 2),
+        }
+    )
+
+    return comparison
+
+
+def get_args() -> Tuple[str, Optional[str]]:
+    """Parse command-line arguments.
+
+    Returns
+    -------
+    report_path, baseline_path : Tuple[str, str]
+        - report_path : str
+            The path of the JSON report.
+        - baseline_path : str or None
+            The path of the JSON report of a previous run.
+    """
+    parser = argparse.ArgumentParser(description="Display and compare the profiles of the stages.")
+    parser.add_argument("--report", dest="report_path", required=True, help="The JSON report.")
+    parser.add_argument(
+        "--baseline",
+        dest="baseline_path",
+        default=None,
+        help="The JSON report of a previous run, to compare the stages with.",
+    )
+    args = parser.parse_args()
+
+    # Checks
+    for path in (args.report_path, args.baseline_path):
+        if path is not None and not os.path.exists(path):
+            logger.error(f"The report '{path}' does not exist.")
+            sys.exit(1)
+
+    return args.report_path, args.baseline_path
+
+
+# MAIN PROGRAM
+if __name__ == "__main__":
+    report_path, baseline_path = get_args()
+    with open(report_path, "r", encoding="utf-8") as f:
+        report = json.load(f)
+    print(f"{report['script']} ({report['timestamp']}), max RSS {report['max_rss_mb']} MB")
+    if baseline_path is None:
+        display_summary(report["stages"])
+    else:
+        with open(baseline_path, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        display_summary(compare_reports(report, baseline))
@@ -0,0 +1,356 @@
+"""Token and cost accounting ledger for database builds and chatbot queries.
+
+This module appends one line per database build (embedding tokens) and per query
+(prompt and completion tokens) to a compact CSV ledger, and summarizes the ledger
+with totals, percentiles and estimated costs grouped by day, model or retrieved chapter.
+The tokens of a query are split evenly between its retrieved chapters, so that the totals
+of the chapters add up to the real spend.
+
+Usage:
+======
+    python src/token_ledger.py --ledger [ledger-path] --by [day|model|chapter]
+
+Arguments:
+==========
+    --ledger : str (optional)
+        The path to the ledger file. Default is token_ledger.csv.
+    --by : str (optional)
+        The key used to group the ledger entries: day, model or chapter. Default is day.
+
+Example:
+========
+    python src/token_ledger.py --ledger token_ledger.csv --by model
+
+This command will read the ledger file `token_ledger.csv` and display, for each model,
+the number of calls, the total of prompt and completion tokens,
+the 50th, 90th and 99th percentiles of the tokens per call and the estimated cost.
+"""
+
+# METADATA
+__authors__ = ("Pierre Poulain", "Essmay Touami")
+__contact__ = "pierre.poulain@u-paris.fr"
+__copyright__ = "BSD-3 clause"
+__date__ = "2024"
+__version__ = "1.0.0"
+
+
+# LIBRARY IMPORTS
+import os
+import sys
+import csv
+import argparse
+from datetime import datetime, timezone
+from statistics import quantiles
+from typing import TextIO
+
+from loguru import logger
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: lock the ledger with msvcrt
+    fcntl = None
+    import msvcrt
+
+
+# CONSTANTS
+TOKEN_LEDGER_PATH = "token_ledger.csv"
+LEDGER_FIELDS = [
+    "timestamp",
+    "kind",
+    "model",
+    "prompt_tokens",
+    "completion_tokens",
+    "chapters",
+]
+# Price in US dollars per million tokens: (prompt, completion)
+MODEL_PRICES = {
+    "gpt-4o": (5.00, 15.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-3.5-turbo": (0.50, 1.50),
+    "text-embedding-3-large": (0.13, 0.0),
+    "text-embedding-3-small": (0.02, 0.0),
+}
+
+
+# FUNCTIONS
+def lock_ledger(f: TextIO) -> None:
+    """Lock the open ledger file, waiting for the other processes to release it."""
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return
+    # msvcrt locks bytes from the current position: lock the first byte, even past the end
+    f.seek(0)
+    while True:
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            # LK_LOCK gives up after 10 attempts
+            continue
+
+
+def unlock_ledger(f: TextIO) -> None:
+    """Release the lock of the open ledger file."""
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_UN)
+        return
+    f.seek(0)
+    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def record_usage(
+    kind: str,
+    model: str,
+    prompt_tokens: int,
+    completion_tokens: int = 0,
+    chapters: list[str] = [],
+    ledger_path: str = TOKEN_LEDGER_PATH,
+) -> None:
+    """Append a token usage entry to the ledger.
+
+    The ledger is locked while the entry (and the header of a new ledger) is written,
+    so that concurrent processes appending to the same ledger do not interleave their lines.
+
+    Parameters
+    ----------
+    kind : str
+        The kind of usage: "embedding" for a database build, "query" for a question.
+    model : str
+        The name of the model that consumed the tokens.
+    prompt_tokens : int
+        The number of input tokens (embedded text or filled prompt).
+    completion_tokens : int, optional
+        The number of tokens generated by the model, by default 0.
+    chapters : list of str, optional
+        The chapters of the chunks retrieved for the query, by default [].
+    ledger_path : str, optional
+        The path to the ledger file, by default TOKEN_LEDGER_PATH.
+    """
+    timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+    # Remove duplicated chapters while keeping the order
+    chapters_field = "|".join(dict.fromkeys(chapters))
+
+    with open(ledger_path, "a", newline="", encoding="utf-8") as f:
+        lock_ledger(f)
+        try:
+            writer = csv.writer(f)
+            # Write the header if the ledger is new (checked under the lock)
+            if f.seek(0, os.SEEK_END) == 0:
+                writer.writerow(LEDGER_FIELDS)
+            writer.writerow(
+                [timestamp, kind, model, prompt_tokens, completion_tokens, chapters_field]
+            )
+            f.flush()
+        finally:
+            unlock_ledger(f)
+
+    logger.info(
+        f"Recorded {prompt_tokens} prompt and {completion_tokens} completion tokens for {model} in '{ledger_path}'."
+    )
+
+
+def read_ledger(ledger_path: str) -> list[dict]:
+    """Read the entries of the ledger.
+
+    Parameters
+    ----------
+    ledger_path : str
+        The path to the ledger file.
+
+    Returns
+    -------
+    entries : list of dict
+        List of ledger entries with token counts converted to integers.
+    """
+    logger.info(f"Reading the ledger '{ledger_path}'...")
+
+    entries = []
+    with open(ledger_path, "r", newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            row["prompt_tokens"] = int(row["prompt_tokens"])
+            row["completion_tokens"] = int(row["completion_tokens"])
+            row["chapters"] = row["chapters"].split("|") if row["chapters"] else []
+            entries.append(row)
+
+    logger.success(f"Read {len(entries)} entries from the ledger.\n")
+
+    return entries
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """Estimate the cost of the tokens consumed by a model.
+
+    Parameters
+    ----------
+    model : str
+        The name of the model.
+    prompt_tokens : int
+        The number of input tokens.
+    completion_tokens : int
+        The number of generated tokens.
+
+    Returns
+    -------
+    float
+        The estimated cost in US dollars, 0 if the model price is unknown.
+    """
+    prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1e6
+
+
+def get_group_keys(entry: dict, by: str) -> list[str]:
+    """Get the keys of the groups an entry belongs to.
+
+    The tokens of the entry are split evenly between its groups.
+
+    Parameters
+    ----------
+    entry : dict
+        A ledger entry.
+    by : str
+        The grouping key: day, model or chapter.
+
+    Returns
+    -------
+    list of str
+        The group keys. A query retrieving several chapters belongs to several groups.
+    """
+    if by == "day":
+        return [entry["timestamp"][:10]]
+    if by == "model":
+        return [entry["model"]]
+    # chapter
+    return entry["chapters"] or ["(none)"]
+
+
+def summarize_ledger(entries: list[dict], by: str = "day") -> list[dict]:
+    """Summarize the ledger entries by group.
+
+    Parameters
+    ----------
+    entries : list of dict
+        List of ledger entries.
+    by : str, optional
+        The grouping key: day, model or chapter, by default "day".
+
+    Returns
+    -------
+    summary : list of dict
+        One dictionary per group with the number of calls, the token totals,
+        the percentiles of tokens per call and the estimated cost.
+    """
+    logger.info(f"Summarizing the ledger by {by}...")
+
+    # Each entry is added to its groups with its share of the tokens
+    groups = {}
+    for entry in entries:
+        keys = get_group_keys(entry, by)
+        for key in keys:
+            groups.setdefault(key, []).append((entry, 1 / len(keys)))
+
+    summary = []
+    for key, group in sorted(groups.items()):
+        tokens_per_call = [
+            (entry["prompt_tokens"] + entry["completion_tokens"]) * share
+            for entry, share in group
+        ]
+        if len(tokens_per_call) > 1:
+            percentiles = quantiles(tokens_per_call, n=100, method="inclusive")
+            p50, p90, p99 = percentiles[49], percentiles[89], percentiles[98]
+        else:
+            p50 = p90 = p99 = tokens_per_call[0]
+        summary.append(
+            {
+                by: key,
+                "calls": len(group),
+                "prompt_tokens": round(sum(entry["prompt_tokens"] * share for entry, share in group)),
+                "completion_tokens": round(
+                    sum(entry["completion_tokens"] * share for entry, share in group)
+                ),
+                "p50": round(p50, 1),
+                "p90": round(p90, 1),
+                "p99": round(p99, 1),
+                "cost_usd": round(
+                    sum(
+                        estimate_cost(
+                            entry["model"],
+                            entry["prompt_tokens"],
+                            entry["completion_tokens"],
+                        )
+                        * share
+                        for entry, share in group
+                    ),
+                    4,
+                ),
+            }
+        )
+
+    logger.success(f"Summarized the ledger into {len(summary)} groups.\n")
+
+    return summary
+
+
+def display_summary(summary: list[dict]) -> None:
+    """Display the summary as a text table.
+
+    Parameters
+    ----------
+    summary : list of dict
+        The summary computed by `summarize_ledger`.
+    """
+    if not summary:
+        print("The ledger is empty.")
+        return
+    columns = list(summary[0].keys())
+    widths = [
+        max(len(column), *(len(str(row[column])) for row in summary))
+        for column in columns
+    ]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in summary:
+        print("  ".join(str(row[column]).ljust(width) for column, width in zip(columns, widths)))
+
+
+def get_args() -> tuple[str, str]:
+    """Parse command-line arguments.
+
+    Returns
+    -------
+    ledger_path, by : Tuple[str, str]
+        - ledger_path : str
+            The path to the ledger file.
+        - by : str
+            The grouping key: day, model or chapter.
+    """
+    parser = argparse.ArgumentParser(
+        description="Summarize the token and cost ledger of builds and queries."
+    )
+    parser.add_argument(
+        "--ledger",
+        dest="ledger_path",
+        default=TOKEN_LEDGER_PATH,
+        help="The path to the ledger file.",
+    )
+    parser.add_argument(
+        "--by",
+        choices=["day", "model", "chapter"],
+        default="day",
+        help="The key used to group the ledger entries.",
+    )
+    args = parser.parse_args()
+
+    # Checks
+    if not os.path.exists(args.ledger_path):
+        logger.error(f"The ledger file '{args.ledger_path}' does not exist.")
+        sys.exit(1)
+
+    return args.ledger_path, args.by
+
+
+# MAIN PROGRAM
+if __name__ == "__main__":
+    ledger_path, by = get_args()
+    entries = read_ledger(ledger_path)
+    display_summary(summarize_ledger(entries, by))
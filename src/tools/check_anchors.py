@@ -0,0 +1,247 @@
+"""Check the URLs of the chunks offline, against the headers of the Markdown files.
+
+The URLs of the chunks are built by `add_url_to_metadata` from the Markdown headers.
+This script builds the set of expected anchors of every file from the headers of the
+processed Markdown files, with the same rules as `preprocess_for_url`, and checks every
+chunk URL against this set in memory, without downloading the course website.
+
+Usage:
+======
+    python src/tools/check_anchors.py --data-path [data-path] (--chroma-path [chroma-path] | --details [details])
+
+Arguments:
+==========
+    --data-path : str (optional)
+        The directory containing the processed Markdown files. Default is data/markdown_processed.
+    --chroma-path : str
+        The path to the directory containing the Chroma database.
+    --details : str
+        The chunk details file written by get_chunk_stats.py (`[chroma-path]_chunks_details.txt`).
+
+Example:
+========
+    python src/tools/check_anchors.py --chroma-path chroma_db
+
+This command will check the URL of every chunk of the `chroma_db` database against the headers
+of the files of `data/markdown_processed`, and exit with an error if an URL does not match any header.
+"""
+
+# METADATA
+__authors__ = ("Pierre Poulain", "Essmay Touami")
+__contact__ = "pierre.poulain@u-paris.fr"
+__copyright__ = "BSD-3 clause"
+__date__ = "2024"
+__version__ = "1.0.0"
+
+
+# LIBRARY IMPORTS
+import os
+import re
+import sys
+import glob
+import time
+import argparse
+from urllib.parse import urlparse
+
+from loguru import logger
+from langchain_community.vectorstores import Chroma
+
+# MODULE IMPORTS
+# Add the project root directory to the sys.path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if project_root not in sys.path:
+    sys.path.append(project_root)
+from create_database import preprocess_for_url
+from check_url import get_url
+
+
+# CONSTANTS
+DATA_PATH = "data/markdown_processed"
+BATCH_SIZE = 1000
+# Same header levels as the splitter of create_database.py
+HEADER_PATTERN = re.compile(r"^(#{1,4})(?:\s+(.*))?$")
+SUBSUBSECTION_LEVEL = 4
+
+
+# FUNCTIONS
+def get_args() -> tuple[str, str, str]:
+    """Parse command-line arguments.
+
+    Returns
+    -------
+    data_path, chroma_path, details_path : Tuple[str, str, str]
+        - data_path : str
+            The directory containing the processed Markdown files.
+        - chroma_path : str
+            The path to the Chroma database, or None.
+        - details_path : str
+            The path to the chunk details file, or None.
+    """
+    parser = argparse.ArgumentParser(
+        description="Check the URLs of the chunks offline, against the headers of the Markdown files."
+    )
+    parser.add_argument(
+        "--data-path",
+        dest="data_path",
+        default=DATA_PATH,
+        help="The directory containing the processed Markdown files.",
+    )
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument(
+        "--chroma-path",
+        dest="chroma_path",
+        help="The path to the directory containing the Chroma database.",
+    )
+    source.add_argument(
+        "--details",
+        dest="details_path",
+        help="The chunk details file written by get_chunk_stats.py.",
+    )
+    args = parser.parse_args()
+
+    # Checks
+    for path in (args.data_path, args.chroma_path, args.details_path):
+        if path and not os.path.exists(path):
+            logger.error(f"'{path}' does not exist.")
+            sys.exit(1)
+
+    return args.data_path, args.chroma_path, args.details_path
+
+
+def get_header_anchors(content: str) -> set[str]:
+    """Get the anchors of the headers of a Markdown file.
+
+    Headers in code blocks are ignored, as in the Markdown header splitter.
+
+    Parameters
+    ----------
+    content : str
+        The content of the Markdown file.
+
+    Returns
+    -------
+    anchors : set of str
+        The anchors of the headers, with their leading '#'.
+    """
+    anchors = set()
+    in_code_block = False
+    for line in content.split("\n"):
+        stripped_line = line.strip()
+        if stripped_line.startswith("```"):
+            in_code_block = not in_code_block
+            continue
+        if in_code_block:
+            continue
+        header = HEADER_PATTERN.match(stripped_line)
+        if header and header.group(2):
+            level = len(header.group(1))
+            anchors.add(
+                preprocess_for_url(header.group(2).strip(), level == SUBSUBSECTION_LEVEL)
+            )
+
+    return anchors
+
+
+def build_anchor_index(data_path: str) -> dict[str, set[str]]:
+    """Build the expected anchors of every Markdown file.
+
+    Parameters
+    ----------
+    data_path : str
+        The directory containing the processed Markdown files.
+
+    Returns
+    -------
+    anchor_index : dict
+        The set of anchors of each file, by file name (without extension).
+    """
+    anchor_index = {}
+    for file_path in sorted(glob.glob(os.path.join(data_path, "*.md"))):
+        file_name = os.path.splitext(os.path.basename(file_path))[0]
+        with open(file_path, "r", encoding="utf-8") as f:
+            anchor_index[file_name] = get_header_anchors(f.read())
+
+    logger.info(
+        f"Indexed {sum(len(anchors) for anchors in anchor_index.values())} anchors "
+        f"of {len(anchor_index)} files."
+    )
+
+    return anchor_index
+
+
+def get_chroma_urls(chroma_path: str, batch_size: int = BATCH_SIZE) -> set[str]:
+    """Get the URLs of the chunks of a Chroma database, reading the metadata in batches.
+
+    Parameters
+    ----------
+    chroma_path : str
+        The path to the directory containing the Chroma database.
+    batch_size : int
+        The number of chunks read at once.
+
+    Returns
+    -------
+    urls : set of str
+        The URLs of the chunks.
+    """
+    # Only the metadata are read: no embedding function is needed
+    vector_db = Chroma(persist_directory=chroma_path)
+    urls = set()
+    offset = 0
+    while True:
+        results = vector_db.get(limit=batch_size, offset=offset, include=["metadatas"])
+        if not results["ids"]:
+            break
+        urls.update(metadata.get("url", "") for metadata in results["metadatas"])
+        offset += len(results["ids"])
+    logger.info(f"Found {len(urls)} URLs in the database.")
+
+    return urls
+
+
+def check_anchors(urls: set[str], anchor_index: dict[str, set[str]]) -> list[str]:
+    """Check the URLs against the anchors of the Markdown files.
+
+    Parameters
+    ----------
+    urls : set of str
+        The URLs to check, as `https://host/<file_name>/#<anchor>`.
+    anchor_index : dict
+        The set of anchors of each file, by file name.
+
+    Returns
+    -------
+    invalid_urls : list of str
+        The URLs whose file or anchor does not exist.
+    """
+    invalid_urls = []
+    for url in sorted(urls):
+        parsed_url = urlparse(url)
+        file_name = parsed_url.path.strip("/")
+        if file_name not in anchor_index or f"#{parsed_url.fragment}" not in anchor_index[file_name]:
+            invalid_urls.append(url)
+
+    return invalid_urls
+
+
+def main() -> None:
+    """Check the URLs of the chunks against the headers of the Markdown files."""
+    data_path, chroma_path, details_path = get_args()
+
+    start = time.perf_counter()
+    anchor_index = build_anchor_index(data_path)
+    urls = get_chroma_urls(chroma_path) if chroma_path else get_url(details_path)
+    invalid_urls = check_anchors(urls, anchor_index)
+    elapsed = time.perf_counter() - start
+
+    for url in invalid_urls:
+        logger.error(f"Invalid anchor: {url}")
+    if invalid_urls:
+        logger.error(f"{len(invalid_urls)} invalid URL(s) out of {len(urls)} ({elapsed * 1e3:.1f} ms).")
+        sys.exit(1)
+    logger.success(f"All the {len(urls)} URLs are valid ({elapsed * 1e3:.1f} ms).")
+
+
+# MAIN PROGRAM
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""Check the degraded mode of the chatbot on a database, without calling the embedding API.
+
+The circuit of the embedding API is opened, so that every search of `search_with_deadline`
+falls back to the local lexical index of the database, as when the API is unavailable.
+The questions of the question bank are then searched, and the check fails if:
+
+- a search raises an error (for instance on a database built before the chunk store,
+  whose Chroma ids are not the chunk ids),
+- a chunk has no id, no text or a score outside [0, 1],
+- a question unrelated to the course retrieves chunks,
+- the routing features of the lexical chunks have a relevance score.
+
+Usage:
+======
+    python src/tools/check_degraded_mode.py --chroma-path [chroma-path] [--questions questions-path]
+
+Arguments:
+==========
+    --chroma-path : str (optional)
+        The path to the directory containing the Chroma database. Default is chroma_db.
+    --questions : str (optional)
+        The YAML file of questions. Default is data/banque_questions_python.yaml.
+
+Example:
+========
+    python src/tools/check_degraded_mode.py --chroma-path chroma_db
+
+This command will search the questions in the lexical index of the `chroma_db` database
+and exit with an error if the degraded mode fails on any of them.
+"""
+
+# METADATA
+__authors__ = ("Pierre Poulain", "Essmay Touami")
+__contact__ = "pierre.poulain@u-paris.fr"
+__copyright__ = "BSD-3 clause"
+__date__ = "2024"
+__version__ = "1.0.0"
+
+
+# LIBRARY IMPORTS
+import os
+import sys
+import argparse
+
+import yaml
+from loguru import logger
+from langchain_community.vectorstores import Chroma
+
+# MODULE IMPORTS
+# Add the project root directory to the sys.path
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if project_root not in sys.path:
+    sys.path.append(project_root)
+from deadlines import Deadline
+from model_router import get_route_features
+from query_chatbot import CHROMA_PATH, EMBEDDING_BREAKER, load_database, search_with_deadline
+
+
+# CONSTANTS
+QUESTIONS_PATH = "data/banque_questions_python.yaml"
+DEADLINE = 10.0
+UNRELATED_QUESTIONS = (
+    "Quelle est la recette de la tarte aux pommes ?",
+    "Qui a gagné la coupe du monde de football en 2018 ?",
+    "Quel temps fera-t-il demain à Paris ?",
+    "Comment réparer un pneu de vélo crevé ?",
+)
+
+
+# FUNCTIONS
+def get_args() -> tuple[str, str]:
+    """Parse command-line arguments.
+
+    Returns
+    -------
+    chroma_path, questions_path : Tuple[str, str]
+        - chroma_path : str
+            The path to the Chroma database.
+        - questions_path : str
+            The YAML file of questions.
+    """
+    parser = argparse.ArgumentParser(
+        description="Check the degraded mode of the chatbot on a database."
+    )
+    parser.add_argument(
+        "--chroma-path",
+        dest="chroma_path",
+        default=CHROMA_PATH,
+        help="The path to the directory containing the Chroma database.",
+    )
+    parser.add_argument(
+        "--questions",
+        dest="questions_path",
+        default=QUESTIONS_PATH,
+        help="The YAML file of questions.",
+    )
+    args = parser.parse_args()
+
+    # Checks
+    for path in (args.chroma_path, args.questions_path):
+        if not os.path.exists(path):
+            logger.error(f"'{path}' does not exist.")
+            sys.exit(1)
+
+    return args.chroma_path, args.questions_path
+
+
+def load_questions(questions_path: str) -> list[str]:
+    """Load the questions of the YAML file, grouped by chapter."""
+    with open(questions_path, "r", encoding="utf-8") as f:
+        data = yaml.safe_load(f)
+
+    return [
+        text
+        for chapter_questions in data["questions"].values()
+        for question in chapter_questions
+        for text in question.values()
+    ]
+
+
+def check_question(vector_db: Chroma, question: str, related: bool) -> tuple[list[str], int]:
+    """Search a question in the degraded mode and check the retrieved chunks.
+
+    Parameters
+    ----------
+    vector_db : Chroma or ChunkVectorStore
+        The vector database.
+    question : str
+        The question.
+    related : bool
+        Whether the question is about the course (unrelated questions should retrieve no chunk).
+
+    Returns
+    -------
+    errors, nb_chunks : Tuple[list[str], int]
+        The errors found and the number of retrieved chunks.
+    """
+    try:
+        scored_chunks, lexical = search_with_deadline(vector_db, question, Deadline(DEADLINE))
+    except Exception as e:
+        return [f"{question!r}: the search failed ({type(e).__name__}: {e})"], 0
+    errors = []
+    if not lexical:
+        errors.append(f"{question!r}: the semantic search ran while the circuit is open")
+    for chunk, score in scored_chunks:
+        if "id" not in chunk.metadata or not chunk.page_content:
+            errors.append(f"{question!r}: a chunk has no id or no text ({chunk.metadata})")
+        if not 0 <= score <= 1:
+            errors.append(f"{question!r}: the score {score} is not in [0, 1]")
+    if not related and scored_chunks:
+        errors.append(f"{question!r}: unrelated question retrieving {len(scored_chunks)} chunk(s)")
+    if get_route_features(question, scored_chunks, lexical=lexical)["top_score"] is not None:
+        errors.append(f"{question!r}: the lexical scores are given to the router")
+
+    return errors, len(scored_chunks)
+
+
+def main() -> None:
+    """Check the degraded mode on the questions of the bank and on unrelated questions."""
+    chroma_path, questions_path = get_args()
+
+    vector_db = load_database(chroma_path)[0]
+    # Open the circuit of the embedding API: the searches use the lexical index
+    for _ in range(EMBEDDING_BREAKER.failure_threshold):
+        EMBEDDING_BREAKER.record_failure()
+    # Only the errors of the check are displayed, not the logs of each search
+    logger.disable("query_chatbot")
+
+    errors = []
+    nb_answered = 0
+    questions = load_questions(questions_path)
+    for question in questions:
+        question_errors, nb_chunks = check_question(vector_db, question, related=True)
+        errors += question_errors
+        nb_answered += nb_chunks > 0
+    for question in UNRELATED_QUESTIONS:
+        errors += check_question(vector_db, question, related=False)[0]
+
+    for error in errors:
+        logger.error(error)
+    if errors:
+        logger.error(f"The degraded mode failed {len(errors)} check(s).")
+        sys.exit(1)
+    logger.success(
+        f"Degraded mode: {nb_answered} of the {len(questions)} questions retrieved chunks, "
+        f"none of the {len(UNRELATED_QUESTIONS)} unrelated questions did."
+    )
+
+
+# MAIN PROGRAM
+if __name__ == "__main__":
+    main()
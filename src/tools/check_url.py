@@ -2,31 +2,69 @@
 
 This script reads a file containing URLs and checks if each URL is valid. If the URL is valid, it also checks if the anchor is valid.
 
+The URLs are grouped by page: each page is fetched once, by a pool of threads which keep
+their HTTP connections alive, and the fragments of all the URLs of the page are checked
+against the ids of the elements of the page. The results are saved as a CSV table.
+
 Usage:
 ======
-    python src/tools/check_url.py <file_name>
+    python src/tools/check_url.py <file_name> [--workers workers] [--timeout timeout] [--output output]
 
 Arguments:
 ==========
     file_name: str
         The path to the file containing URLs.
+    --workers: int (optional)
+        The number of pages fetched concurrently. Default is 8.
+    --timeout: float (optional)
+        The timeout of the connections, in seconds. Default is 10.
+    --output: str (optional)
+        The CSV file where the results are saved, "-" for the standard output. Default is url_check.csv.
 
 Example:
 ========
     python src/tools/check_url.py chroma_db_chunks_details.txt
 
-This command will read the file `chroma_db_chunks_details.txt` and check each URL in the file. 
+This command will read the file `chroma_db_chunks_details.txt` and check each URL in the file.
 If the URL is valid, it will also check if the anchor is valid.
 
 """
 
+import csv
 import sys
-from urllib.parse import urlparse
-from urllib.request import urlopen
+import argparse
+import threading
+import http.client
+from html.parser import HTMLParser
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlparse, urldefrag, unquote
 
 from loguru import logger
 
 
+WORKERS = 8
+TIMEOUT = 10
+MAX_REDIRECTS = 5
+OUTPUT_PATH = "url_check.csv"
+RESULT_FIELDS = ["url", "page", "status", "page_ok", "anchor", "anchor_ok", "error"]
+
+# One pool of keep-alive connections per thread, by (scheme, host)
+_local = threading.local()
+
+
+class AnchorParser(HTMLParser):
+    """Collect the ids (and the names of the <a> elements) of an HTML page."""
+
+    def __init__(self):
+        super().__init__()
+        self.anchors = set()
+
+    def handle_starttag(self, tag, attrs):
+        for name, value in attrs:
+            if value and (name == "id" or (tag == "a" and name == "name")):
+                self.anchors.add(value)
+
+
 def get_url(file_name):
     logger.info(f"Reading URLs from file: {file_name}")
     urls = set()
@@ -40,38 +78,158 @@ def get_url(file_name):
     return urls
 
 
-def is_valid_url(url):
+def group_urls_by_page(urls):
+    """Group the URLs by page (URL without fragment)."""
+    pages = {}
+    for url in urls:
+        page, _fragment = urldefrag(url)
+        pages.setdefault(page, []).append(url)
+
+    return pages
+
+
+def get_connection(scheme, host, timeout):
+    """Get the keep-alive connection of the current thread to a host."""
+    if not hasattr(_local, "connections"):
+        _local.connections = {}
+    key = (scheme, host)
+    if key not in _local.connections:
+        if scheme == "https":
+            _local.connections[key] = http.client.HTTPSConnection(host, timeout=timeout)
+        else:
+            _local.connections[key] = http.client.HTTPConnection(host, timeout=timeout)
+
+    return _local.connections[key]
+
+
+def request(url, timeout):
+    """Send a GET request on a pooled connection, retrying once on a stale connection."""
+    parsed = urlparse(url)
+    path = parsed.path or "/"
+    if parsed.query:
+        path += f"?{parsed.query}"
+    for attempt in range(2):
+        connection = get_connection(parsed.scheme, parsed.netloc, timeout)
+        try:
+            connection.request("GET", path, headers={"Connection": "keep-alive"})
+            response = connection.getresponse()
+            return response.status, response.getheader("Location"), response.read()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            # The server closed the kept-alive connection: reconnect once
+            connection.close()
+            if attempt == 1:
+                raise
+        except Exception:
+            connection.close()
+            raise
+
+
+def fetch_page(page, timeout=TIMEOUT):
+    """Fetch a page once and collect its anchors.
+
+    Returns
+    -------
+    tuple
+        The HTTP status (None if the page could not be fetched), the set of anchors
+        of the page and the error message.
+    """
+    url = page
     try:
-        r = urlopen(url)
-        return r.status == 200
+        for _ in range(MAX_REDIRECTS + 1):
+            status, location, body = request(url, timeout)
+            if status in (301, 302, 303, 307, 308) and location:
+                url = urljoin(url, location)
+                continue
+            break
     except Exception as e:
-        return False
-
+        return None, set(), str(e)
+    if status != 200:
+        return status, set(), f"HTTP {status}"
+    parser = AnchorParser()
+    parser.feed(body.decode("utf-8", errors="replace"))
+
+    return status, parser.anchors, ""
+
+
+def check_page(page, urls, timeout=TIMEOUT):
+    """Check a page and the anchors of all its URLs."""
+    status, anchors, error = fetch_page(page, timeout)
+    results = []
+    for url in sorted(urls):
+        anchor = unquote(urlparse(url).fragment)
+        results.append(
+            {
+                "url": url,
+                "page": page,
+                "status": status,
+                "page_ok": status == 200,
+                "anchor": anchor,
+                "anchor_ok": (anchor in anchors) if anchor else status == 200,
+                "error": error,
+            }
+        )
+
+    return results
+
+
+def check_urls(urls, workers=WORKERS, timeout=TIMEOUT):
+    """Check all the URLs, fetching each page once with a pool of threads."""
+    pages = group_urls_by_page(urls)
+    logger.info(f"Checking {len(urls)} URLs on {len(pages)} pages...")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        page_results = executor.map(
+            lambda item: check_page(item[0], item[1], timeout), sorted(pages.items())
+        )
+        results = [result for results in page_results for result in results]
+
+    return results
+
+
+def save_results(results, output_path):
+    """Save the results as a CSV table (to the standard output if output_path is "-")."""
+    f = sys.stdout if output_path == "-" else open(output_path, "w", newline="")
+    try:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Check the URLs and anchors of a file.")
+    parser.add_argument("file_name", help="The path to the file containing URLs.")
+    parser.add_argument(
+        "--workers", type=int, default=WORKERS, help="The number of pages fetched concurrently."
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=TIMEOUT, help="The timeout of the connections, in seconds."
+    )
+    parser.add_argument(
+        "--output", default=OUTPUT_PATH, help="The CSV file where the results are saved."
+    )
+    args = parser.parse_args()
+
+    return args.file_name, args.workers, args.timeout, args.output
 
-def is_valid_anchor(url):
-    anchor = urlparse(url).fragment
-    r = urlopen(url)
-    if anchor not in str(r.read()):
-        logger.info(f"Checking URL: {url}")
-        logger.error("Anchor: ERROR")
-       
 
 if __name__ == "__main__":
-    # Get the file name from the command line
-    if len(sys.argv) != 2:
-        sys.exit("Error! Need exactly one argument: the path to the file containing URLs.")
-    
-    file_name = sys.argv[1]
+    file_name, workers, timeout, output_path = get_args()
 
     # Get the URLs from the file and check each URL
     urls = get_url(file_name)
-    for url in urls:
-        if not is_valid_url(url):
-            logger.info(f"Checking URL: {url}")
-            logger.error("URL: ERROR")
-        else:
-            if "#" in url:
-                is_valid_anchor(url)
-
-    logger.success("Done checking URLs.")
-    
+    results = check_urls(urls, workers, timeout)
+    for result in results:
+        if not result["page_ok"]:
+            logger.info(f"Checking URL: {result['url']}")
+            logger.error(f"URL: ERROR ({result['error']})")
+        elif not result["anchor_ok"]:
+            logger.info(f"Checking URL: {result['url']}")
+            logger.error("Anchor: ERROR")
+    save_results(results, output_path)
+
+    nb_errors = sum(not (result["page_ok"] and result["anchor_ok"]) for result in results)
+    logger.success(f"Done checking URLs: {nb_errors} error(s), results saved to '{output_path}'.")
+    if nb_errors:
+        sys.exit(1)
@@ -0,0 +1,658 @@
+"""Vector storage helpers for the Chroma databases.
+
+The full embedding of every chunk is saved next to the Chroma database
+in a NumPy file (row i is the embedding of the chunk with id i), which can be memory-mapped.
+
+With the truncated-dimension mode, Chroma only stores a renormalized prefix of the embeddings
+(for example the first 256 dimensions of the 3072 dimensions of text-embedding-3-large).
+The first-pass search in Chroma is then faster and lighter,
+and the top candidates are rescored exactly with the full embeddings.
+
+The search can be restricted to a subset of the chunks (a chapter, an appendix or a section),
+given by the inverted index of their metadata: only the embeddings of this subset are scanned.
+In the two-stage mode, this subset is the chunks of the chapters (or sections)
+whose centroid embeddings are the most similar to the query.
+
+With the quantized mode, the embeddings are also encoded as int8 codes
+(per-dimension min/max scalar quantization, 4x smaller than float32)
+or as binary sign codes (32x smaller). Only the codes are kept in memory:
+the candidates are generated with integer dot products (or Hamming distances) on the codes,
+and the top candidates are rescored exactly with the full embeddings memory-mapped from disk.
+"""
+
+# METADATA
+__authors__ = ("Pierre Poulain", "Essmay Touami")
+__contact__ = "pierre.poulain@u-paris.fr"
+__copyright__ = "BSD-3 clause"
+__date__ = "2024"
+__version__ = "1.0.0"
+
+
+# LIBRARY IMPORTS
+import os
+import threading
+from typing import Any, Callable, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+from loguru import logger
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+from langchain_community.vectorstores import Chroma
+
+# MODULE IMPORTS
+from metadata_index import get_filter_rows
+from centroids import get_top_group_rows
+from chunk_store import ChunkStore
+
+
+# CONSTANTS
+EMBEDDINGS_FILE = "embeddings.npy"
+CODES_FILE = "codes.npy"
+QUANTIZATION_FILE = "quantization.npz"
+QUANTIZATIONS = ("int8", "binary")
+RESCORE_FACTOR = 4
+SCAN_BLOCK_SIZE = 4096
+# Number of bits set in each byte value
+POPCOUNT = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.uint8)
+# Number of open Chroma databases of each path (see `open_chroma` and `release_chroma`)
+CHROMA_REFCOUNTS = {}
+CHROMA_REFCOUNTS_LOCK = threading.Lock()
+
+
+# FUNCTIONS
+def normalize_vectors(vectors: np.ndarray) -> np.ndarray:
+    """L2-normalize vectors along their last axis.
+
+    Parameters
+    ----------
+    vectors : np.ndarray
+        A vector or a matrix of vectors (one per row).
+
+    Returns
+    -------
+    np.ndarray
+        The normalized vectors, as float32.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def truncate_vectors(vectors: np.ndarray, truncate_dim: Optional[int]) -> np.ndarray:
+    """Keep the first dimensions of vectors and renormalize them.
+
+    Parameters
+    ----------
+    vectors : np.ndarray
+        A vector or a matrix of vectors (one per row).
+    truncate_dim : int or None
+        The number of dimensions to keep. None keeps all the dimensions.
+
+    Returns
+    -------
+    np.ndarray
+        The truncated and normalized vectors.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if truncate_dim is None:
+        return normalize_vectors(vectors)
+
+    return normalize_vectors(vectors[..., :truncate_dim])
+
+
+def save_embeddings(vectors: List[List[float]], vector_db_path: str) -> str:
+    """Save the full embeddings of the chunks next to the vector database.
+
+    Parameters
+    ----------
+    vectors : list of list of float
+        The embeddings of the chunks, ordered by chunk id.
+    vector_db_path : str
+        The directory of the vector database.
+
+    Returns
+    -------
+    embeddings_path : str
+        The path of the saved NumPy file.
+    """
+    embeddings_path = os.path.join(vector_db_path, EMBEDDINGS_FILE)
+    np.save(embeddings_path, normalize_vectors(vectors))
+    logger.info(f"Saved {len(vectors)} full embeddings to '{embeddings_path}'.")
+
+    return embeddings_path
+
+
+def load_embeddings(vector_db_path: str) -> np.ndarray:
+    """Memory-map the full embeddings saved next to the vector database.
+
+    Parameters
+    ----------
+    vector_db_path : str
+        The directory of the vector database.
+
+    Returns
+    -------
+    np.ndarray
+        The read-only memory-mapped embeddings (one row per chunk id).
+    """
+    return np.load(os.path.join(vector_db_path, EMBEDDINGS_FILE), mmap_mode="r")
+
+
+def quantize_embeddings(vectors: np.ndarray, quantization: str) -> dict:
+    """Encode embeddings as int8 or binary codes.
+
+    Parameters
+    ----------
+    vectors : np.ndarray
+        The normalized embeddings, one row per chunk.
+    quantization : str
+        "int8": each dimension is mapped linearly from its [min, max] range to [-128, 127].
+        "binary": each dimension is encoded by its sign, 8 dimensions per byte.
+
+    Returns
+    -------
+    dict
+        The codes and the parameters needed to decode them.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if quantization == "int8":
+        minimums = vectors.min(axis=0)
+        scales = (vectors.max(axis=0) - minimums) / 255
+        scales[scales == 0] = 1
+        codes = np.round((vectors - minimums) / scales) - 128
+        return {
+            "codes": codes.astype(np.int8),
+            "minimums": minimums,
+            "scales": scales.astype(np.float32),
+        }
+    if quantization == "binary":
+        return {"codes": np.packbits(vectors > 0, axis=1)}
+    raise ValueError(f"Unknown quantization '{quantization}'. Choose among {QUANTIZATIONS}.")
+
+
+def save_quantized_embeddings(
+    vectors: List[List[float]], vector_db_path: str, quantization: str
+) -> None:
+    """Save the quantized codes of the embeddings next to the vector database.
+
+    Parameters
+    ----------
+    vectors : list of list of float
+        The embeddings of the chunks, ordered by chunk id.
+    vector_db_path : str
+        The directory of the vector database.
+    quantization : str
+        The quantization: "int8" or "binary".
+    """
+    quantized = quantize_embeddings(normalize_vectors(vectors), quantization)
+    np.save(os.path.join(vector_db_path, CODES_FILE), quantized.pop("codes"))
+    np.savez(os.path.join(vector_db_path, QUANTIZATION_FILE), **quantized)
+    logger.info(f"Saved the {quantization} codes of {len(vectors)} embeddings.")
+
+
+def load_quantized_embeddings(vector_db_path: str) -> dict:
+    """Load the quantized codes of the embeddings in memory.
+
+    Parameters
+    ----------
+    vector_db_path : str
+        The directory of the vector database.
+
+    Returns
+    -------
+    dict
+        The codes and the parameters needed to decode them.
+    """
+    quantized = dict(np.load(os.path.join(vector_db_path, QUANTIZATION_FILE)))
+    quantized["codes"] = np.load(os.path.join(vector_db_path, CODES_FILE))
+
+    return quantized
+
+
+def rescore(
+    full_vectors: np.ndarray, rows: np.ndarray, query_vector: np.ndarray, k: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Rescore candidate chunks with their full embeddings.
+
+    Parameters
+    ----------
+    full_vectors : np.ndarray
+        The full normalized embeddings (possibly memory-mapped), one row per chunk id.
+    rows : np.ndarray
+        The ids of the candidate chunks.
+    query_vector : np.ndarray
+        The full normalized query embedding.
+    k : int
+        The number of chunks to keep.
+
+    Returns
+    -------
+    tuple of np.ndarray
+        The ids of the best k candidates and their cosine similarities, by decreasing similarity.
+    """
+    # Sorted rows make the reads of a memory-mapped file sequential
+    order = np.argsort(rows)
+    rows = np.asarray(rows)[order]
+    scores = full_vectors[rows] @ query_vector
+    best = np.argsort(-scores)[:k]
+
+    return rows[best], scores[best]
+
+
+def open_chroma(persist_directory: str, embedding_function: Embeddings) -> Chroma:
+    """Open a Chroma database, counted until it is released with `release_chroma`.
+
+    Parameters
+    ----------
+    persist_directory : str
+        The directory of the Chroma database.
+    embedding_function : Embeddings
+        The embedding function of the queries.
+
+    Returns
+    -------
+    Chroma
+        The Chroma database.
+    """
+    chroma = Chroma(persist_directory=persist_directory, embedding_function=embedding_function)
+    identifier = getattr(getattr(chroma, "_client", None), "_identifier", None)
+    with CHROMA_REFCOUNTS_LOCK:
+        CHROMA_REFCOUNTS[identifier] = CHROMA_REFCOUNTS.get(identifier, 0) + 1
+
+    return chroma
+
+
+def release_chroma(chroma: Chroma) -> None:
+    """Release the Chroma client of a database, closing its SQLite file and HNSW segments.
+
+    The clients of a path share one Chroma system, which stays open as long as
+    it is referenced: the system is stopped when its last client is released.
+    Other databases opened on the same path with `open_chroma` (a version still used
+    by in-flight requests and loaded again) keep working.
+
+    Parameters
+    ----------
+    chroma : Chroma
+        The Chroma database.
+    """
+    client = getattr(chroma, "_client", None)
+    if client is None:
+        return
+    identifier = getattr(client, "_identifier", None)
+    with CHROMA_REFCOUNTS_LOCK:
+        nb_open = CHROMA_REFCOUNTS.get(identifier, 1) - 1
+        if nb_open > 0:
+            CHROMA_REFCOUNTS[identifier] = nb_open
+        else:
+            CHROMA_REFCOUNTS.pop(identifier, None)
+        if hasattr(client, "close"):
+            # Chroma counts the clients of its systems itself
+            client.close()
+        elif nb_open == 0:
+            # Clients without close(): stop the shared system of the last client and forget it
+            systems = getattr(type(client), "_identifier_to_system", {})
+            system = systems.pop(identifier, None)
+            if system is not None:
+                system.stop()
+
+
+# CLASSES
+class RecordingEmbeddings(Embeddings):
+    """Embedding function keeping the full embeddings of the embedded documents.
+
+    The documents and queries are embedded with the underlying embedding function.
+    The full normalized embeddings of the documents are kept in `vectors`,
+    and the returned embeddings are truncated to `truncate_dim` dimensions (if given).
+    """
+
+    def __init__(self, embedding_function: Embeddings, truncate_dim: Optional[int] = None) -> None:
+        self.embedding_function = embedding_function
+        self.truncate_dim = truncate_dim
+        self.vectors = []
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed documents and keep their full embeddings."""
+        vectors = normalize_vectors(self.embedding_function.embed_documents(texts))
+        self.vectors.extend(vectors)
+
+        return truncate_vectors(vectors, self.truncate_dim).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a query, truncated to `truncate_dim` dimensions."""
+        vector = self.embedding_function.embed_query(text)
+
+        return truncate_vectors(vector, self.truncate_dim).tolist()
+
+
+class ChunkVectorStore(VectorStore):
+    """Read-only vector store over a Chroma database and its full embeddings.
+
+    Unfiltered searches use the HNSW index of Chroma. Filtered searches
+    (`rows` argument, see `filter_rows`) compute the exact cosine similarity of
+    the query with the full embeddings of the selected chunks only.
+    Two-stage searches (`two_stage` argument) first select the chapters or sections
+    whose centroids are the most similar to the query, then scan their chunks only.
+    Scores are cosine similarities, as the relevance scores of a Chroma collection
+    using the cosine distance, so that `k` and `score_threshold` behave as with
+    a plain Chroma database.
+    """
+
+    def __init__(
+        self,
+        chroma: Chroma,
+        embedding_function: Embeddings,
+        full_vectors: np.ndarray,
+        metadata_index: dict,
+        rescore_factor: int = RESCORE_FACTOR,
+        centroids: Optional[dict] = None,
+        chunk_store: Optional[ChunkStore] = None,
+    ) -> None:
+        self.chroma = chroma
+        self.embedding_function = embedding_function
+        self.full_vectors = full_vectors
+        self.metadata_index = metadata_index
+        self.rescore_factor = rescore_factor
+        self.centroids = centroids or {}
+        self.chunk_store = chunk_store
+        # Same attribute as Chroma, used to count the chunks
+        self._collection = chroma._collection
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding_function
+
+    def close(self) -> None:
+        """Stop the threads of the embedding function, if any."""
+        if hasattr(self.embedding_function, "close"):
+            self.embedding_function.close()
+
+    def get(self, *args: Any, **kwargs: Any) -> dict:
+        """Get chunks from the underlying Chroma collection."""
+        return self.chroma.get(*args, **kwargs)
+
+    def get_documents(self, rows: np.ndarray) -> List[Document]:
+        """Fetch the documents of chunks, in the order of their ids.
+
+        The documents are read from the chunk store if the database has one,
+        from Chroma otherwise.
+
+        Parameters
+        ----------
+        rows : np.ndarray
+            The ids of the chunks.
+
+        Returns
+        -------
+        list of Document
+            The documents of the chunks.
+        """
+        if len(rows) == 0:
+            return []
+        if self.chunk_store is not None:
+            return [self.chunk_store[row].to_document() for row in rows]
+        results = self.chroma.get(ids=[str(row) for row in rows])
+        documents = {
+            chunk_id: Document(page_content=content, metadata=metadata)
+            for chunk_id, content, metadata in zip(
+                results["ids"], results["documents"], results["metadatas"]
+            )
+        }
+
+        return [documents[str(row)] for row in rows]
+
+    def filter_rows(
+        self,
+        chapter: Optional[Union[int, str]] = None,
+        appendix: Optional[str] = None,
+        section: Optional[str] = None,
+    ) -> np.ndarray:
+        """Get the ids of the chunks of a chapter, an appendix and/or a section.
+
+        Parameters
+        ----------
+        chapter : int or str, optional
+            The chapter number, by default None.
+        appendix : str, optional
+            The appendix letter, by default None.
+        section : str, optional
+            The section number or name, by default None.
+
+        Returns
+        -------
+        np.ndarray
+            The sorted ids of the chunks matching all the given filters.
+        """
+        return get_filter_rows(self.metadata_index, chapter, appendix, section)
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, rows: Optional[np.ndarray] = None, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        """Search the chunks most similar to the query.
+
+        Parameters
+        ----------
+        query : str
+            The query text.
+        k : int, optional
+            The number of chunks to return, by default 4.
+        rows : np.ndarray, optional
+            The ids of the chunks to search, by default all the chunks.
+        two_stage : int, optional
+            The number of chapters (or sections) searched in the two-stage mode,
+            by default None (single-stage search).
+        two_stage_level : str, optional
+            "chapter" or "section", by default "chapter".
+
+        Returns
+        -------
+        list of tuple
+            List of (chunk, cosine similarity), by decreasing similarity.
+        """
+        query_vector = normalize_vectors(self.embedding_function.embed_query(query))
+
+        return self.similarity_search_by_vector_with_score(query_vector, k, rows, **kwargs)
+
+    def similarity_search_by_vector_with_score(
+        self,
+        query_vector: np.ndarray,
+        k: int = 4,
+        rows: Optional[np.ndarray] = None,
+        two_stage: Optional[int] = None,
+        two_stage_level: str = "chapter",
+        **kwargs: Any,
+    ) -> List[Tuple[Document, float]]:
+        """Search the chunks most similar to a full query embedding.
+
+        Parameters
+        ----------
+        query_vector : np.ndarray
+            The full normalized query embedding.
+        k : int, optional
+            The number of chunks to return, by default 4.
+        rows : np.ndarray, optional
+            The ids of the chunks to search, by default all the chunks.
+        two_stage : int, optional
+            The number of chapters (or sections) searched in the two-stage mode,
+            by default None (single-stage search).
+        two_stage_level : str, optional
+            "chapter" or "section", by default "chapter".
+
+        Returns
+        -------
+        list of tuple
+            List of (chunk, cosine similarity), by decreasing similarity.
+        """
+        if two_stage:
+            # First stage: chunks of the chapters (or sections) closest to the query
+            top_rows = get_top_group_rows(
+                self.centroids, self.metadata_index, query_vector, two_stage, two_stage_level
+            )
+            rows = top_rows if rows is None else np.intersect1d(rows, top_rows)
+        if rows is None:
+            return self.search_all(query_vector, k, **kwargs)
+        # Exact scan of the selected chunks only
+        if len(rows) == 0:
+            return []
+        best_rows, best_scores = rescore(self.full_vectors, rows, query_vector, k)
+
+        return list(zip(self.get_documents(best_rows), best_scores.tolist()))
+
+    def search_all(
+        self, query_vector: np.ndarray, k: int, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        """Search all the chunks with the HNSW index of Chroma."""
+        results = self.chroma.similarity_search_by_vector_with_relevance_scores(
+            query_vector.tolist(), k=k, **kwargs
+        )
+
+        # Chroma returns cosine distances
+        return [(document, 1.0 - distance) for document, distance in results]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        """Search the chunks most similar to the query."""
+        return [
+            document
+            for document, _score in self.similarity_search_with_score(query, k, **kwargs)
+        ]
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        # Scores are already cosine similarities
+        return lambda score: score
+
+    def add_texts(
+        self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs: Any
+    ) -> List[str]:
+        raise NotImplementedError("The database is read-only: rebuild it with create_database.py.")
+
+    @classmethod
+    def from_texts(cls, *args: Any, **kwargs: Any) -> "ChunkVectorStore":
+        raise NotImplementedError("Build the database with create_database.py.")
+
+
+class RescoringVectorStore(ChunkVectorStore):
+    """Read-only vector store rescoring Chroma candidates with the full embeddings.
+
+    Chroma holds the truncated embeddings and returns `rescore_factor * k` candidates,
+    which are rescored with the cosine similarity between the full query embedding
+    and their full embeddings.
+    """
+
+    def __init__(
+        self,
+        chroma: Chroma,
+        embedding_function: Embeddings,
+        full_vectors: np.ndarray,
+        metadata_index: dict,
+        truncate_dim: int,
+        rescore_factor: int = RESCORE_FACTOR,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(
+            chroma, embedding_function, full_vectors, metadata_index, rescore_factor, **kwargs
+        )
+        self.truncate_dim = truncate_dim
+
+    def search_all(
+        self, query_vector: np.ndarray, k: int, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        """Search the truncated embeddings in Chroma and rescore the candidates."""
+        # First pass: truncated embeddings in Chroma
+        candidates = self.chroma.similarity_search_by_vector_with_relevance_scores(
+            truncate_vectors(query_vector, self.truncate_dim).tolist(),
+            k=k * self.rescore_factor,
+            **kwargs,
+        )
+        if not candidates:
+            return []
+        # Second pass: exact rescoring with the full embeddings
+        documents = {document.metadata["id"]: document for document, _score in candidates}
+        rows, scores = rescore(
+            self.full_vectors, np.array(list(documents)), query_vector, k
+        )
+
+        return [(documents[row], float(score)) for row, score in zip(rows, scores)]
+
+
+class QuantizedVectorStore(ChunkVectorStore):
+    """Read-only vector store searching quantized codes held in memory.
+
+    The `rescore_factor * k` candidates are generated from the int8 or binary codes
+    and rescored with the cosine similarity between the full query embedding
+    and their full embeddings, memory-mapped from disk. The documents of the best chunks
+    are then fetched from Chroma by id.
+    """
+
+    def __init__(
+        self,
+        chroma: Chroma,
+        embedding_function: Embeddings,
+        full_vectors: np.ndarray,
+        metadata_index: dict,
+        quantized: dict,
+        quantization: str,
+        rescore_factor: int = RESCORE_FACTOR,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(
+            chroma, embedding_function, full_vectors, metadata_index, rescore_factor, **kwargs
+        )
+        self.codes = quantized["codes"]
+        self.scales = quantized.get("scales")
+        self.quantization = quantization
+
+    def score_codes(self, query_vector: np.ndarray) -> np.ndarray:
+        """Compute approximate scores of all the chunks from their codes.
+
+        For int8 codes, the query weighted by the scale of each dimension is itself
+        quantized to int8, and the scores are integer dot products computed by blocks
+        of rows (the offsets of the dimensions add the same constant to every score).
+        For binary codes, the scores are the opposite of the Hamming distances
+        between the sign bits of the query and of the chunks.
+
+        Parameters
+        ----------
+        query_vector : np.ndarray
+            The full normalized query embedding.
+
+        Returns
+        -------
+        np.ndarray
+            One score per chunk, higher is more similar.
+        """
+        if self.quantization == "binary":
+            query_bits = np.packbits(query_vector > 0)
+            distances = np.empty(len(self.codes), dtype=np.int32)
+            for start in range(0, len(self.codes), SCAN_BLOCK_SIZE):
+                block = self.codes[start : start + SCAN_BLOCK_SIZE]
+                distances[start : start + len(block)] = POPCOUNT[
+                    np.bitwise_xor(block, query_bits)
+                ].sum(axis=1, dtype=np.int32)
+            return -distances
+
+        weights = query_vector * self.scales
+        weights_max = np.abs(weights).max()
+        query_codes = np.round(weights / (weights_max if weights_max else 1) * 127)
+        query_codes = query_codes.astype(np.int32)
+        scores = np.empty(len(self.codes), dtype=np.int32)
+        for start in range(0, len(self.codes), SCAN_BLOCK_SIZE):
+            block = self.codes[start : start + SCAN_BLOCK_SIZE].astype(np.int32)
+            scores[start : start + len(block)] = block @ query_codes
+
+        return scores
+
+    def search_all(
+        self, query_vector: np.ndarray, k: int, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        """Search the codes and rescore the candidates with the full embeddings."""
+        if len(self.codes) == 0:
+            return []
+        # First pass: approximate scores from the codes
+        scores = self.score_codes(query_vector)
+        nb_candidates = min(k * self.rescore_factor, len(scores))
+        candidates = np.argpartition(-scores, nb_candidates - 1)[:nb_candidates]
+        # Second pass: exact rescoring with the full embeddings
+        best_rows, best_scores = rescore(self.full_vectors, candidates, query_vector, k)
+
+        return list(zip(self.get_documents(best_rows), best_scores.tolist()))